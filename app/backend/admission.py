@@ -0,0 +1,117 @@
+from collections import Counter, deque
+from typing import Callable, Dict, Iterable, List, Tuple
+import time
+
+# Kitaverse admission control
+#
+# A space's nominal capacity says how many people it is designed for, not how
+# many this server can serve right now. Once a second the controller looks at
+# how late the event loop runs, how far the chat tick overruns and how many
+# events wait in each space's outbound queues, and scales each space's
+# effective capacity: down multiplicatively while any signal is above its
+# target, back up step by step once every signal is well below it. Lowering
+# only stops new entries; nobody already inside is moved out.
+#
+# Every change is kept as a decision, with the signals behind it, so
+# operators can see why a space stopped admitting and tune the targets.
+
+# (space_id, nominal capacity, current users, mean queued events per connection)
+SpaceLoad = Tuple[int, int, int, float]
+
+class AdmissionController:
+    """Effective capacity per space from server load"""
+
+    def __init__(self, lag_target: float = 0.05, overrun_target: float = 0.05,
+                 queue_target: float = 32.0, min_share: float = 0.25, max_boost: float = 1.0,
+                 decrease: float = 0.8, step: float = 0.1, recover_below: float = 0.5,
+                 history: int = 200, clock: Callable[[], float] = time.time):
+        self.targets = {"loop_lag": lag_target, "tick_overrun": overrun_target, "queue_depth": queue_target}
+        self.min_share = min_share
+        self.max_boost = max_boost
+        self.decrease = decrease
+        self.step = step
+        self.recover_below = recover_below
+        self.clock = clock
+        self.scale: Dict[int, float] = {}
+        self.signals = {"loop_lag": 0.0, "tick_overrun": 0.0, "queue_depth": {}}
+        self.pressure = 0.0
+        self.decisions = deque(maxlen=history)
+        self.rejected = Counter()
+        self._max_overrun = 0.0
+
+    @property
+    def overloaded(self) -> bool:
+        return self.pressure > 1.0
+
+    def capacity(self, space_id: int, nominal: int) -> int:
+        """How many users a space admits right now"""
+        return max(1, round(nominal * self.scale.get(space_id, 1.0)))
+
+    def observe_tick(self, overrun: float):
+        """Record how far a periodic tick finished past its deadline"""
+        self._max_overrun = max(self._max_overrun, overrun)
+
+    def update(self, loop_lag: float, spaces: Iterable[SpaceLoad]) -> List[dict]:
+        """Adjust every space to the latest signals; returns the decisions made"""
+        overrun, self._max_overrun = self._max_overrun, 0.0
+        server_signals = {"loop_lag": loop_lag, "tick_overrun": overrun}
+        server_pressure = {name: value / self.targets[name] for name, value in server_signals.items()}
+        self.pressure = max(server_pressure.values())
+
+        queue_depth = {}
+        made = []
+        seen = set()
+        for space_id, nominal, current_users, queued in spaces:
+            seen.add(space_id)
+            queue_depth[space_id] = round(queued, 1)
+            pressures = dict(server_pressure, queue_depth=queued / self.targets["queue_depth"])
+            signal, pressure = max(pressures.items(), key=lambda item: item[1])
+
+            scale = self.scale.get(space_id, 1.0)
+            if pressure > 1.0:
+                new_scale, reason = max(self.min_share, scale * self.decrease), signal
+            elif pressure < self.recover_below:
+                new_scale, reason = min(self.max_boost, scale + self.step), "headroom"
+            else:
+                continue
+            self.scale[space_id] = new_scale
+
+            before = max(1, round(nominal * scale))
+            after = max(1, round(nominal * new_scale))
+            if after != before:
+                decision = {
+                    "at": self.clock(),
+                    "space_id": space_id,
+                    "from": before,
+                    "to": after,
+                    "nominal": nominal,
+                    "current_users": current_users,
+                    "reason": reason,
+                    "pressure": round(pressure, 2)
+                }
+                self.decisions.append(decision)
+                made.append(decision)
+
+        # Forget spaces that no longer exist, e.g. closed overflow instances
+        for space_id in set(self.scale) - seen:
+            del self.scale[space_id]
+        self.signals = dict(server_signals, queue_depth=queue_depth)
+        return made
+
+    def report(self) -> dict:
+        return {
+            "pressure": round(self.pressure, 2),
+            "signals": {
+                "loop_lag_ms": round(self.signals["loop_lag"] * 1000, 1),
+                "tick_overrun_ms": round(self.signals["tick_overrun"] * 1000, 1),
+                "queue_depth": self.signals["queue_depth"]
+            },
+            "targets": {
+                "loop_lag_ms": self.targets["loop_lag"] * 1000,
+                "tick_overrun_ms": self.targets["tick_overrun"] * 1000,
+                "queue_depth": self.targets["queue_depth"],
+                "min_share": self.min_share,
+                "max_boost": self.max_boost
+            },
+            "decisions": list(self.decisions)
+        }
@@ -0,0 +1,71 @@
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+from typing import Optional, Tuple
+import os
+import re
+
+# Kitaverse file serving
+#
+# Serves asset objects, update chunks and manifests with validators and byte
+# ranges, so a phone on a flaky link can resume a download instead of
+# starting over and never downloads an unchanged file twice.
+
+# Content-addressed files never change
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Manifests change between releases and must be revalidated
+REVALIDATE = "no-cache"
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range Range header into inclusive (start, end).
+
+    Returns None if the range cannot be satisfied.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def stat_etag(path: str) -> str:
+    """Validator for files that change in place, like manifests"""
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def serve_file(request: Request, path: str, etag: str, cache_control: str,
+               media_type: str = "application/octet-stream") -> Response:
+    """Serve a file honouring If-None-Match, Range and If-Range"""
+    size = os.path.getsize(path)
+    quoted_etag = f'"{etag}"'
+    headers = {"ETag": quoted_etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match")
+    # Weak comparison: compressed responses carry W/ validators
+    if if_none_match and quoted_etag in [tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # Multiple ranges are answered with the whole file, as HTTP allows
+    if range_header and "," not in range_header and (if_range is None or if_range == quoted_etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+        start, end = byte_range
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(content=data, status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers)
@@ -0,0 +1,133 @@
+from typing import List, Optional, Tuple
+import gzip
+
+# Brotli is optional: it compresses JSON better than gzip at similar speed
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+# Kitaverse response compression
+#
+# Compresses JSON and text responses for clients that send Accept-Encoding,
+# preferring Brotli when it is installed. Responses smaller than
+# `minimum_size` are sent as they are: on small bodies the saving is a few
+# bytes and not worth the CPU time. Binary files (assets, update chunks) are
+# already compact and may be range requests, so they are never compressed.
+# See bench_compression.py for how the defaults were chosen.
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+def parse_accept_encoding(header: str) -> List[str]:
+    """Encodings a client accepts, best first"""
+    accepted = []
+    for position, part in enumerate(header.split(",")):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name and quality > 0:
+            accepted.append((-quality, position, name.strip().lower()))
+    return [name for _, _, name in sorted(accepted)]
+
+def choose_encoding(header: Optional[str]) -> Optional[str]:
+    """Best encoding both sides support, or None for identity"""
+    if not header:
+        return None
+    for name in parse_accept_encoding(header):
+        if name == "br" and HAS_BROTLI:
+            return "br"
+        if name == "gzip":
+            return "gzip"
+        if name == "*":
+            return "br" if HAS_BROTLI else "gzip"
+    return None
+
+def compress(data: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 4) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+def is_compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+    content_type = ""
+    for name, value in headers:
+        name = name.lower()
+        if name == b"content-encoding":
+            return False
+        if name == b"content-type":
+            content_type = value.decode("latin-1").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def add_vary(headers: List[Tuple[bytes, bytes]], field: bytes) -> List[Tuple[bytes, bytes]]:
+    """Add a field to the Vary header, merging with an existing one"""
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == b"vary":
+            if field.lower() not in [v.strip().lower() for v in value.split(b",")]:
+                headers[i] = (name, value + b", " + field)
+            return headers
+    return headers + [(b"vary", field)]
+
+class CompressionMiddleware:
+    """ASGI middleware compressing responses of at least `minimum_size` bytes"""
+
+    def __init__(self, app, minimum_size: int = 256, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = None
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = choose_encoding(accept_encoding)
+
+        start = None
+        body = []
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start = message
+                headers = list(message.get("headers", []))
+                if not is_compressible(headers) or message["status"] in (204, 206, 304):
+                    passthrough = True
+                    await send(message)
+                else:
+                    # The body depends on Accept-Encoding, even when it is not compressed
+                    start["headers"] = add_vary(headers, b"Accept-Encoding")
+                return
+
+            body.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            data = b"".join(body)
+            headers = start["headers"]
+            if encoding and len(data) >= self.minimum_size:
+                data = compress(data, encoding, self.gzip_level, self.brotli_quality)
+                headers = [(name, value) for name, value in headers
+                           if name.lower() not in (b"content-length", b"etag")]
+                headers += [(b"content-encoding", encoding.encode()),
+                            (b"content-length", str(len(data)).encode())]
+                # The compressed body is a different representation: weaken the validator
+                for name, value in start["headers"]:
+                    if name.lower() == b"etag":
+                        headers.append((b"etag", value if value.startswith(b"W/") else b"W/" + value))
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": data})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Hashable, Optional
+import asyncio
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+# Kitaverse concurrency helpers
+#
+# Handlers run on a single event loop, so a handler that blocks (file I/O, a
+# slow computation) stalls every user of the process. Blocking work goes to a
+# thread pool via BlockingPool.run(), changes to a space are serialized with a
+# per-space lock even when they await in the middle, and LoopBlockDetector
+# logs the stack of any code that keeps the loop busy for too long.
+
+logger = logging.getLogger("kitaverse")
+
+class SpaceLocks:
+    """One asyncio.Lock per space, created on first use"""
+
+    def __init__(self):
+        # Locks of spaces nobody is waiting on are dropped automatically
+        self._locks: "weakref.WeakValueDictionary[Hashable, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def get(self, key: Hashable) -> asyncio.Lock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    @asynccontextmanager
+    async def hold(self, *keys: Hashable):
+        """Hold the locks of several spaces, always taken in the same order"""
+        locks = [self.get(key) for key in sorted(set(keys))]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+class BlockingPool:
+    """Thread pool for work that must not run on the event loop"""
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="kitaverse-blocking")
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Run `func(*args, **kwargs)` in the pool and await its result"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+class LoopBlockDetector:
+    """Report code that keeps the event loop from running other tasks.
+
+    A task on the loop records a heartbeat every `interval` seconds. A watchdog
+    thread checks the heartbeat; if it is more than `threshold` seconds late,
+    it logs the loop thread's current stack, which names the blocking handler.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.threshold = threshold
+        self.interval = interval if interval is not None else threshold / 2
+        self.clock = clock
+        self.blocks = 0
+        self.max_block = 0.0
+        self.last_lag = 0.0
+        self.peak_lag = 0.0  # Since take_peak_lag was last called
+        self._beat = clock()
+        self._loop_thread: Optional[int] = None
+        self._reported_beat: Optional[float] = None
+        self._stopped = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start watching the running loop (call from the loop)"""
+        self._loop_thread = threading.get_ident()
+        self._beat = self.clock()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="kitaverse-loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = self.clock() + self.interval
+            await asyncio.sleep(self.interval)
+            now = self.clock()
+            self.last_lag = max(0.0, now - expected)
+            self.peak_lag = max(self.peak_lag, self.last_lag)
+            if self.last_lag > self.threshold:
+                self.blocks += 1
+                self.max_block = max(self.max_block, self.last_lag)
+                logger.warning("Event loop was blocked for %.0f ms", self.last_lag * 1000)
+            self._beat = now
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beat
+            late = self.clock() - beat - self.interval
+            if late > self.threshold and self._reported_beat != beat:
+                # Report each stall once, while it is still happening
+                self._reported_beat = beat
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else "(unknown)\n"
+                logger.warning("Event loop blocked for over %.0f ms in:\n%s", late * 1000, stack)
+
+    def take_peak_lag(self) -> float:
+        """Largest lag since the previous call"""
+        peak, self.peak_lag = self.peak_lag, 0.0
+        return peak
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "blocks": self.blocks,
+            "max_block_ms": round(self.max_block * 1000, 1),
+            "last_lag_ms": round(self.last_lag * 1000, 1)
+        }
@@ -0,0 +1,57 @@
+from typing import List, Optional, Tuple
+import json
+import os
+
+# Kitaverse space definitions
+#
+# Spaces are defined in a JSON file shared with the clients
+# (app/client/spaces.json). The backend watches the file and applies changes
+# to the running server instead of requiring a restart.
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SPACES_FILE = os.path.join(BACKEND_DIR, "..", "client", "spaces.json")
+
+# Fields of a definition that the backend keeps on its Space model
+SPACE_FIELDS = ("id", "name", "type", "description", "capacity")
+
+# Overflow instances of a full space get ids parent_id + n * OVERFLOW_ID_STRIDE,
+# so the router can map any overflow id back to the worker hosting its parent.
+# Defined ids must stay below the stride, or they would alias another space's
+# overflow instances (1001 would share space 1's locks, history and worker).
+OVERFLOW_ID_STRIDE = 1000
+
+def load_space_definitions(path: str) -> List[dict]:
+    """Read space definitions, keeping only the fields the backend uses.
+
+    Raises ValueError for a space id outside 0 to OVERFLOW_ID_STRIDE - 1.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    definitions = [{k: d[k] for k in SPACE_FIELDS if k in d} for d in data["spaces"]]
+    for definition in definitions:
+        space_id = definition["id"]
+        if isinstance(space_id, bool) or not isinstance(space_id, int) or not 0 <= space_id < OVERFLOW_ID_STRIDE:
+            raise ValueError(f"Space id {space_id!r} is not between 0 and {OVERFLOW_ID_STRIDE - 1}")
+    return definitions
+
+class DefinitionWatcher:
+    """Detects changes to the definitions file by modification time and size"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.signature = self._signature()
+
+    def _signature(self) -> Optional[Tuple[float, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def changed(self) -> bool:
+        """Return True once after each change to the file"""
+        signature = self._signature()
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        return True
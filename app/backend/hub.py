@@ -0,0 +1,133 @@
+from fastapi import WebSocket
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Optional
+import asyncio
+
+# Kitaverse connection hub
+#
+# Tracks the open WebSocket of each user per space and pushes space events
+# (users entering, leaving, moving, ...) to everyone in that space.
+#
+# Sends never block the caller: every connection has a bounded outbound queue
+# drained by its own sender task. Position updates are snapshots, so a newer
+# one replaces an unsent older one for the same user instead of queueing up
+# behind a slow phone. Whatever is queued when the sender wakes up goes out as
+# one {"type": "batch", "events": [...]} frame.
+
+MAX_QUEUED_EVENTS = 256
+MAX_BATCH_EVENTS = 64
+
+class Connection:
+    """A WebSocket connection with its outbound queue"""
+
+    def __init__(self, websocket: WebSocket, stats: Counter, max_events: int = MAX_QUEUED_EVENTS):
+        self.websocket = websocket
+        self.stats = stats
+        self.events = deque()
+        self.max_events = max_events
+        self.positions: "OrderedDict[int, dict]" = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.sender = asyncio.ensure_future(self._send_loop())
+
+    def __len__(self):
+        return len(self.events) + len(self.positions)
+
+    def send(self, event: dict):
+        """Queue an event, dropping the oldest one if the queue is full"""
+        if len(self.events) >= self.max_events:
+            self.events.popleft()
+            self.stats["events_dropped"] += 1
+        self.events.append(event)
+        self.wakeup.set()
+
+    def send_position(self, user_id: int, event: dict):
+        """Queue a position snapshot, replacing an unsent one for the same user"""
+        if user_id in self.positions:
+            self.stats["positions_coalesced"] += 1
+            del self.positions[user_id]
+        self.positions[user_id] = event
+        self.wakeup.set()
+
+    def close(self):
+        """Stop the sender task"""
+        self.sender.cancel()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.events or self.positions:
+                    batch = []
+                    while self.events and len(batch) < MAX_BATCH_EVENTS:
+                        batch.append(self.events.popleft())
+                    while self.positions and len(batch) < MAX_BATCH_EVENTS:
+                        batch.append(self.positions.popitem(last=False)[1])
+                    
+                    if len(batch) == 1:
+                        await self.websocket.send_json(batch[0])
+                    else:
+                        self.stats["events_batched"] += len(batch)
+                        await self.websocket.send_json({"type": "batch", "events": batch})
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # The receive loop of this connection cleans it up
+            self.stats["send_errors"] += 1
+
+class ConnectionHub:
+    """Registry of WebSocket connections grouped by space"""
+
+    def __init__(self, stats: Optional[Counter] = None):
+        self.spaces: Dict[int, Dict[int, Connection]] = {}
+        self.stats = stats if stats is not None else Counter()
+
+    def connect(self, space_id: int, user_id: int, websocket: WebSocket) -> Connection:
+        """Register a user's connection, replacing any previous one"""
+        connections = self.spaces.setdefault(space_id, {})
+        if user_id in connections:
+            connections[user_id].close()
+        connection = Connection(websocket, self.stats)
+        connections[user_id] = connection
+        return connection
+
+    def disconnect(self, space_id: int, user_id: int, websocket: Optional[WebSocket] = None):
+        """Unregister a user's connection.
+
+        If `websocket` is given, only that exact connection is removed, so a
+        stale socket closing late cannot drop the user's newer connection.
+        """
+        connections = self.spaces.get(space_id, {})
+        connection = connections.get(user_id)
+        if connection and (websocket is None or connection.websocket is websocket):
+            connection.close()
+            del connections[user_id]
+        if not connections:
+            self.spaces.pop(space_id, None)
+
+    def get(self, space_id: int, user_id: int) -> Optional[WebSocket]:
+        """Return a user's WebSocket in a space, if any"""
+        connection = self.spaces.get(space_id, {}).get(user_id)
+        return connection.websocket if connection else None
+
+    def queue_depth(self) -> int:
+        """Total number of queued outbound messages"""
+        return sum(len(c) for connections in self.spaces.values() for c in connections.values())
+
+    def queue_depths(self) -> Dict[int, float]:
+        """Mean number of queued outbound messages per connection, by space"""
+        return {space_id: sum(len(c) for c in connections.values()) / len(connections)
+                for space_id, connections in self.spaces.items() if connections}
+
+    def broadcast(self, space_id: int, event: dict, exclude: Optional[int] = None):
+        """Queue an event for every connection in a space"""
+        for user_id, connection in self.spaces.get(space_id, {}).items():
+            if user_id != exclude:
+                connection.send(event)
+
+    def broadcast_position(self, space_id: int, user_id: int, position: dict):
+        """Queue a user's latest position for everyone else in the space"""
+        event = {"type": "position", "user_id": user_id, "position": position}
+        for other_id, connection in self.spaces.get(space_id, {}).items():
+            if other_id != user_id:
+                connection.send_position(user_id, event)
@@ -0,0 +1,129 @@
+from startup import PROCESS_START
+from typing import List, Optional
+import argparse
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import time
+
+import uvicorn
+
+# Kitaverse production launcher
+#
+# Starts the backend with the server settings from server.json (override with
+# KITAVERSE_SERVER_CONFIG or --config) instead of uvicorn's defaults:
+#
+#   python app/backend/launcher.py
+#
+# All state of a space lives in one process, so "workers" is not passed on to
+# uvicorn, whose workers would each hold a different copy of every space.
+# With more than one worker the launcher instead splits the spaces across
+# worker processes and runs router.py in front of them, as in sharded mode.
+# Workers listen on the ports after the configured one.
+
+logger = logging.getLogger("kitaverse")
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_CONFIG = os.environ.get("KITAVERSE_SERVER_CONFIG", os.path.join(BACKEND_DIR, "server.json"))
+
+# Settings handled by the launcher rather than passed to uvicorn.Config
+LAUNCHER_SETTINGS = {"host", "port", "workers"}
+
+# Optional speedups, and what to use when they are not installed
+OPTIONAL_IMPLEMENTATIONS = {
+    "loop": {"uvloop": ("uvloop", "asyncio")},
+    "http": {"httptools": ("httptools", "h11")},
+}
+
+def load_server_config(path: str = SERVER_CONFIG) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+def resolve_implementation(setting: str, value: str) -> str:
+    """Fall back to the pure Python loop or parser if a requested one is missing"""
+    module, fallback = OPTIONAL_IMPLEMENTATIONS[setting].get(value, (None, None))
+    if module and importlib.util.find_spec(module) is None:
+        logger.warning("%s=%s requested but %s is not installed, using %s",
+                       setting, value, module, fallback)
+        return fallback
+    return value
+
+def uvicorn_options(config: dict) -> dict:
+    """Config entries uvicorn understands, with loop and http resolved"""
+    supported = inspect.signature(uvicorn.Config).parameters
+    options = {}
+    for key, value in config.items():
+        if key in LAUNCHER_SETTINGS:
+            continue
+        if key not in supported:
+            logger.warning("Ignoring server setting %r, not supported by uvicorn %s",
+                           key, uvicorn.__version__)
+            continue
+        if key in OPTIONAL_IMPLEMENTATIONS:
+            value = resolve_implementation(key, value)
+        options[key] = value
+    return options
+
+def shard_layout(space_ids: List[int], workers: int, host: str, port: int) -> dict:
+    """Spread spaces round-robin over `workers` processes, in the format of shards.json"""
+    workers = max(1, min(workers, len(space_ids)))
+    layout = {"router": {"host": host, "port": port},
+              "workers": [{"port": port + 1 + i, "spaces": []} for i in range(workers)]}
+    for i, space_id in enumerate(sorted(space_ids)):
+        layout["workers"][i % workers]["spaces"].append(space_id)
+    return layout
+
+def run_single(config: dict, options: dict, spaces: Optional[str]):
+    import_started = time.perf_counter()
+    import main
+    main.startup_report.record("import", time.perf_counter() - import_started)
+    main.startup_report.record("launcher", import_started - PROCESS_START)
+
+    if spaces:
+        main.host_spaces({int(space_id) for space_id in spaces.split(",")})
+
+    server = uvicorn.Server(uvicorn.Config(
+        main.app, host=config["host"], port=config["port"],
+        ws_per_message_deflate=main.WS_DEFLATE, **options))
+    server.run()
+
+def run_sharded(config: dict, options: dict, config_path: str):
+    import main
+    import router
+
+    layout = shard_layout([space.id for space in main.spaces], config["workers"],
+                          config["host"], config["port"])
+    router.configure(layout)
+    router.start_workers(config_path)
+    try:
+        server = uvicorn.Server(uvicorn.Config(
+            router.app, host=config["host"], port=config["port"],
+            ws_per_message_deflate=main.WS_DEFLATE, **options))
+        server.run()
+    finally:
+        router.stop_workers()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kitaverse production launcher")
+    parser.add_argument("--config", default=SERVER_CONFIG, help="Server settings (JSON)")
+    parser.add_argument("--host", help="Overrides the configured host")
+    parser.add_argument("--port", type=int, help="Overrides the configured port")
+    parser.add_argument("--workers", type=int, help="Overrides the configured worker count")
+    parser.add_argument("--spaces", default="",
+                        help="Comma-separated space ids hosted by this worker (default: all)")
+    args = parser.parse_args()
+
+    config = {"host": "0.0.0.0", "port": 8000, "workers": 1, **load_server_config(args.config)}
+    for key in ("host", "port", "workers"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    logging.basicConfig(level=config.get("log_level", "info").upper())
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    options = uvicorn_options(config)
+    if config["workers"] > 1 and not args.spaces:
+        run_sharded(config, options, args.config)
+    else:
+        run_single(config, options, args.spaces)
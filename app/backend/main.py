@@ -1,9 +1,38 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from collections import Counter
+from typing import Dict, List, Optional
 import uvicorn
+import argparse
+import asyncio
+import hashlib
+import httpx
 import json
+import logging
+import math
+import os
+import re
+import time
+
+from admission import AdmissionController
+from compression import CompressionMiddleware
+from assets import IMMUTABLE, REVALIDATE, serve_file, stat_etag
+from concurrency import BlockingPool, LoopBlockDetector, SpaceLocks
+from definitions import (BACKEND_DIR, DEFAULT_SPACES_FILE, OVERFLOW_ID_STRIDE, DefinitionWatcher,
+                         load_space_definitions)
+from hub import ConnectionHub
+from occupancy import RESOLUTIONS, OccupancyRecorder
+from messaging import MAX_CHAT_LENGTH, SCOPE_NEARBY, SCOPE_SPACE, MessageFanout
+from presence import TimerWheel
+from ratelimit import RateLimiter, TokenBucket
+from recording import (CHAT, CONNECT, DISCONNECT, ENTER, HEARTBEAT, LEAVE, MOVE, USERS,
+                       RecordingError, SessionRecorder, append_recordings)
+from snapshots import SnapshotError, encode_snapshot, read_snapshot, write_snapshot
+from startup import StartupReport
+
+logger = logging.getLogger("kitaverse")
 
 app = FastAPI(title="Kitaverse Backend")
 
@@ -16,6 +45,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# JSON responses of at least COMPRESSION_MIN_SIZE bytes are compressed for
+# clients that accept it; WebSocket messages use per-message deflate. Below
+# ~150 bytes gzip output is larger than its input (see bench_compression.py)
+COMPRESSION_MIN_SIZE = int(os.environ.get("KITAVERSE_COMPRESSION_MIN_SIZE", "256"))
+GZIP_LEVEL = int(os.environ.get("KITAVERSE_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("KITAVERSE_BROTLI_QUALITY", "4"))
+WS_DEFLATE = os.environ.get("KITAVERSE_WS_DEFLATE", "1") != "0"
+
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    gzip_level=GZIP_LEVEL,
+    brotli_quality=BROTLI_QUALITY,
+)
+
 # Data models
 class Space(BaseModel):
     id: int
@@ -24,44 +68,514 @@ class Space(BaseModel):
     description: str
     capacity: int = 50
     current_users: int = 0
+    parent_id: Optional[int] = None  # Set on overflow instances
+
+# Snapshots and recordings store user ids as int64 and names with a length
+MAX_USER_ID = 2 ** 63 - 1
+MAX_NAME_LENGTH = 64
 
 class User(BaseModel):
-    id: int
-    name: str
+    id: int = Field(..., ge=-MAX_USER_ID - 1, le=MAX_USER_ID)
+    name: str = Field(..., max_length=MAX_NAME_LENGTH)
     position: dict = {"x": 0, "y": 0, "z": 0}
     space_id: Optional[int] = None
 
+def parse_position(value) -> Optional[dict]:
+    """A client position as finite x, y, z floats, or None if it is not one.
+
+    Positions are broadcast, snapshotted and recorded, so anything else is
+    rejected before it is stored. Missing coordinates count as 0.
+    """
+    if not isinstance(value, dict):
+        return None
+    position = {}
+    for axis in ("x", "y", "z"):
+        coordinate = value.get(axis, 0)
+        if isinstance(coordinate, bool) or not isinstance(coordinate, (int, float)) \
+                or not math.isfinite(coordinate):
+            return None
+        position[axis] = float(coordinate)
+    return position
+
+# Space definitions live in a JSON file shared with the clients and are
+# reloaded while the server runs whenever the file changes
+SPACES_FILE = os.environ.get("KITAVERSE_SPACES_FILE", DEFAULT_SPACES_FILE)
+SPACES_WATCH_INTERVAL = 2.0
+
+# Live state is snapshotted every SNAPSHOT_INTERVAL seconds and restored on
+# startup when KITAVERSE_SNAPSHOT_FILE is set
+SNAPSHOT_FILE = os.environ.get("KITAVERSE_SNAPSHOT_FILE")
+SNAPSHOT_INTERVAL = 5.0
+
+# Differential client updates published by package.py
+UPDATES_DIR = os.environ.get("KITAVERSE_UPDATES_DIR",
+                             os.path.join(BACKEND_DIR, "..", "..", "dist", "updates"))
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Content-addressed asset bundle built by package.py
+ASSETS_DIR = os.environ.get("KITAVERSE_ASSETS_DIR",
+                            os.path.join(BACKEND_DIR, "..", "..", "dist", "kitaverse", "assets"))
+
 # In-memory storage (in production, use a database)
-spaces = [
-    Space(
-        id=1,
-        name="Community Center",
-        type="meeting",
-        description="A place for village meetings and discussions",
-        capacity=30
-    ),
-    Space(
-        id=2,
-        name="Village Market",
-        type="market",
-        description="Buy and sell goods with other villagers",
-        capacity=100
-    ),
-    Space(
-        id=3,
-        name="Festival Grounds",
-        type="festival",
-        description="Celebrate festivals and cultural events",
-        capacity=200
+spaces = [Space(**definition) for definition in load_space_definitions(SPACES_FILE)]
+
+users: Dict[int, User] = {}
+
+# Space ids hosted by this process (None hosts every defined space)
+hosted_space_ids: Optional[set] = None
+space_watcher = DefinitionWatcher(SPACES_FILE)
+
+# Phase timings and readiness, reported by /health/ready
+startup_report = StartupReport()
+
+# Spaces defined when the router assigned spaces to workers, and spaces added
+# to the definitions since, which no worker hosts until the router restarts
+sharded_space_ids: set = set()
+unassigned_space_ids: set = set()
+
+def worker_snapshot_path(path: str, space_ids: set) -> str:
+    """Snapshot file of the worker hosting `space_ids`, e.g. state.spaces-1-3.snapshot"""
+    root, ext = os.path.splitext(path)
+    name = "-".join(str(space_id) for space_id in sorted(space_ids))
+    if len(name) > 64:
+        name = hashlib.sha256(name.encode()).hexdigest()[:16]
+    return f"{root}.spaces-{name}{ext}"
+
+def host_spaces(space_ids: set):
+    """Only host the given spaces, as a worker behind router.py"""
+    global hosted_space_ids, SNAPSHOT_FILE
+    hosted_space_ids = set(space_ids)
+    sharded_space_ids.update(s.id for s in spaces)
+    spaces[:] = [s for s in spaces if s.id in hosted_space_ids]
+    # Workers share the configured path; each keeps its own spaces' users
+    if SNAPSHOT_FILE:
+        SNAPSHOT_FILE = worker_snapshot_path(SNAPSHOT_FILE, hosted_space_ids)
+
+# Users that stop sending heartbeats (REST or WebSocket) are removed from
+# their space after PRESENCE_TIMEOUT seconds
+PRESENCE_TIMEOUT = float(os.environ.get("KITAVERSE_PRESENCE_TIMEOUT", "30"))
+PRESENCE_TICK = 1.0
+
+# Per-client limits: REST calls per client address, messages per WebSocket
+REST_RATE = float(os.environ.get("KITAVERSE_REST_RATE", "5"))
+REST_BURST = float(os.environ.get("KITAVERSE_REST_BURST", "20"))
+WS_RATE = float(os.environ.get("KITAVERSE_WS_RATE", "20"))
+WS_BURST = float(os.environ.get("KITAVERSE_WS_BURST", "40"))
+
+presence = TimerWheel(timeout=PRESENCE_TIMEOUT, tick=PRESENCE_TICK)
+backpressure = Counter()
+hub = ConnectionHub(stats=backpressure)
+rest_limiter = RateLimiter(rate=REST_RATE, burst=REST_BURST)
+
+# Disk I/O runs in a thread pool instead of on the event loop, and code that
+# blocks the loop for longer than LOOP_BLOCK_THRESHOLD is logged with its stack
+BLOCKING_WORKERS = int(os.environ.get("KITAVERSE_BLOCKING_WORKERS", "4"))
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("KITAVERSE_LOOP_BLOCK_MS", "100")) / 1000
+
+blocking = BlockingPool(max_workers=BLOCKING_WORKERS)
+loop_monitor = LoopBlockDetector(threshold=LOOP_BLOCK_THRESHOLD)
+space_locks = SpaceLocks()
+
+# Occupancy history per space; overflow instances count towards their parent.
+# Joins and leaves are recorded as they happen, occupancy is sampled every
+# OCCUPANCY_SAMPLE_INTERVAL seconds
+OCCUPANCY_SAMPLE_INTERVAL = 10.0
+occupancy = OccupancyRecorder()
+
+# Inbound operations are logged per space for replay.py when
+# KITAVERSE_RECORD_DIR is set; KITAVERSE_RECORD_SPACES limits which spaces
+RECORD_DIR = os.environ.get("KITAVERSE_RECORD_DIR")
+RECORD_SPACES = os.environ.get("KITAVERSE_RECORD_SPACES")
+RECORD_FLUSH_INTERVAL = 1.0
+recorder = SessionRecorder(
+    RECORD_DIR,
+    space_ids={int(space_id) for space_id in RECORD_SPACES.split(",")} if RECORD_SPACES else None,
+    key=lambda space_id: space_id % OVERFLOW_ID_STRIDE
+)
+
+# Chat messages are delivered in batches every CHAT_TICK seconds
+CHAT_TICK = 0.1
+
+# Effective space capacities follow server load, re-evaluated every
+# ADMISSION_INTERVAL seconds; see admission.py and GET /stats/admission
+ADMISSION_INTERVAL = 1.0
+ADMISSION_LAG_TARGET = float(os.environ.get("KITAVERSE_ADMISSION_LAG_MS", "50")) / 1000
+ADMISSION_TICK_TARGET = float(os.environ.get("KITAVERSE_ADMISSION_TICK_MS", "50")) / 1000
+ADMISSION_QUEUE_TARGET = float(os.environ.get("KITAVERSE_ADMISSION_QUEUE", "32"))
+ADMISSION_MIN_SHARE = float(os.environ.get("KITAVERSE_ADMISSION_MIN_SHARE", "0.25"))
+ADMISSION_MAX_BOOST = float(os.environ.get("KITAVERSE_ADMISSION_MAX_BOOST", "1.0"))
+admission = AdmissionController(
+    lag_target=ADMISSION_LAG_TARGET,
+    overrun_target=ADMISSION_TICK_TARGET,
+    queue_target=ADMISSION_QUEUE_TARGET,
+    min_share=ADMISSION_MIN_SHARE,
+    max_boost=ADMISSION_MAX_BOOST
+)
+
+def get_user_position(user_id: int) -> Optional[dict]:
+    user = users.get(user_id)
+    return user.position if user else None
+
+fanout = MessageFanout(hub, get_user_position)
+
+# Addresses whose X-Forwarded-For names the real client: router.py on this machine
+TRUSTED_PROXIES = {"127.0.0.1", "::1"}
+
+def client_address(request: Request) -> str:
+    """The address a request came from, looking through the router"""
+    host = request.client.host if request.client else "unknown"
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded and host in TRUSTED_PROXIES:
+        # The router sets the header itself; the last entry is the address it saw
+        return forwarded.split(",")[-1].strip()
+    return host
+
+async def rate_limit(request: Request):
+    """Reject REST clients that exceed their token bucket"""
+    key = client_address(request)
+    bucket = rest_limiter.bucket(key)
+    if not bucket.allow():
+        backpressure["rest_rejected"] += 1
+        raise HTTPException(status_code=429, detail="Too many requests",
+                            headers={"Retry-After": str(math.ceil(bucket.retry_after()))})
+
+# Overflow instances of a full space get ids parent_id + n * OVERFLOW_ID_STRIDE
+MAX_OVERFLOW_INSTANCES = 4
+
+def lock_keys(*space_ids: Optional[int]) -> List[int]:
+    """Lock keys of spaces; overflow instances share their parent's lock,
+    since entering a full space may create them"""
+    return [space_id % OVERFLOW_ID_STRIDE for space_id in space_ids if space_id is not None]
+
+def find_space(space_id: int) -> Optional[Space]:
+    """Return the space with the given id, or None"""
+    for space in spaces:
+        if space.id == space_id:
+            return space
+    return None
+
+def get_overflow_space(space: Space) -> Optional[Space]:
+    """Return an overflow instance of a full space with room left.
+
+    A new instance (e.g. "Village Market #2") is created when every existing
+    one is full, up to MAX_OVERFLOW_INSTANCES per space. `space` may itself be
+    an overflow instance; instances are always created for the original space.
+    """
+    root = find_space(space.id % OVERFLOW_ID_STRIDE) or space
+    instances = [s for s in spaces if s.id == root.id or s.parent_id == root.id]
+    for instance in instances:
+        if instance.id != space.id and \
+                instance.current_users < admission.capacity(instance.id, instance.capacity):
+            return instance
+
+    # More instances mean more work for a server that is already behind
+    if admission.overloaded:
+        return None
+
+    taken = {s.id for s in spaces}
+    for n in range(1, MAX_OVERFLOW_INSTANCES + 1):
+        if root.id + n * OVERFLOW_ID_STRIDE not in taken:
+            return create_overflow_space(root, n)
+    return None
+
+def create_overflow_space(space: Space, n: int) -> Space:
+    """Create the n-th overflow instance of a space"""
+    overflow = Space(
+        id=space.id + n * OVERFLOW_ID_STRIDE,
+        name=f"{space.name} #{n + 1}",
+        type=space.type,
+        description=space.description,
+        capacity=space.capacity,
+        parent_id=space.id
     )
-]
+    spaces.append(overflow)
+    return overflow
+
+def remove_user_from_space(user: User, space: Space):
+    """Take a user out of a space and stop tracking their presence"""
+    user.space_id = None
+    space.current_users -= 1
+    presence.discard(user.id)
+    occupancy.leave(space.id % OVERFLOW_ID_STRIDE)
+    
+    # Drop overflow instances once the last user has left
+    if space.parent_id is not None and space.current_users == 0:
+        spaces.remove(space)
+
+def close_space(space: Space, reason: str):
+    """Remove a space, sending everyone inside it a leave event"""
+    for user in users.values():
+        if user.space_id == space.id:
+            user.space_id = None
+            presence.discard(user.id)
+            occupancy.leave(space.id % OVERFLOW_ID_STRIDE)
+            hub.broadcast(space.id, {"type": "leave", "user_id": user.id, "reason": reason})
+    spaces.remove(space)
+
+def apply_space_definitions(definitions: List[dict]) -> dict:
+    """Bring the live spaces in line with a new set of definitions.
+
+    Changed spaces are updated in place so the people inside stay; removed
+    spaces (and their overflow instances) are closed.
+    """
+    if hosted_space_ids is not None:
+        # Spaces are assigned to workers at startup, so a space added now is
+        # not hosted anywhere; say so once instead of dropping it silently
+        for definition in definitions:
+            space_id = definition["id"]
+            if space_id not in sharded_space_ids and space_id not in unassigned_space_ids:
+                unassigned_space_ids.add(space_id)
+                logger.warning("Space %d was added to the definitions but is not hosted: "
+                               "restart the router to assign it to a worker", space_id)
+        definitions = [d for d in definitions if d["id"] in hosted_space_ids]
+    changes = {"added": [], "updated": [], "removed": []}
+    defined = {d["id"]: d for d in definitions}
+    
+    for space in [s for s in spaces if s.parent_id is None]:
+        definition = defined.get(space.id)
+        if definition is None:
+            for instance in [s for s in spaces if s.id == space.id or s.parent_id == space.id]:
+                close_space(instance, "closed")
+            changes["removed"].append(space.id)
+            continue
+        
+        updated = Space(**definition)
+        if any(getattr(space, field) != getattr(updated, field) for field in definition):
+            for instance in [s for s in spaces if s.id == space.id or s.parent_id == space.id]:
+                instance.type = updated.type
+                instance.description = updated.description
+                instance.capacity = updated.capacity
+                n = (instance.id - space.id) // OVERFLOW_ID_STRIDE
+                instance.name = f"{updated.name} #{n + 1}" if n else updated.name
+            changes["updated"].append(space.id)
+    
+    known = {s.id for s in spaces}
+    for space_id, definition in defined.items():
+        if space_id not in known:
+            spaces.append(Space(**definition))
+            changes["added"].append(space_id)
+    
+    spaces.sort(key=lambda s: s.id)
+    return changes
 
-users = []
+async def reload_space_definitions() -> dict:
+    """Re-read the definitions file and apply it"""
+    definitions = await blocking.run(load_space_definitions, SPACES_FILE)
+    async with space_locks.hold(*lock_keys(*(s.id for s in spaces))):
+        changes = apply_space_definitions(definitions)
+    if any(changes.values()):
+        logger.info("Reloaded space definitions: %s", changes)
+    return changes
+
+def take_snapshot() -> bytes:
+    """Encode the memberships and positions of everyone inside a space"""
+    return encode_snapshot((user.id, user.name, user.space_id, user.position)
+                           for user in users.values() if user.space_id is not None)
+
+def restore_snapshot(path: str) -> int:
+    """Put users back into their spaces from a snapshot; returns the count"""
+    taken_at, records = read_snapshot(path)
+    if time.time() - taken_at > PRESENCE_TIMEOUT:
+        return 0  # Everyone in it would have timed out by now
+    
+    restored = 0
+    for user_id, name, space_id, position in records:
+        space = find_space(space_id)
+        if not space and space_id > OVERFLOW_ID_STRIDE:
+            parent = find_space(space_id % OVERFLOW_ID_STRIDE)
+            if parent:
+                space = create_overflow_space(parent, space_id // OVERFLOW_ID_STRIDE)
+        if not space or user_id in users:
+            continue
+        users[user_id] = User(id=user_id, name=name[:MAX_NAME_LENGTH], position=position, space_id=space.id)
+        space.current_users += 1
+        # Restored users get a full timeout to reconnect
+        presence.touch(user_id)
+        restored += 1
+    return restored
+
+async def save_snapshot():
+    """Write a snapshot without blocking the event loop on disk I/O"""
+    data = take_snapshot()
+    await blocking.run(write_snapshot, SNAPSHOT_FILE, data)
+
+async def snapshot_periodically():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_snapshot()
+        except Exception:
+            # Keep snapshotting; one failed snapshot must not end the task
+            logger.exception("Could not write snapshot")
+
+async def watch_space_definitions():
+    """Apply edits to the definitions file while the server runs"""
+    while True:
+        await asyncio.sleep(SPACES_WATCH_INTERVAL)
+        if not await blocking.run(space_watcher.changed):
+            continue
+        try:
+            await reload_space_definitions()
+        except (OSError, ValueError, KeyError) as e:
+            # Keep serving the previous definitions until the file is fixed
+            logger.warning("Ignoring invalid space definitions: %s", e)
+
+async def reap_idle_users():
+    """Remove users whose heartbeats stopped, e.g. phones that lost signal"""
+    while True:
+        await asyncio.sleep(PRESENCE_TICK)
+        for user_id in presence.advance():
+            user = users.get(user_id)
+            if not user or user.space_id is None:
+                continue
+            space_id = user.space_id
+            async with space_locks.hold(*lock_keys(space_id)):
+                space = find_space(space_id)
+                if not space or user.space_id != space_id:
+                    continue
+                remove_user_from_space(user, space)
+                hub.broadcast(space_id, {"type": "leave", "user_id": user_id, "reason": "timeout"})
+            websocket = hub.get(space_id, user_id)
+            if websocket:
+                hub.disconnect(space_id, user_id)
+                await websocket.close(code=4408)
+
+def occupancy_counts() -> Counter:
+    """Current users per space, overflow instances included"""
+    counts = Counter()
+    for space in spaces:
+        counts[space.id % OVERFLOW_ID_STRIDE] += space.current_users
+    return counts
+
+async def sample_occupancy():
+    while True:
+        occupancy.sample(occupancy_counts().items())
+        await asyncio.sleep(OCCUPANCY_SAMPLE_INTERVAL)
+
+async def flush_recordings():
+    """Append recorded operations to the space logs"""
+    pending = recorder.take()
+    if pending:
+        await blocking.run(append_recordings, pending, recorder.checked)
+
+async def flush_recordings_periodically():
+    while True:
+        await asyncio.sleep(RECORD_FLUSH_INTERVAL)
+        try:
+            await flush_recordings()
+        except (OSError, RecordingError) as e:
+            logger.warning("Could not write recording: %s", e)
+
+async def deliver_messages():
+    """Flush queued chat messages once per tick"""
+    while True:
+        deadline = time.monotonic() + CHAT_TICK
+        await asyncio.sleep(CHAT_TICK)
+        fanout.flush()
+        admission.observe_tick(time.monotonic() - deadline)
+
+def space_loads():
+    """Load of every space, as the admission controller sees it"""
+    queue_depths = hub.queue_depths()
+    return [(space.id, space.capacity, space.current_users, queue_depths.get(space.id, 0.0))
+            for space in spaces]
+
+async def adjust_capacity():
+    while True:
+        await asyncio.sleep(ADMISSION_INTERVAL)
+        for decision in admission.update(loop_monitor.take_peak_lag(), space_loads()):
+            logger.info("Space %d admits %d instead of %d (%s, pressure %.2f)", decision["space_id"],
+                        decision["to"], decision["from"], decision["reason"], decision["pressure"])
+
+async def prewarm():
+    """Build everything the first requests would otherwise pay for.
+
+    Uvicorn only starts accepting connections once startup has finished, so
+    the first users after a deploy do not wait for thread creation, occupancy
+    buffers, cold manifest files or first-call code paths.
+    """
+    with startup_report.phase("blocking_pool"):
+        # Threads are started lazily; start them all now
+        await asyncio.gather(*(blocking.run(time.sleep, 0.01) for _ in range(BLOCKING_WORKERS)))
+    
+    with startup_report.phase("occupancy"):
+        for space in spaces:
+            occupancy.series(space.id % OVERFLOW_ID_STRIDE)
+    
+    with startup_report.phase("manifests"):
+        for path in (os.path.join(UPDATES_DIR, "manifest.json"), os.path.join(ASSETS_DIR, "manifest.json")):
+            if os.path.exists(path):
+                try:
+                    await blocking.run(load_json_file, path)
+                except (OSError, ValueError) as e:
+                    logger.warning("Manifest %s is unreadable: %s", path, e)
+    
+    with startup_report.phase("first_requests"), recorder.suspend():
+        # Exercise the read-only endpoints in-process, compression included
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://prewarm",
+                                     headers={"Accept-Encoding": "br, gzip"}) as client:
+            await client.get("/spaces")
+            for space in list(spaces):
+                await client.get(f"/spaces/{space.id}")
+                await client.get(f"/spaces/{space.id}/users")
+                await client.get(f"/spaces/{space.id}/occupancy")
+
+def load_json_file(path: str):
+    with open(path, "r") as f:
+        return json.load(f)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if SNAPSHOT_FILE and os.path.exists(SNAPSHOT_FILE):
+        with startup_report.phase("snapshot"):
+            try:
+                restored = restore_snapshot(SNAPSHOT_FILE)
+                logger.info("Restored %d users from snapshot", restored)
+            except (OSError, SnapshotError) as e:
+                logger.warning("Could not restore snapshot: %s", e)
+    
+    await prewarm()
+    startup_report.mark_ready()
+    
+    loop_monitor.start()
+    asyncio.create_task(reap_idle_users())
+    asyncio.create_task(deliver_messages())
+    asyncio.create_task(adjust_capacity())
+    asyncio.create_task(sample_occupancy())
+    asyncio.create_task(watch_space_definitions())
+    if SNAPSHOT_FILE:
+        asyncio.create_task(snapshot_periodically())
+    if recorder.enabled:
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        asyncio.create_task(flush_recordings_periodically())
+
+@app.on_event("shutdown")
+async def save_final_snapshot():
+    startup_report.mark_draining()
+    loop_monitor.stop()
+    if SNAPSHOT_FILE:
+        await save_snapshot()
+    if recorder.enabled:
+        await flush_recordings()
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to Kitaverse Backend", "version": "1.0.0"}
 
+@app.get("/health/live")
+async def liveness():
+    """The process is up and its event loop is responding"""
+    return {"status": "alive", "loop_lag_ms": round(loop_monitor.last_lag * 1000, 1)}
+
+@app.get("/health/ready")
+async def readiness():
+    """200 once startup and pre-warming are done, 503 while starting or draining"""
+    report = startup_report.as_dict()
+    if not startup_report.ready:
+        return JSONResponse(report, status_code=503)
+    return report
+
 @app.get("/spaces")
 async def get_spaces():
     """Return available virtual public spaces"""
@@ -70,84 +584,282 @@ async def get_spaces():
 @app.get("/spaces/{space_id}")
 async def get_space(space_id: int):
     """Return details about a specific space"""
-    for space in spaces:
-        if space.id == space_id:
-            return space
+    space = find_space(space_id)
+    if space:
+        return space
     raise HTTPException(status_code=404, detail="Space not found")
 
-@app.post("/spaces/{space_id}/enter")
+@app.post("/spaces/{space_id}/enter", dependencies=[Depends(rate_limit)])
 async def enter_space(space_id: int, user: User):
     """Allow a user to enter a space"""
+    position = parse_position(user.position)
+    if position is None:
+        raise HTTPException(status_code=422, detail="Position must have numeric x, y and z")
+    user.position = position
+    recorder.record(ENTER, space_id, user.id, name=user.name, position=user.position)
+    # Lock the target space and the one the user is moving out of, retrying
+    # if the user moved to yet another space while we waited
+    while True:
+        previous_id = users[user.id].space_id if user.id in users else None
+        async with space_locks.hold(*lock_keys(space_id, previous_id)):
+            if (users[user.id].space_id if user.id in users else None) == previous_id:
+                return admit_user(space_id, user)
+
+def admit_user(space_id: int, user: User) -> dict:
+    """Place a user in a space or one of its overflow instances"""
     # Check if space exists
-    space = None
-    for s in spaces:
-        if s.id == space_id:
-            space = s
-            break
+    space = find_space(space_id)
     
     if not space:
         raise HTTPException(status_code=404, detail="Space not found")
     
-    # Check if space is full
-    if space.current_users >= space.capacity:
-        raise HTTPException(status_code=400, detail="Space is full")
-    
-    # Add user to space
-    user.space_id = space_id
-    space.current_users += 1
+    # Redirect to an overflow instance if the space is full
+    already_inside = user.id in users and users[user.id].space_id == space_id
+    capacity = admission.capacity(space.id, space.capacity)
+    if space.current_users >= capacity and not already_inside:
+        if capacity < space.capacity:
+            # Lowered under load: shed the entry instead of adding an instance
+            admission.rejected[space.id] += 1
+            raise HTTPException(status_code=503, detail="Space is busy, please try again shortly",
+                                headers={"Retry-After": str(math.ceil(ADMISSION_INTERVAL * 5))})
+        space = get_overflow_space(space)
+        if not space:
+            raise HTTPException(status_code=400, detail="Space is full")
+        space_id = space.id
     
     # Add user to users list if not already there
-    existing_user = next((u for u in users if u.id == user.id), None)
+    existing_user = users.get(user.id)
     if not existing_user:
-        users.append(user)
+        users[user.id] = user
     else:
-        existing_user.space_id = space_id
+        # Moving between spaces frees the seat in the previous one
+        previous_space = find_space(existing_user.space_id)
+        if previous_space and previous_space.id != space_id:
+            remove_user_from_space(existing_user, previous_space)
+            hub.broadcast(previous_space.id, {"type": "leave", "user_id": user.id, "reason": "moved"})
         existing_user.position = user.position
+        user = existing_user
+    
+    # Add user to space
+    if user.space_id != space_id:
+        user.space_id = space_id
+        space.current_users += 1
+        occupancy.join(space_id % OVERFLOW_ID_STRIDE)
+        hub.broadcast(space_id, {"type": "enter", "user_id": user.id, "name": user.name,
+                                 "position": user.position}, exclude=user.id)
+    presence.touch(user.id)
     
     return {"message": f"User {user.name} entered {space.name}", "space": space}
 
-@app.post("/spaces/{space_id}/leave")
+@app.post("/spaces/{space_id}/leave", dependencies=[Depends(rate_limit)])
 async def leave_space(space_id: int, user_id: int):
     """Allow a user to leave a space"""
+    recorder.record(LEAVE, space_id, user_id)
     # Find the space
-    space = None
-    for s in spaces:
-        if s.id == space_id:
-            space = s
-            break
+    space = find_space(space_id)
     
     if not space:
         raise HTTPException(status_code=404, detail="Space not found")
     
     # Find the user
-    user = None
-    for u in users:
-        if u.id == user_id:
-            user = u
-            break
+    user = users.get(user_id)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
     # Remove user from space
-    if user.space_id == space_id:
-        user.space_id = None
-        space.current_users -= 1
-        return {"message": f"User {user.name} left {space.name}", "space": space}
-    else:
-        raise HTTPException(status_code=400, detail="User is not in this space")
+    async with space_locks.hold(*lock_keys(space_id)):
+        if user.space_id == space_id:
+            remove_user_from_space(user, space)
+            hub.broadcast(space_id, {"type": "leave", "user_id": user_id, "reason": "left"})
+            return {"message": f"User {user.name} left {space.name}", "space": space}
+    raise HTTPException(status_code=400, detail="User is not in this space")
 
 @app.get("/spaces/{space_id}/users")
 async def get_space_users(space_id: int):
     """Get all users in a specific space"""
+    recorder.record(USERS, space_id, 0)
     # Check if space exists
-    space_exists = any(s.id == space_id for s in spaces)
-    if not space_exists:
+    if not find_space(space_id):
         raise HTTPException(status_code=404, detail="Space not found")
     
     # Get users in this space
-    space_users = [u for u in users if u.space_id == space_id]
+    space_users = [u for u in users.values() if u.space_id == space_id]
     return {"users": space_users}
 
+@app.get("/spaces/{space_id}/occupancy")
+async def get_space_occupancy(space_id: int, resolution: str = "hour",
+                              since: Optional[float] = None, until: Optional[float] = None):
+    """Occupancy history of a space in minute or hour buckets.
+
+    `since` and `until` are Unix timestamps; by default the last 24 buckets
+    are returned. Overflow instances are counted with their parent space.
+    """
+    if not find_space(space_id):
+        raise HTTPException(status_code=404, detail="Space not found")
+    if resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Resolution must be one of {sorted(RESOLUTIONS)}")
+    
+    key = space_id % OVERFLOW_ID_STRIDE
+    return {
+        "space_id": key,
+        "resolution": resolution,
+        "current_users": occupancy_counts()[key],
+        "buckets": occupancy.query(key, resolution, since, until)
+    }
+
+@app.post("/spaces/{space_id}/heartbeat", dependencies=[Depends(rate_limit)])
+async def heartbeat(space_id: int, user_id: int):
+    """Keep a user's place in a space alive"""
+    recorder.record(HEARTBEAT, space_id, user_id)
+    user = users.get(user_id)
+    if not user or user.space_id != space_id:
+        raise HTTPException(status_code=404, detail="User is not in this space")
+    
+    presence.touch(user_id)
+    return {"status": "ok", "timeout": PRESENCE_TIMEOUT}
+
+@app.websocket("/spaces/{space_id}/ws")
+async def space_socket(websocket: WebSocket, space_id: int, user_id: int):
+    """Real-time connection to a space; every message counts as a heartbeat.
+
+    Clients send JSON messages: {"type": "heartbeat"},
+    {"type": "move", "position": {"x": ..., "y": ..., "z": ...}} or
+    {"type": "chat", "text": ..., "scope": "nearby" | "space"}.
+    Several server events may arrive as one {"type": "batch", "events": [...]}.
+    """
+    user = users.get(user_id)
+    if not user or user.space_id != space_id:
+        await websocket.close(code=4404)
+        return
+    
+    await websocket.accept()
+    hub.connect(space_id, user_id, websocket)
+    recorder.record(CONNECT, space_id, user_id)
+    presence.touch(user_id)
+    bucket = TokenBucket(rate=WS_RATE, burst=WS_BURST)
+    try:
+        while True:
+            text = await websocket.receive_text()
+            if user.space_id != space_id:
+                break  # Moved elsewhere, timed out or the space was closed
+            presence.touch(user_id)
+            if not bucket.allow():
+                backpressure["ws_messages_dropped"] += 1
+                continue
+            
+            try:
+                message = json.loads(text)
+            except ValueError:
+                continue
+            if not isinstance(message, dict):
+                continue
+            if message.get("type") == "move":
+                position = parse_position(message.get("position"))
+                if position is None:
+                    continue
+                recorder.record(MOVE, space_id, user_id, position=position)
+                async with space_locks.hold(*lock_keys(space_id)):
+                    if user.space_id == space_id:
+                        user.position = position
+                        hub.broadcast_position(space_id, user_id, user.position)
+            elif message.get("type") == "heartbeat":
+                recorder.record(HEARTBEAT, space_id, user_id)
+            elif message.get("type") == "chat" and isinstance(message.get("text"), str):
+                recorder.record(CHAT, space_id, user_id, text=message["text"][:MAX_CHAT_LENGTH],
+                                scope=message.get("scope"))
+                scope = SCOPE_SPACE if message.get("scope") == SCOPE_SPACE else SCOPE_NEARBY
+                fanout.post(space_id, user_id, {
+                    "type": "chat",
+                    "user_id": user_id,
+                    "name": user.name,
+                    "text": message["text"][:MAX_CHAT_LENGTH],
+                    "scope": scope
+                }, scope)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Presence expiry, not the socket closing, decides when the user leaves
+        hub.disconnect(space_id, user_id, websocket)
+        recorder.record(DISCONNECT, space_id, user_id)
+
+@app.post("/admin/reload-spaces")
+async def reload_spaces():
+    """Apply the space definitions file right away"""
+    try:
+        return {"changes": await reload_space_definitions()}
+    except (OSError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid space definitions: {e}")
+
+@app.get("/updates/manifest")
+async def get_update_manifest(request: Request):
+    """Latest published version: files with their content and chunk hashes"""
+    path = os.path.join(UPDATES_DIR, "manifest.json")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No update published")
+    return await blocking.run(serve_file, request, path, stat_etag(path), REVALIDATE, "application/json")
+
+@app.get("/updates/chunks/{chunk_hash}")
+async def get_update_chunk(chunk_hash: str, request: Request):
+    """A chunk by content hash; chunks never change, so they cache forever"""
+    if not HASH_PATTERN.match(chunk_hash):
+        raise HTTPException(status_code=400, detail="Invalid chunk hash")
+    path = os.path.join(UPDATES_DIR, "chunks", chunk_hash[:2], chunk_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    return await blocking.run(serve_file, request, path, chunk_hash, IMMUTABLE)
+
+@app.get("/assets/manifest")
+async def get_asset_manifest(request: Request):
+    """Asset bundle manifest: per tier, logical paths mapped to object hashes"""
+    path = os.path.join(ASSETS_DIR, "manifest.json")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No asset bundle built")
+    return await blocking.run(serve_file, request, path, stat_etag(path), REVALIDATE, "application/json")
+
+@app.get("/assets/objects/{object_hash}")
+async def get_asset_object(object_hash: str, request: Request):
+    """An asset by content hash, with byte ranges for resumable downloads"""
+    if not HASH_PATTERN.match(object_hash):
+        raise HTTPException(status_code=400, detail="Invalid asset hash")
+    path = os.path.join(ASSETS_DIR, "objects", object_hash[:2], object_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return await blocking.run(serve_file, request, path, object_hash, IMMUTABLE)
+
+@app.get("/stats/backpressure")
+async def get_backpressure_stats():
+    """Report how often rate limits and send queue limits kicked in"""
+    return {"counters": dict(backpressure), "queued_messages": hub.queue_depth()}
+
+@app.get("/stats/admission")
+async def get_admission_stats():
+    """Load signals, effective capacities and recent admission decisions"""
+    report = admission.report()
+    report["spaces"] = [{
+        "id": space.id,
+        "nominal": space.capacity,
+        "effective": admission.capacity(space.id, space.capacity),
+        "current_users": space.current_users,
+        "rejected": admission.rejected[space.id]
+    } for space in spaces]
+    return report
+
+@app.get("/stats/loop")
+async def get_loop_stats():
+    """Report how often and how long the event loop was blocked"""
+    return loop_monitor.stats()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Kitaverse backend server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--spaces", default="",
+                        help="Comma-separated space ids hosted by this worker (default: all)")
+    args = parser.parse_args()
+    
+    # When run as a worker behind router.py, only host the assigned spaces
+    if args.spaces:
+        host_spaces({int(space_id) for space_id in args.spaces.split(",")})
+    
+    uvicorn.run(app, host=args.host, port=args.port, ws_per_message_deflate=WS_DEFLATE)
@@ -0,0 +1,90 @@
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Kitaverse chat and event fan-out
+#
+# Messages posted during a tick are collected per space and delivered together
+# on the next flush. Nearby messages only reach users within CHAT_RADIUS of the
+# sender, found through a uniform grid built once per space per flush, so each
+# message looks at a handful of cells instead of every user. Delivery goes
+# through the hub's per-connection queues, which write everything queued for a
+# recipient during the tick as a single frame.
+
+CHAT_RADIUS = 15.0
+MAX_CHAT_LENGTH = 500
+
+SCOPE_NEARBY = "nearby"  # Users within CHAT_RADIUS of the sender
+SCOPE_SPACE = "space"  # Announcements to the whole space
+
+Position = Tuple[float, float]
+
+class SpatialGrid:
+    """Uniform grid of user positions on the ground (x, y) plane"""
+
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], List[Tuple[int, float, float]]] = defaultdict(list)
+
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def add(self, user_id: int, x: float, y: float):
+        self.cells[self._cell(x, y)].append((user_id, x, y))
+
+    def within(self, x: float, y: float, radius: float) -> Iterable[int]:
+        """Yield the users within `radius` of (x, y)"""
+        reach = int(radius // self.cell_size) + 1
+        cx, cy = self._cell(x, y)
+        radius_squared = radius * radius
+        for gx in range(cx - reach, cx + reach + 1):
+            for gy in range(cy - reach, cy + reach + 1):
+                for user_id, ux, uy in self.cells.get((gx, gy), ()):
+                    if (ux - x) ** 2 + (uy - y) ** 2 <= radius_squared:
+                        yield user_id
+
+def ground_position(position: Optional[dict]) -> Position:
+    """Return the (x, y) of a user's position dict"""
+    position = position or {}
+    try:
+        return float(position.get("x", 0)), float(position.get("y", 0))
+    except (TypeError, ValueError):
+        return 0.0, 0.0
+
+class MessageFanout:
+    """Collects messages per space and delivers them once per tick"""
+
+    def __init__(self, hub, position_of: Callable[[int], Optional[dict]], radius: float = CHAT_RADIUS):
+        self.hub = hub
+        self.position_of = position_of
+        self.radius = radius
+        self.pending: Dict[int, List[Tuple[int, str, dict]]] = defaultdict(list)
+
+    def post(self, space_id: int, sender_id: int, event: dict, scope: str = SCOPE_NEARBY):
+        """Queue an event from a user for delivery on the next flush"""
+        self.pending[space_id].append((sender_id, scope, event))
+
+    def flush(self) -> int:
+        """Deliver all pending messages; returns the number of deliveries"""
+        pending, self.pending = self.pending, defaultdict(list)
+        deliveries = 0
+        for space_id, messages in pending.items():
+            connections = self.hub.spaces.get(space_id)
+            if not connections:
+                continue
+
+            grid = None
+            if any(scope == SCOPE_NEARBY for _, scope, _ in messages):
+                grid = SpatialGrid(self.radius)
+                for user_id in connections:
+                    grid.add(user_id, *ground_position(self.position_of(user_id)))
+
+            for sender_id, scope, event in messages:
+                if scope == SCOPE_SPACE:
+                    recipients = connections.keys()
+                else:
+                    recipients = grid.within(*ground_position(self.position_of(sender_id)), self.radius)
+                for user_id in recipients:
+                    if user_id != sender_id:
+                        connections[user_id].send(event)
+                        deliveries += 1
+        return deliveries
@@ -0,0 +1,125 @@
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import time
+
+# Kitaverse occupancy history
+#
+# Records how many people are in each space over time, for organizers ("how
+# busy is the market by hour") and capacity planning. Each space has a ring
+# buffer of fixed-size time buckets per resolution, stored in flat arrays, so
+# memory is bounded and recording a join or leave is a couple of array writes.
+# The occupancy itself is sampled periodically by a background task rather
+# than on the enter path.
+
+RESOLUTIONS = {"minute": 60, "hour": 3600}
+# Buckets kept per resolution: one day of minutes, 30 days of hours
+RETENTION = {"minute": 24 * 60, "hour": 30 * 24}
+
+class RingSeries:
+    """Consecutive time buckets in a ring; the oldest bucket is reused"""
+
+    def __init__(self, resolution: float, slots: int):
+        self.resolution = resolution
+        self.slots = slots
+        self.index = array("q", [-1]) * slots  # Bucket number held by each slot
+        self.joins = array("l", [0]) * slots
+        self.leaves = array("l", [0]) * slots
+        self.peak = array("l", [0]) * slots
+        self.samples = array("l", [0]) * slots
+        self.total = array("q", [0]) * slots  # Sum of sampled occupancies
+
+    def _slot(self, now: float, occupancy: int) -> int:
+        index = int(now // self.resolution)
+        slot = index % self.slots
+        if self.index[slot] != index:
+            self.index[slot] = index
+            self.joins[slot] = self.leaves[slot] = self.samples[slot] = self.total[slot] = 0
+            self.peak[slot] = occupancy
+        return slot
+
+    def join(self, now: float, occupancy: int):
+        slot = self._slot(now, occupancy)
+        self.joins[slot] += 1
+        if occupancy > self.peak[slot]:
+            self.peak[slot] = occupancy
+
+    def leave(self, now: float, occupancy: int):
+        self.leaves[self._slot(now, occupancy)] += 1
+
+    def sample(self, now: float, occupancy: int):
+        slot = self._slot(now, occupancy)
+        self.samples[slot] += 1
+        self.total[slot] += occupancy
+        if occupancy > self.peak[slot]:
+            self.peak[slot] = occupancy
+
+    def buckets(self, since: float, until: float) -> List[dict]:
+        """Recorded buckets overlapping [since, until], oldest first"""
+        last = int(until // self.resolution)
+        first = max(int(since // self.resolution), last - self.slots + 1, 0)
+        result = []
+        for index in range(first, last + 1):
+            slot = index % self.slots
+            if self.index[slot] != index:
+                continue  # Nothing recorded, e.g. the server was down
+            samples = self.samples[slot]
+            result.append({
+                "start": index * self.resolution,
+                "joins": self.joins[slot],
+                "leaves": self.leaves[slot],
+                "peak": self.peak[slot],
+                "average": round(self.total[slot] / samples, 2) if samples else None
+            })
+        return result
+
+class OccupancyRecorder:
+    """Occupancy time series for every space"""
+
+    def __init__(self, resolutions: Dict[str, float] = RESOLUTIONS,
+                 retention: Dict[str, int] = RETENTION,
+                 clock: Callable[[], float] = time.time):
+        self.resolutions = resolutions
+        self.retention = retention
+        self.clock = clock
+        self.occupancy: Dict[int, int] = {}
+        self._series: Dict[int, Dict[str, RingSeries]] = {}
+
+    def series(self, key: int) -> Dict[str, RingSeries]:
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {name: RingSeries(resolution, self.retention[name])
+                                          for name, resolution in self.resolutions.items()}
+        return series
+
+    def join(self, key: int):
+        occupancy = self.occupancy[key] = self.occupancy.get(key, 0) + 1
+        now = self.clock()
+        for ring in self.series(key).values():
+            ring.join(now, occupancy)
+
+    def leave(self, key: int):
+        occupancy = self.occupancy[key] = max(0, self.occupancy.get(key, 0) - 1)
+        now = self.clock()
+        for ring in self.series(key).values():
+            ring.leave(now, occupancy)
+
+    def sample(self, counts: Iterable[Tuple[int, int]]):
+        """Record the actual occupancy of every space.
+
+        Spaces that were recorded before but are missing from `counts` are
+        sampled as empty.
+        """
+        counts = dict(counts)
+        now = self.clock()
+        for key in set(counts) | set(self._series):
+            occupancy = self.occupancy[key] = counts.get(key, 0)
+            for ring in self.series(key).values():
+                ring.sample(now, occupancy)
+
+    def query(self, key: int, resolution: str, since: Optional[float] = None,
+              until: Optional[float] = None) -> List[dict]:
+        """Buckets of one resolution; by default the most recent 24"""
+        ring = self.series(key)[resolution]
+        until = self.clock() if until is None else until
+        since = until - 23 * ring.resolution if since is None else since
+        return ring.buckets(since, until)
@@ -0,0 +1,70 @@
+from typing import Callable, Dict, Hashable, List, Set
+import math
+import time
+
+# Kitaverse presence tracking
+#
+# Users keep their place in a space by sending heartbeats. Deadlines are kept
+# in a hashed timer wheel, so a heartbeat is a single dict write and each tick
+# only visits the sessions whose slot came due instead of every user.
+
+class TimerWheel:
+    """Expire keys that have not been touched within `timeout` seconds"""
+
+    def __init__(self, timeout: float, tick: float = 1.0, slots: int = 64,
+                 clock: Callable[[], float] = time.monotonic):
+        self.timeout = timeout
+        self.tick = tick
+        self.clock = clock
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._slot_of: Dict[Hashable, int] = {}
+        self._deadlines: Dict[Hashable, float] = {}
+        self._current_tick = int(clock() / tick)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def touch(self, key: Hashable):
+        """Push the key's deadline `timeout` seconds into the future"""
+        self._deadlines[key] = self.clock() + self.timeout
+        if key not in self._slot_of:
+            self._schedule(key)
+        # Otherwise the key is re-slotted lazily when its old slot comes due
+
+    def discard(self, key: Hashable):
+        """Stop tracking a key"""
+        self._deadlines.pop(key, None)
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            self._slots[slot].discard(key)
+
+    def advance(self) -> List[Hashable]:
+        """Move the wheel up to the current time and return expired keys"""
+        now = self.clock()
+        now_tick = int(now / self.tick)
+        expired = []
+        # One lap visits every slot, so never walk more than that
+        first_tick = max(self._current_tick + 1, now_tick - len(self._slots) + 1)
+        self._current_tick = now_tick
+        for tick_number in range(first_tick, now_tick + 1):
+            slot = tick_number % len(self._slots)
+            due, self._slots[slot] = self._slots[slot], set()
+            for key in due:
+                del self._slot_of[key]
+                if self._deadlines[key] <= now:
+                    del self._deadlines[key]
+                    expired.append(key)
+                else:
+                    self._schedule(key)
+        return expired
+
+    def _schedule(self, key: Hashable):
+        tick_number = max(math.ceil(self._deadlines[key] / self.tick), self._current_tick + 1)
+        # Deadlines beyond one lap land early and get re-slotted when visited
+        tick_number = min(tick_number, self._current_tick + len(self._slots))
+        slot = tick_number % len(self._slots)
+        self._slots[slot].add(key)
+        self._slot_of[key] = slot
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from typing import Callable, Hashable
+import time
+
+# Kitaverse rate limiting
+#
+# Token buckets: each client may burst up to `burst` requests, refilled at
+# `rate` tokens per second. Used per WebSocket connection and per REST client.
+
+class TokenBucket:
+    """A single token bucket"""
+
+    def __init__(self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def allow(self, cost: float = 1.0) -> bool:
+        """Take `cost` tokens if available"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def retry_after(self, cost: float = 1.0) -> float:
+        """Seconds until `cost` tokens will be available"""
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+class RateLimiter:
+    """Token buckets keyed by client, keeping at most `max_clients` buckets.
+
+    The least recently seen client is forgotten first; a forgotten client
+    simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.clock = clock
+        self.buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def bucket(self, key: Hashable) -> TokenBucket:
+        """Return the bucket for a client, creating it if needed"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self.clock)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        """Take `cost` tokens from a client's bucket if available"""
+        return self.bucket(key).allow(cost)
@@ -0,0 +1,215 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import heapq
+import os
+import struct
+import time
+
+# Kitaverse session recording
+#
+# Optionally records every inbound operation on a space (entering, leaving,
+# heartbeats, user list requests, WebSocket connects, moves and chat) to an
+# append-only binary log per space, so a real festival can be replayed
+# against a new build with replay.py. Operations are buffered in memory and
+# appended by a background task, off the event loop. Overflow instances are
+# recorded in their parent space's log. Layout (little-endian):
+#
+#   header:  b"KVRC", version (B), space id (I)
+#   record:  kind (B), received_at (d), space_id (q), user_id (q),
+#            payload length (H), payload
+#
+#   payloads:  enter  x, y, z (fff), name (utf-8)
+#              move   x, y, z (fff)
+#              chat   scope (B, 1 for the whole space), text (utf-8)
+#
+# A record cut short by a crash is ignored when reading, and cut off before a
+# restarted server appends to the log, so later records stay aligned.
+
+MAGIC = b"KVRC"
+VERSION = 1
+HEADER = struct.Struct("<4sBI")
+RECORD = struct.Struct("<BdqqH")
+POSITION = struct.Struct("<fff")
+MAX_PAYLOAD = 0xFFFF
+FLOAT32_MAX = 3.4028234663852886e38
+
+ENTER, LEAVE, HEARTBEAT, USERS, CONNECT, DISCONNECT, MOVE, CHAT = range(1, 9)
+KINDS = {ENTER: "enter", LEAVE: "leave", HEARTBEAT: "heartbeat", USERS: "users",
+         CONNECT: "connect", DISCONNECT: "disconnect", MOVE: "move", CHAT: "chat"}
+
+# (received_at, kind, space_id, user_id, data)
+RecordedOperation = Tuple[float, str, int, int, dict]
+
+class RecordingError(Exception):
+    """Raised when a recording file cannot be read"""
+
+def coordinate(value) -> float:
+    """A position component as sent by the client; anything unusable counts as 0.
+
+    Values beyond single precision are clamped, so the move is still recorded.
+    """
+    try:
+        return max(-FLOAT32_MAX, min(FLOAT32_MAX, float(value)))
+    except (TypeError, ValueError):
+        return 0.0
+
+def encode_text(text: str, limit: int) -> bytes:
+    """UTF-8 text of at most `limit` bytes, cut between characters"""
+    return text.encode("utf-8")[:limit].decode("utf-8", "ignore").encode("utf-8")
+
+def encode_position(position: Optional[dict]) -> bytes:
+    position = position or {}
+    return POSITION.pack(coordinate(position.get("x", 0)), coordinate(position.get("y", 0)),
+                         coordinate(position.get("z", 0)))
+
+def decode_position(payload: bytes) -> dict:
+    x, y, z = POSITION.unpack_from(payload, 0)
+    return {"x": x, "y": y, "z": z}
+
+def encode_payload(kind: int, data: dict) -> bytes:
+    if kind == ENTER:
+        return encode_position(data.get("position")) + encode_text(data["name"], MAX_PAYLOAD - POSITION.size)
+    if kind == MOVE:
+        return encode_position(data["position"])
+    if kind == CHAT:
+        return bytes([data.get("scope") == "space"]) + encode_text(data["text"], MAX_PAYLOAD - 1)
+    return b""
+
+def decode_payload(kind: int, payload: bytes) -> dict:
+    if kind == ENTER:
+        return {"position": decode_position(payload), "name": payload[POSITION.size:].decode("utf-8")}
+    if kind == MOVE:
+        return {"position": decode_position(payload)}
+    if kind == CHAT:
+        return {"scope": "space" if payload[0] else "nearby", "text": payload[1:].decode("utf-8")}
+    return {}
+
+def encode_operation(kind: int, received_at: float, space_id: int, user_id: int, data: dict) -> bytes:
+    payload = encode_payload(kind, data)
+    return RECORD.pack(kind, received_at, space_id, user_id, len(payload)) + payload
+
+def decode_recording(data: bytes) -> List[RecordedOperation]:
+    """Parse a recording, ignoring a truncated last record"""
+    try:
+        magic, version, _ = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise RecordingError("Recording has no header")
+    if magic != MAGIC or version != VERSION:
+        raise RecordingError("Not a Kitaverse recording")
+    offset = HEADER.size
+    operations = []
+    while offset + RECORD.size <= len(data):
+        kind, received_at, space_id, user_id, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        if kind not in KINDS:
+            raise RecordingError(f"Unknown operation {kind} at byte {offset - RECORD.size}")
+        try:
+            operation_data = decode_payload(kind, data[offset:offset + length])
+        except (struct.error, IndexError, UnicodeDecodeError) as e:
+            raise RecordingError(f"Corrupt operation at byte {offset - RECORD.size}: {e}")
+        operations.append((received_at, KINDS[kind], space_id, user_id, operation_data))
+        offset += length
+    return operations
+
+def read_recording(path: str) -> List[RecordedOperation]:
+    with open(path, "rb") as f:
+        return decode_recording(f.read())
+
+def merge_recordings(paths: Iterable[str]) -> Iterator[RecordedOperation]:
+    """Operations of several space logs in the order they were received"""
+    return heapq.merge(*(read_recording(path) for path in paths), key=lambda operation: operation[0])
+
+def complete_length(f) -> int:
+    """Length of an open log up to the end of its last complete record"""
+    size = os.fstat(f.fileno()).st_size
+    f.seek(0)
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return 0
+    magic, version, _ = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise RecordingError(f"{f.name} is not a Kitaverse recording")
+    end = HEADER.size
+    while True:
+        record = f.read(RECORD.size)
+        if len(record) < RECORD.size:
+            return end
+        record_end = end + RECORD.size + RECORD.unpack(record)[4]
+        if record_end > size:
+            return end
+        end = record_end
+        f.seek(end)
+
+def append_recordings(pending: Dict[str, Tuple[int, bytes]], checked: Optional[set] = None):
+    """Append buffered records to their logs, starting new logs with a header.
+
+    Before the first append to a log, a record left incomplete by a crash is
+    cut off. Logs listed in `checked` have been through that already.
+    """
+    for path, (space_id, data) in pending.items():
+        with open(path, "a+b") as f:
+            if checked is None or path not in checked:
+                f.truncate(complete_length(f))
+                if checked is not None:
+                    checked.add(path)
+            if f.seek(0, os.SEEK_END) == 0:
+                f.write(HEADER.pack(MAGIC, VERSION, space_id))
+            f.write(data)
+
+class SessionRecorder:
+    """Buffers inbound operations per space until they are appended to disk.
+
+    With no directory, recording is off and `record` returns right away.
+    `key` maps a space id to the log it belongs in.
+    """
+
+    def __init__(self, directory: Optional[str], space_ids: Optional[set] = None,
+                 key: Callable[[int], int] = lambda space_id: space_id,
+                 clock: Callable[[], float] = time.time):
+        self.directory = directory
+        self.space_ids = space_ids
+        self.key = key
+        self.clock = clock
+        self.buffers: Dict[int, bytearray] = {}
+        self.checked: set = set()  # Logs append_recordings has checked for a torn tail
+        self.recorded = 0
+        self.suspended = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def path(self, key: int) -> str:
+        return os.path.join(self.directory, f"space-{key}.kvrec")
+
+    @contextmanager
+    def suspend(self):
+        """Do not record operations that did not come from clients"""
+        self.suspended = True
+        try:
+            yield
+        finally:
+            self.suspended = False
+
+    def record(self, kind: int, space_id: int, user_id: int, **data):
+        if self.directory is None or self.suspended:
+            return
+        key = self.key(space_id)
+        if self.space_ids is not None and key not in self.space_ids:
+            return
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = bytearray()
+        try:
+            buffer += encode_operation(kind, self.clock(), space_id, user_id, data)
+        except struct.error:
+            return  # An id no client could have been given
+        self.recorded += 1
+
+    def take(self) -> Dict[str, Tuple[int, bytes]]:
+        """Hand over the buffered records, for append_recordings"""
+        pending = {self.path(key): (key, bytes(buffer)) for key, buffer in self.buffers.items() if buffer}
+        self.buffers.clear()
+        return pending
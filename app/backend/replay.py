@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import statistics
+import time
+from collections import Counter, defaultdict
+
+import httpx
+import websockets
+
+from recording import RecordedOperation, merge_recordings
+
+# Kitaverse session replay
+#
+# Feeds operations recorded with KITAVERSE_RECORD_DIR back into a server, at
+# the recorded pace or faster, and reports request latencies and how far the
+# replay fell behind schedule. Replaying the same recording against two
+# builds gives a like-for-like comparison on a real workload:
+#
+#   python app/backend/replay.py recordings/ --speed 4 --output after.json
+#
+# Replay against a fresh server with the same space definitions, so overflow
+# instances get the same ids as during the recording. All replayed users
+# share one client address and accelerated replay sends faster than real
+# clients, so raise KITAVERSE_REST_RATE and KITAVERSE_WS_RATE on the server.
+
+DEFAULT_SERVER_URL = "http://127.0.0.1:8000"
+
+def recording_paths(sources) -> list:
+    """Recording files, expanding directories to the logs inside"""
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(sorted(glob.glob(os.path.join(source, "*.kvrec"))))
+        else:
+            paths.append(source)
+    return paths
+
+def percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2)
+    return {
+        "count": len(samples),
+        "mean": round(statistics.mean(samples) * 1000, 2),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": round(samples[-1] * 1000, 2)
+    }
+
+class ReplayStats:
+    """What the replay sent, how the server answered and how late we were"""
+
+    def __init__(self):
+        self.operations = Counter()
+        self.statuses = defaultdict(Counter)
+        self.latencies = defaultdict(list)
+        self.skipped = Counter()
+        self.schedule_lag = []
+        self.frames_received = 0
+        self.bytes_received = 0
+
+    def summary(self, duration: float, recorded_duration: float) -> dict:
+        return {
+            "operations": dict(self.operations),
+            "recorded_duration_s": round(recorded_duration, 2),
+            "duration_s": round(duration, 2),
+            "latency_ms": {kind: percentiles(samples) for kind, samples in self.latencies.items()},
+            "statuses": {kind: dict(statuses) for kind, statuses in self.statuses.items()},
+            "skipped": dict(self.skipped),
+            "schedule_lag_ms": percentiles(self.schedule_lag) if self.schedule_lag else None,
+            "frames_received": self.frames_received,
+            "bytes_received": self.bytes_received
+        }
+
+class Replayer:
+    """Sends recorded operations as the recorded users did.
+
+    Operations of one user are applied in order; different users, and REST
+    requests in general, run concurrently, so a slow response does not hold
+    up the rest of the session.
+    """
+
+    def __init__(self, http: httpx.AsyncClient, server: str, stats: ReplayStats):
+        self.http = http
+        self.server = server.replace("https://", "wss://").replace("http://", "ws://")
+        self.stats = stats
+        self.connections = {}  # user_id -> (space_id, websocket, receiver)
+        self.pending = {}  # user_id -> task of the user's last operation
+        self.requests = set()
+
+    def submit(self, operation: RecordedOperation):
+        _, kind, _, user_id, _ = operation
+        self.stats.operations[kind] += 1
+        if kind == "users":
+            task = asyncio.ensure_future(self.apply(operation))
+            self.requests.add(task)
+            task.add_done_callback(self.requests.discard)
+            return
+        self.pending[user_id] = asyncio.ensure_future(self.after(self.pending.get(user_id), operation))
+
+    async def after(self, previous, operation: RecordedOperation):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await self.apply(operation)
+
+    async def request(self, kind: str, method: str, path: str, **kwargs):
+        started = time.monotonic()
+        try:
+            response = await self.http.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.stats.statuses[kind]["error"] += 1
+            return
+        self.stats.latencies[kind].append(time.monotonic() - started)
+        self.stats.statuses[kind][response.status_code] += 1
+
+    async def apply(self, operation: RecordedOperation):
+        _, kind, space_id, user_id, data = operation
+        if kind == "enter":
+            await self.request(kind, "POST", f"/spaces/{space_id}/enter",
+                               json={"id": user_id, "name": data["name"], "position": data["position"]})
+        elif kind == "leave":
+            await self.request(kind, "POST", f"/spaces/{space_id}/leave", params={"user_id": user_id})
+        elif kind == "users":
+            await self.request(kind, "GET", f"/spaces/{space_id}/users")
+        elif kind == "connect":
+            await self.connect(space_id, user_id)
+        elif kind == "disconnect":
+            connection = self.connections.get(user_id)
+            if connection and connection[0] == space_id:
+                await self.disconnect(user_id)
+        else:
+            await self.send(kind, space_id, user_id, data)
+
+    async def send(self, kind: str, space_id: int, user_id: int, data: dict):
+        """Send a heartbeat, move or chat over the user's WebSocket"""
+        connection = self.connections.get(user_id)
+        if not connection or connection[0] != space_id:
+            if kind == "heartbeat":
+                await self.request(kind, "POST", f"/spaces/{space_id}/heartbeat", params={"user_id": user_id})
+            else:
+                self.stats.skipped[kind] += 1
+            return
+        try:
+            await connection[1].send(json.dumps({"type": kind, **data}))
+        except websockets.exceptions.WebSocketException:
+            self.stats.skipped[kind] += 1
+
+    async def connect(self, space_id: int, user_id: int):
+        await self.disconnect(user_id)
+        started = time.monotonic()
+        try:
+            websocket = await websockets.connect(f"{self.server}/spaces/{space_id}/ws?user_id={user_id}",
+                                                 max_queue=None)
+        except (OSError, websockets.exceptions.WebSocketException):
+            self.stats.statuses["connect"]["error"] += 1
+            return
+        self.stats.latencies["connect"].append(time.monotonic() - started)
+        self.stats.statuses["connect"][101] += 1
+        receiver = asyncio.ensure_future(self.receive(websocket))
+        self.connections[user_id] = (space_id, websocket, receiver)
+
+    async def receive(self, websocket):
+        try:
+            async for frame in websocket:
+                self.stats.frames_received += 1
+                self.stats.bytes_received += len(frame)
+        except websockets.exceptions.WebSocketException:
+            pass
+
+    async def disconnect(self, user_id: int):
+        connection = self.connections.pop(user_id, None)
+        if connection:
+            _, websocket, receiver = connection
+            await websocket.close()
+            receiver.cancel()
+
+    async def finish(self):
+        await asyncio.gather(*self.pending.values(), *self.requests, return_exceptions=True)
+        for user_id in list(self.connections):
+            await self.disconnect(user_id)
+
+async def replay(operations, server: str = DEFAULT_SERVER_URL, speed: float = 1.0,
+                 max_gap: float = 10.0, http_connections: int = 100) -> dict:
+    """Replay operations; `speed` 0 sends them as fast as possible.
+
+    Pauses longer than `max_gap` recorded seconds, e.g. while the recorded
+    server was down, are shortened to `max_gap`.
+    """
+    stats = ReplayStats()
+    limits = httpx.Limits(max_connections=http_connections)
+    async with httpx.AsyncClient(base_url=server, limits=limits, timeout=30.0) as http:
+        replayer = Replayer(http, server, stats)
+        started = time.monotonic()
+        scheduled = 0.0
+        recorded = 0.0
+        previous_at = None
+        for operation in operations:
+            received_at = operation[0]
+            if previous_at is not None:
+                gap = min(max(received_at - previous_at, 0.0), max_gap)
+                recorded += gap
+                if speed > 0:
+                    scheduled += gap / speed
+            previous_at = received_at
+            if speed > 0:
+                delay = started + scheduled - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    stats.schedule_lag.append(-delay)
+            replayer.submit(operation)
+            await asyncio.sleep(0)  # Let the submitted operation start
+        await replayer.finish()
+    return stats.summary(time.monotonic() - started, recorded)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Kitaverse sessions against a server")
+    parser.add_argument("recordings", nargs="+", help="Recording files, or directories of them")
+    parser.add_argument("--server", default=DEFAULT_SERVER_URL)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed; 1 is the recorded pace, 0 as fast as possible")
+    parser.add_argument("--max-gap", type=float, default=10.0,
+                        help="Longest pause in recorded seconds; longer ones are shortened")
+    parser.add_argument("--http-connections", type=int, default=100)
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    operations = merge_recordings(recording_paths(args.recordings))
+    report = asyncio.run(replay(operations, args.server, args.speed, args.max_gap, args.http_connections))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Dict, List, Optional
+import asyncio
+import itertools
+import logging
+import subprocess
+import sys
+import os
+import json
+import time
+import httpx
+import uvicorn
+import websockets
+
+from compression import CompressionMiddleware
+from main import (BROTLI_QUALITY, COMPRESSION_MIN_SIZE, GZIP_LEVEL, OVERFLOW_ID_STRIDE,
+                  WS_DEFLATE)
+
+logger = logging.getLogger("kitaverse")
+
+# Kitaverse space router
+#
+# Runs each group of spaces from shards.json in its own backend worker process
+# (python launcher.py --port <port> --spaces <ids>) so a busy space cannot
+# starve the others, and forwards REST and WebSocket traffic to the right
+# worker by space_id. Assets and updates are served by any worker, while
+# statistics and definition reloads go to every worker. The router only
+# reports ready once every worker does.
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARDS_FILE = os.environ.get("KITAVERSE_SHARDS", os.path.join(BACKEND_DIR, "shards.json"))
+# Seconds to wait for the workers to pre-warm before serving anyway
+WORKER_READY_TIMEOUT = float(os.environ.get("KITAVERSE_WORKER_READY_TIMEOUT", "60"))
+
+# Headers that only make sense for a single hop
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length"
+}
+
+def load_shards(path: str = SHARDS_FILE) -> dict:
+    """Load the shard map from a JSON file"""
+    with open(path, "r") as f:
+        return json.load(f)
+
+def build_routing_table(shards: dict) -> Dict[int, str]:
+    """Map each configured space id to the base URL of its worker"""
+    table = {}
+    for worker in shards["workers"]:
+        base_url = f"http://127.0.0.1:{worker['port']}"
+        for space_id in worker["spaces"]:
+            table[space_id] = base_url
+    return table
+
+def worker_for(space_id: int, table: Dict[int, str]) -> str:
+    """Return the worker URL for a space, including its overflow instances"""
+    base_url = table.get(space_id) or table.get(space_id % OVERFLOW_ID_STRIDE)
+    if not base_url:
+        raise HTTPException(status_code=404, detail="Space not found")
+    return base_url
+
+shards = load_shards()
+routing_table = build_routing_table(shards)
+worker_urls: List[str] = sorted(set(routing_table.values()))
+worker_processes: List[subprocess.Popen] = []
+http_client: httpx.AsyncClient = None
+# Spreads asset and update downloads over the workers
+file_requests = itertools.count()
+
+def configure(layout: dict):
+    """Use a shard layout other than shards.json, e.g. from launcher.py"""
+    global shards, routing_table, worker_urls
+    shards = layout
+    routing_table = build_routing_table(shards)
+    worker_urls = sorted(set(routing_table.values()))
+
+app = FastAPI(title="Kitaverse Router")
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # In production, specify exact origins
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    gzip_level=GZIP_LEVEL,
+    brotli_quality=BROTLI_QUALITY,
+)
+
+def start_workers(server_config: Optional[str] = None):
+    """Spawn one backend process per shard"""
+    for worker in shards["workers"]:
+        command = [
+            sys.executable, os.path.join(BACKEND_DIR, "launcher.py"),
+            "--host", "127.0.0.1",
+            "--port", str(worker["port"]),
+            "--workers", "1",
+            "--spaces", ",".join(str(space_id) for space_id in worker["spaces"])
+        ]
+        if server_config:
+            command += ["--config", server_config]
+        worker_processes.append(subprocess.Popen(command, cwd=BACKEND_DIR))
+
+def stop_workers():
+    """Terminate all worker processes"""
+    for process in worker_processes:
+        process.terminate()
+    for process in worker_processes:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    worker_processes.clear()
+
+async def workers_ready() -> Dict[str, int]:
+    """Readiness status code of each worker, 0 if unreachable"""
+    responses = await asyncio.gather(
+        *(http_client.get(f"{url}/health/ready") for url in worker_urls),
+        return_exceptions=True
+    )
+    return {url: 0 if isinstance(response, Exception) else response.status_code
+            for url, response in zip(worker_urls, responses)}
+
+@app.on_event("startup")
+async def on_startup():
+    global http_client
+    http_client = httpx.AsyncClient(timeout=10.0)
+
+    # Do not accept traffic before the workers can serve it
+    deadline = time.monotonic() + WORKER_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        statuses = await workers_ready()
+        if all(status == 200 for status in statuses.values()):
+            return
+        await asyncio.sleep(0.25)
+    logger.warning("Workers not ready after %.0f s: %s", WORKER_READY_TIMEOUT, statuses)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await http_client.aclose()
+
+@app.get("/")
+async def root():
+    return {"message": "Welcome to Kitaverse Router", "workers": worker_urls}
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    """200 once every worker is ready"""
+    statuses = await workers_ready()
+    ready = all(status == 200 for status in statuses.values())
+    body = {"status": "ready" if ready else "starting", "workers": statuses}
+    return body if ready else JSONResponse(body, status_code=503)
+
+@app.get("/spaces")
+async def get_spaces():
+    """Return the spaces of every worker, merged"""
+    responses = await asyncio.gather(
+        *(http_client.get(f"{url}/spaces") for url in worker_urls),
+        return_exceptions=True
+    )
+    merged = []
+    for response in responses:
+        if isinstance(response, Exception) or response.status_code != 200:
+            continue  # An unavailable worker only hides its own spaces
+        merged.extend(response.json()["spaces"])
+    merged.sort(key=lambda space: space["id"])
+    return {"spaces": merged}
+
+async def proxy(base_url: str, request: Request) -> Response:
+    """Forward a REST request to a worker and stream its reply back"""
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "x-forwarded-for"}
+    # Workers see every request coming from the router; pass on who sent it.
+    # A client's own X-Forwarded-For is dropped so it cannot pick its rate limit bucket.
+    headers["X-Forwarded-For"] = request.client.host if request.client else "unknown"
+    try:
+        upstream = http_client.build_request(
+            request.method,
+            f"{base_url}{request.url.path}",
+            params=request.query_params,
+            content=await request.body(),
+            headers=headers
+        )
+        response = await http_client.send(upstream, stream=True)
+    except httpx.HTTPError:
+        raise HTTPException(status_code=503, detail="Worker unavailable")
+    # Pass the body on as the worker encoded it (e.g. already compressed)
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers={k: v for k, v in response.headers.items()
+                 if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() not in ("date", "server")},
+        background=BackgroundTask(response.aclose)
+    )
+
+async def fan_out(method: str, path: str) -> Dict[str, dict]:
+    """Send a request to every worker; returns status and body per worker"""
+    responses = await asyncio.gather(
+        *(http_client.request(method, f"{url}{path}") for url in worker_urls),
+        return_exceptions=True
+    )
+    results = {}
+    for url, response in zip(worker_urls, responses):
+        if isinstance(response, Exception):
+            results[url] = {"status": 503, "body": None}
+        else:
+            try:
+                body = response.json()
+            except ValueError:
+                body = None
+            results[url] = {"status": response.status_code, "body": body}
+    return results
+
+@app.api_route("/spaces/{space_id}", methods=["GET", "POST", "PUT", "DELETE"])
+@app.api_route("/spaces/{space_id}/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def forward(space_id: int, request: Request, path: str = ""):
+    """Forward a REST request to the worker hosting the space"""
+    return await proxy(worker_for(space_id, routing_table), request)
+
+@app.get("/assets/{path:path}")
+@app.get("/updates/{path:path}")
+async def forward_files(request: Request, path: str):
+    """Serve assets and updates from any worker; they all read the same files"""
+    if not worker_urls:
+        raise HTTPException(status_code=503, detail="Worker unavailable")
+    return await proxy(worker_urls[next(file_requests) % len(worker_urls)], request)
+
+@app.get("/stats/{name}")
+async def get_worker_stats(name: str):
+    """Statistics of every worker, by worker URL"""
+    results = await fan_out("GET", f"/stats/{name}")
+    if all(result["status"] == 404 for result in results.values()):
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"workers": {url: result["body"] for url, result in results.items()}}
+
+@app.post("/admin/reload-spaces")
+async def reload_spaces():
+    """Have every worker apply the space definitions file.
+
+    Spaces added to the file are not hosted until the router restarts.
+    """
+    results = await fan_out("POST", "/admin/reload-spaces")
+    status = max(result["status"] for result in results.values()) if results else 200
+    return JSONResponse({"workers": results}, status_code=status)
+
+@app.websocket("/spaces/{space_id}/{path:path}")
+async def forward_websocket(websocket: WebSocket, space_id: int, path: str):
+    """Relay a WebSocket connection to the worker hosting the space"""
+    try:
+        base_url = worker_for(space_id, routing_table)
+    except HTTPException:
+        await websocket.close(code=4404)
+        return
+
+    target = base_url.replace("http://", "ws://") + websocket.url.path
+    if websocket.url.query:
+        target += "?" + websocket.url.query
+
+    await websocket.accept()
+    try:
+        async with websockets.connect(target) as upstream:
+            async def client_to_worker():
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        return
+                    text = message.get("text")
+                    await upstream.send(text if text is not None else message["bytes"])
+
+            async def worker_to_client():
+                async for message in upstream:
+                    if isinstance(message, bytes):
+                        await websocket.send_bytes(message)
+                    else:
+                        await websocket.send_text(message)
+
+            tasks = [asyncio.ensure_future(client_to_worker()),
+                     asyncio.ensure_future(worker_to_client())]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+    except (OSError, websockets.exceptions.WebSocketException):
+        pass
+    finally:
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass  # Already closed by the client
+
+if __name__ == "__main__":
+    # launcher.py with "workers" > 1 runs the router from server.json instead
+    start_workers()
+    try:
+        uvicorn.run(app, host=shards["router"]["host"], port=shards["router"]["port"],
+                    ws_per_message_deflate=WS_DEFLATE)
+    finally:
+        stop_workers()
@@ -0,0 +1,78 @@
+from typing import Iterable, List, Tuple
+import os
+import struct
+import time
+
+# Kitaverse state snapshots
+#
+# Live memberships and positions are written to a compact binary file so a
+# restarted server can put everyone back where they were before clients
+# notice. Layout (little-endian):
+#
+#   header:  b"KVSN", version (B), taken_at (d), record count (I)
+#   record:  user_id (q), space_id (q), x, y, z (ddd), name length (H), name (utf-8)
+
+MAGIC = b"KVSN"
+VERSION = 1
+HEADER = struct.Struct("<4sBdI")
+RECORD = struct.Struct("<qqdddH")
+
+# (user_id, name, space_id, position)
+SnapshotRecord = Tuple[int, str, int, dict]
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file cannot be read"""
+
+def encode_name(name: str) -> bytes:
+    """UTF-8 name cut to the length field, without splitting a character"""
+    return name.encode("utf-8")[:0xFFFF].decode("utf-8", "ignore").encode("utf-8")
+
+def encode_snapshot(records: Iterable[SnapshotRecord], taken_at: float = None) -> bytes:
+    """Serialize snapshot records, leaving out any that cannot be stored"""
+    body = []
+    count = 0
+    for user_id, name, space_id, position in records:
+        encoded_name = encode_name(name)
+        try:
+            record = RECORD.pack(user_id, space_id,
+                                 float(position.get("x", 0)),
+                                 float(position.get("y", 0)),
+                                 float(position.get("z", 0)),
+                                 len(encoded_name))
+        except (struct.error, TypeError, ValueError):
+            continue  # One bad record must not cost everyone else their place
+        body.append(record)
+        body.append(encoded_name)
+        count += 1
+    header = HEADER.pack(MAGIC, VERSION, time.time() if taken_at is None else taken_at, count)
+    return header + b"".join(body)
+
+def decode_snapshot(data: bytes) -> Tuple[float, List[SnapshotRecord]]:
+    """Parse a snapshot; returns (taken_at, records)"""
+    try:
+        magic, version, taken_at, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError("Not a Kitaverse snapshot")
+        offset = HEADER.size
+        records = []
+        for _ in range(count):
+            user_id, space_id, x, y, z, name_length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            name = data[offset:offset + name_length].decode("utf-8")
+            offset += name_length
+            records.append((user_id, name, space_id, {"x": x, "y": y, "z": z}))
+    except (struct.error, UnicodeDecodeError) as e:
+        raise SnapshotError(f"Corrupt snapshot: {e}")
+    return taken_at, records
+
+def write_snapshot(path: str, data: bytes):
+    """Atomically replace the snapshot file"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def read_snapshot(path: str) -> Tuple[float, List[SnapshotRecord]]:
+    """Read a snapshot file"""
+    with open(path, "rb") as f:
+        return decode_snapshot(f.read())
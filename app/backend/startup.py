@@ -0,0 +1,60 @@
+from contextlib import contextmanager
+from typing import Dict, Optional
+import logging
+import time
+
+# Kitaverse startup tracking
+#
+# Records how long each startup phase takes and whether the process is ready
+# for traffic, for the readiness endpoint and the cold-start log line. Times
+# are measured from the first import of this module, so the launcher, which
+# imports it before anything else, also counts importing the application.
+
+logger = logging.getLogger("kitaverse")
+
+PROCESS_START = time.perf_counter()
+
+class StartupReport:
+    """Phase timings and readiness of one server process"""
+
+    def __init__(self, started: float = PROCESS_START):
+        self.started = started
+        self.phases: Dict[str, float] = {}
+        self.ready = False
+        self.draining = False
+        self.cold_start: Optional[float] = None
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = round(seconds * 1000, 1)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a startup phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def mark_ready(self):
+        self.ready = True
+        self.cold_start = time.perf_counter() - self.started
+        logger.info("Ready for traffic %.0f ms after start (%s)", self.cold_start * 1000,
+                    ", ".join(f"{name} {ms:.0f} ms" for name, ms in self.phases.items()))
+
+    def mark_draining(self):
+        """Stop reporting ready, so load balancers move traffic elsewhere"""
+        self.ready = False
+        self.draining = True
+
+    def status(self) -> str:
+        if self.draining:
+            return "draining"
+        return "ready" if self.ready else "starting"
+
+    def as_dict(self) -> dict:
+        return {
+            "status": self.status(),
+            "cold_start_ms": round(self.cold_start * 1000, 1) if self.cold_start is not None else None,
+            "phases": dict(self.phases)
+        }
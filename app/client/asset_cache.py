@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from protocol import ACCEPT_ENCODING, read_body
+
+# Kitaverse asset streaming
+#
+# Downloads a space's models and textures from the backend asset bundle (see
+# package.py) into a size-bounded on-disk cache, so each asset is fetched once
+# per device. Objects are stored by content hash; each tier gets a directory
+# of links laid out like the paths the clients load (models/..., textures/...)
+# that can be put on Panda3D's model path. Interrupted downloads resume with
+# HTTP range requests. AssetStreamer fetches the low tier first, so a space
+# appears quickly, then the device's own tier.
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+INDEX_FILE = "index.json"
+DOWNLOAD_BLOCK = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+class AssetError(Exception):
+    """Raised when an asset cannot be downloaded or does not match its hash"""
+
+def read_prc_setting(path, name, default=None):
+    """Value of a setting in a .prc file ("name value" or "name=value")"""
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return default
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line or line.startswith("["):
+            continue
+        key, _, value = line.replace("=", " ", 1).partition(" ")
+        if key == name:
+            return value.strip()
+    return default
+
+class AssetCache:
+    """Content-addressed LRU cache of asset bundle objects"""
+
+    def __init__(self, cache_dir, server_url, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.server_url = server_url
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.manifest = None
+        self.manifest_etag = None
+        self.bytes_downloaded = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self.load_index()
+
+    def load_index(self):
+        """Cached objects by hash: size, last use and the links pointing at them"""
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # Forget objects removed behind our back
+        return {digest: entry for digest, entry in index.items()
+                if os.path.exists(self.object_path(digest))}
+
+    def save_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(path + ".tmp", path)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+    def fetch_manifest(self):
+        """Current bundle manifest, revalidated with the server's ETag.
+
+        A server without a bundle has nothing to stream: that is an empty
+        manifest, not an error.
+        """
+        headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if self.manifest_etag:
+            headers["If-None-Match"] = self.manifest_etag
+        req = urllib.request.Request(f"{self.server_url}/assets/manifest", headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT) as response:
+                self.manifest = json.loads(read_body(response)[0])
+                self.manifest_etag = response.headers.get("ETag")
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                self.manifest = {"version": 1, "tiers": {}}
+                self.manifest_etag = None
+            elif e.code != 304:
+                raise
+        return self.manifest
+
+    def download(self, digest):
+        """Download an object, resuming a partial download if there is one"""
+        path = self.object_path(digest)
+        part_path = path + ".part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-", "If-Range": f'"{digest}"'} if offset else {}
+        req = urllib.request.Request(f"{self.server_url}/assets/objects/{digest}", headers=headers)
+        try:
+            response = urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code == 416 and offset:
+                # The partial file is not a prefix of this object: start over
+                os.remove(part_path)
+                return self.download(digest)
+            raise AssetError(f"Cannot download asset {digest}: HTTP {e.code}")
+
+        with response, open(part_path, "ab" if response.status == 206 else "wb") as f:
+            for block in iter(lambda: response.read(DOWNLOAD_BLOCK), b""):
+                f.write(block)
+                self.bytes_downloaded += len(block)
+
+        digest_check = hashlib.sha256()
+        with open(part_path, "rb") as f:
+            for block in iter(lambda: f.read(DOWNLOAD_BLOCK), b""):
+                digest_check.update(block)
+        if digest_check.hexdigest() != digest:
+            os.remove(part_path)
+            raise AssetError(f"Asset {digest} is corrupt")
+        os.replace(part_path, path)
+
+    def fetch(self, digest, keep=()):
+        """Path of a cached object, downloading it if needed.
+
+        Objects in `keep` (and the fetched one) are never evicted to make room.
+        """
+        if digest not in self.index:
+            self.download(digest)
+            self.index[digest] = {"size": os.path.getsize(self.object_path(digest)), "links": []}
+        self.index[digest]["used"] = time.time()
+        self.evict(set(keep) | {digest})
+        self.save_index()
+        return self.object_path(digest)
+
+    def evict(self, keep=()):
+        """Remove least recently used objects until the cache fits its budget"""
+        total = self.total_bytes()
+        for digest in sorted(self.index, key=lambda d: self.index[d].get("used", 0)):
+            if total <= self.max_bytes:
+                break
+            if digest in keep:
+                continue
+            entry = self.index.pop(digest)
+            for link in entry["links"]:
+                if os.path.exists(link):
+                    os.remove(link)
+            os.remove(self.object_path(digest))
+            total -= entry["size"]
+
+    def link(self, digest, link_path):
+        """Expose a cached object under a logical path"""
+        entry = self.index[digest]
+        if link_path in entry["links"] and os.path.exists(link_path):
+            return
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        if os.path.exists(link_path):
+            # The path held another version of the asset
+            os.remove(link_path)
+            for other in self.index.values():
+                if link_path in other["links"]:
+                    other["links"].remove(link_path)
+        try:
+            os.link(self.object_path(digest), link_path)
+        except OSError:
+            shutil.copyfile(self.object_path(digest), link_path)
+        entry["links"].append(link_path)
+
+    def prepare(self, tier, logical_paths, on_asset=None):
+        """Fetch assets of one tier and return the directory to load them from.
+
+        Paths missing from the manifest are skipped. `on_asset(path)` is called
+        after each asset and may return False to stop early.
+        """
+        entries = self.manifest["tiers"][tier]
+        tier_dir = os.path.join(self.cache_dir, "tiers", tier)
+        wanted = [path for path in logical_paths if path in entries]
+        keep = {entries[path]["hash"] for path in wanted}
+        for path in wanted:
+            digest = entries[path]["hash"]
+            self.fetch(digest, keep)
+            self.link(digest, os.path.join(tier_dir, *path.split("/")))
+            if on_asset and on_asset(path) is False:
+                break
+        self.save_index()
+        return tier_dir
+
+class AssetStreamer:
+    """Streams space assets in the background, lowest tier first.
+
+    The Panda3D clients call request() when entering a space and poll() once
+    per frame; poll() returns (space_id, tier, tier_dir) for every tier that
+    finished downloading. Only the latest request is worked on.
+    """
+
+    def __init__(self, cache, tier):
+        self.cache = cache
+        self.tiers = ["low"] if tier == "low" else ["low", tier]
+        self.generation = 0
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.errors = queue.Queue()
+        threading.Thread(target=self._work, name="asset-streamer", daemon=True).start()
+
+    def request(self, space_id, model_paths):
+        """Start streaming a space's models, abandoning earlier requests"""
+        self.generation += 1
+        self.jobs.put((self.generation, space_id, list(model_paths)))
+
+    def poll(self):
+        results = []
+        while not self.results.empty():
+            results.append(self.results.get())
+        return results
+
+    def _work(self):
+        while True:
+            generation, space_id, model_paths = self.jobs.get()
+            if generation != self.generation:
+                continue
+            try:
+                manifest = self.cache.fetch_manifest()
+                if not manifest["tiers"]:
+                    continue  # No bundle: the client keeps its bundled models
+                for tier in self.tiers:
+                    entries = manifest["tiers"].get(tier, {})
+                    textures = sorted({texture for path in model_paths
+                                       for texture in entries.get(path, {}).get("textures", [])})
+                    tier_dir = self.cache.prepare(
+                        tier, model_paths + textures,
+                        on_asset=lambda path: generation == self.generation)
+                    if generation != self.generation:
+                        break
+                    self.results.put((space_id, tier, tier_dir))
+            except (OSError, ValueError, KeyError, AssetError) as e:
+                self.errors.put(e)
@@ -0,0 +1,44 @@
+import hashlib
+
+# Kitaverse content-defined chunking
+#
+# Files are split where a rolling "gear" hash of the last bytes hits a bit
+# pattern, so chunk boundaries follow the content: an edit only changes the
+# chunks around it and every other chunk keeps its hash. package.py uses this
+# to publish updates and updater.py to download only the chunks it lacks.
+# Both sides must use exactly these parameters.
+
+MIN_CHUNK_SIZE = 2 * 1024
+AVERAGE_CHUNK_BITS = 13  # ~8 KiB average chunks
+MAX_CHUNK_SIZE = 64 * 1024
+
+_HASH_BITS = (1 << 64) - 1
+# The top bits of the gear hash cover the last 64 bytes
+_BOUNDARY_MASK = ((1 << AVERAGE_CHUNK_BITS) - 1) << (64 - AVERAGE_CHUNK_BITS)
+
+# Fixed pseudo-random value per byte, derived so every platform agrees
+GEAR = [int.from_bytes(hashlib.sha256(bytes([b])).digest()[:8], "little") for b in range(256)]
+
+def chunk_boundaries(data):
+    """Yield (start, end) offsets of the chunks of `data`"""
+    start = 0
+    length = len(data)
+    while start < length:
+        end = min(start + MAX_CHUNK_SIZE, length)
+        position = start + MIN_CHUNK_SIZE
+        rolling = 0
+        while position < end:
+            rolling = ((rolling << 1) + GEAR[data[position]]) & _HASH_BITS
+            position += 1
+            if rolling & _BOUNDARY_MASK == 0:
+                end = position
+                break
+        yield start, end
+        start = end
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def split_chunks(data):
+    """Return [(hash, bytes)] for the chunks of `data`"""
+    return [(chunk_hash(data[start:end]), data[start:end]) for start, end in chunk_boundaries(data)]
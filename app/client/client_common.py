@@ -0,0 +1,191 @@
+from panda3d.core import Filename, getModelPath
+from contextlib import nullcontext
+import sys
+import os
+import json
+import atexit
+
+from asset_cache import AssetCache, AssetStreamer, read_prc_setting
+from pool import MAX_IDLE_AVATARS, ScenePools
+from profiler import FrameProfiler
+
+# Kitaverse client scene helpers
+#
+# Scene pooling, profiling, asset streaming and presence handling shared by
+# the desktop (main.py) and mobile (mobile.py) Panda3D clients. The clients
+# mix this class into their ShowBase subclass and provide the per-device
+# parts: the window, the UI, the controls and each space type's props.
+
+# Settings shared by the clients, including the asset cache location
+OPTIMIZED_PRC = "app/client/config_optimized.prc"
+AVATAR_MODEL = "models/misc/sphere"
+
+class KitaverseClientMixin:
+    """Space handling common to the Panda3D clients"""
+    
+    def setup_pools(self):
+        """Recycle prop and avatar nodes instead of loading and removing them"""
+        self.pools = ScenePools(lambda model_path: self.loader.loadModel(model_path))
+        self.avatar_pool = self.pools.pool(AVATAR_MODEL, MAX_IDLE_AVATARS)
+        self.environment = self.render.attachNewNode("environment")
+        self.avatar_root = self.render.attachNewNode("avatars")
+        self.avatars = {}
+        
+    def prop(self, model_path):
+        """A pooled node that belongs to the current space's environment"""
+        return self.pools.acquire("environment", model_path, self.environment)
+        
+    def sync_avatars(self, users):
+        """Show the other users in the space, reusing avatar nodes"""
+        present = {user["id"]: user for user in users if user["id"] != self.user_id}
+        for user_id in [user_id for user_id in self.avatars if user_id not in present]:
+            self.avatar_pool.release(self.avatars.pop(user_id))
+        for user_id, user in present.items():
+            avatar = self.avatars.get(user_id)
+            if avatar is None:
+                avatar = self.avatars[user_id] = self.avatar_pool.acquire(self.avatar_root)
+                avatar.setScale(0.5)
+                avatar.setColor(0.2, 0.6, 0.9, 1)
+            position = user.get("position", {})
+            avatar.setPos(position.get("x", 0), position.get("y", 0), position.get("z", 0))
+        
+    def setup_profiler(self, client_name):
+        """Enable profiling with --profile or KITAVERSE_PROFILE=1"""
+        self.profiler = None
+        if "--profile" in sys.argv or os.environ.get("KITAVERSE_PROFILE") == "1":
+            self.profiler = FrameProfiler(self, client_name)
+            self.profiler.instrument_loader(self.loader)
+            # The trace is written when the client exits
+            atexit.register(self.export_profile)
+            
+    def export_profile(self):
+        """Write the profiling trace to the traces directory"""
+        if self.profiler:
+            print(f"Profiling trace written to {self.profiler.export()}")
+            
+    def measure(self, name):
+        """Time a block as a scene load when profiling"""
+        return self.profiler.measure(name) if self.profiler else nullcontext()
+        
+    def setup_asset_streaming(self, tier):
+        """Stream space models from the server into the local asset cache"""
+        cache_dir = read_prc_setting(OPTIMIZED_PRC, "model-cache-dir", ".")
+        self.asset_cache = AssetCache(os.path.join(cache_dir, "kitaverse-assets"), self.server_url)
+        self.asset_streamer = AssetStreamer(self.asset_cache, tier)
+        self.streaming_space = None
+        self.streamed_tier_dir = None
+        self.streamed_models = []
+        self.taskMgr.add(self.attach_streamed_assets, "attach-streamed-assets")
+        
+    def stream_space_assets(self, space_def):
+        """Start downloading a space's models, lowest quality first"""
+        self.streaming_space = space_def
+        for model in self.streamed_models:
+            model.removeNode()
+        self.streamed_models = []
+        self.asset_streamer.request(space_def["id"], list(space_def.get("models", {}).values()))
+        
+    def use_asset_tier(self, tier_dir):
+        """Put a streamed tier first on the model path, replacing the previous one"""
+        model_path = getModelPath()
+        directories = [model_path.getDirectory(i) for i in range(model_path.getNumDirectories())]
+        previous = Filename.fromOsSpecific(self.streamed_tier_dir) if self.streamed_tier_dir else None
+        model_path.clear()
+        model_path.appendDirectory(Filename.fromOsSpecific(os.path.abspath(tier_dir)))
+        for directory in directories:
+            if directory != previous:
+                model_path.appendDirectory(directory)
+        self.streamed_tier_dir = os.path.abspath(tier_dir)
+        
+    def attach_streamed_assets(self, task):
+        """Show a space's streamed models as each tier arrives"""
+        while not self.asset_streamer.errors.empty():
+            self.status_text.setText(f"Asset download failed: {self.asset_streamer.errors.get()}")
+        for space_id, tier, tier_dir in self.asset_streamer.poll():
+            # Ignore downloads for a space we have already left
+            if not self.streaming_space or self.streaming_space["id"] != space_id:
+                continue
+            with self.measure(f"attach_streamed_assets {tier}"):
+                self.use_asset_tier(tier_dir)
+                for model in self.streamed_models:
+                    model.removeNode()
+                self.streamed_models = []
+                # Buildings and areas are modelled around the space's origin
+                for name, model_path in self.streaming_space.get("models", {}).items():
+                    if not name.startswith("main_"):
+                        continue
+                    model = self.loader.loadModel(model_path, okMissing=True)
+                    if model:
+                        model.reparentTo(self.environment)
+                        self.streamed_models.append(model)
+        return task.cont
+        
+    def load_space_definitions(self):
+        """Load space definitions from JSON file"""
+        try:
+            with open("app/client/spaces.json", "r") as f:
+                self.space_definitions = json.load(f)
+        except FileNotFoundError:
+            # Default space definitions if file not found
+            self.space_definitions = {
+                "spaces": [
+                    {
+                        "id": 1,
+                        "name": "Community Center",
+                        "type": "meeting",
+                        "description": "A place for village meetings and discussions",
+                        "capacity": 30
+                    },
+                    {
+                        "id": 2,
+                        "name": "Village Market",
+                        "type": "market",
+                        "description": "Buy and sell goods with other villagers",
+                        "capacity": 100
+                    },
+                    {
+                        "id": 3,
+                        "name": "Festival Grounds",
+                        "type": "festival",
+                        "description": "Celebrate festivals and cultural events",
+                        "capacity": 200
+                    }
+                ]
+            }
+        
+    def check_presence(self, task):
+        """Tell the user if the server dropped them, e.g. after a long network outage"""
+        if self.heartbeat.lost and self.current_space:
+            self.heartbeat.lost = False
+            self.status_text.setText(f"Lost your place in {self.current_space['name']}, please enter again")
+            self.current_space = None
+        return task.again
+        
+    def load_space_environment(self, space_id):
+        """Load environment specific to the space type"""
+        # Find space definition
+        space_def = None
+        for space in self.space_definitions["spaces"]:
+            if space["id"] == space_id:
+                space_def = space
+                break
+                
+        if not space_def:
+            return
+            
+        # Return the previous space's props and avatars to their pools
+        self.pools.release_group("environment")
+        self.sync_avatars([])
+        if space_def["type"] == "festival":
+            # Busy festivals bring many avatars at once: have nodes ready
+            self.avatar_pool.prewarm(MAX_IDLE_AVATARS)
+                
+        # Load space-specific models based on type
+        if space_def["type"] == "meeting":
+            self.create_meeting_environment()
+        elif space_def["type"] == "market":
+            self.create_market_environment()
+        elif space_def["type"] == "festival":
+            self.create_festival_environment()
+            
+        self.stream_space_assets(space_def)
@@ -2,15 +2,18 @@ from direct.showbase.ShowBase import ShowBase
 from panda3d.core import WindowProperties, ConfigVariableBool, Vec3
 from direct.gui.DirectGui import *
 import sys
-import json
-import urllib.request
-import urllib.parse
 
-class KitaverseClient(ShowBase):
+from client_common import KitaverseClientMixin
+from protocol import DEFAULT_SERVER_URL, Heartbeat, KitaverseConnection
+
+class KitaverseClient(KitaverseClientMixin, ShowBase):
     def __init__(self):
         # Initialize the ShowBase class
         ShowBase.__init__(self)
         
+        # Optional frame-time and network profiling
+        self.setup_profiler("desktop")
+        
         # Optimize for low-end devices
         self.optimize_for_mobile()
         
@@ -27,12 +30,20 @@ class KitaverseClient(ShowBase):
         self.setup_controls()
         
         # Server connection state
-        self.server_url = "http://localhost:8000"
+        self.server_url = DEFAULT_SERVER_URL
+        self.connection = KitaverseConnection(
+            self.server_url,
+            observer=self.profiler.record_request if self.profiler else None)
         self.current_space = None
+        self.heartbeat = Heartbeat(self.connection)
+        self.taskMgr.doMethodLater(1.0, self.check_presence, "check-presence")
         self.user_id = 1  # In a real app, this would be assigned by the server
         self.user_name = "Villager"
         self.user_position = Vec3(0, 0, 0)
         
+        # Space models are streamed from the server and cached on disk
+        self.setup_asset_streaming("high")
+        
         # Load space definitions
         self.load_space_definitions()
         
@@ -58,41 +69,10 @@ class KitaverseClient(ShowBase):
         # Disable mouse control for camera
         self.disableMouse()
         
-    def load_space_definitions(self):
-        """Load space definitions from JSON file"""
-        try:
-            with open("app/client/spaces.json", "r") as f:
-                self.space_definitions = json.load(f)
-        except FileNotFoundError:
-            # Default space definitions if file not found
-            self.space_definitions = {
-                "spaces": [
-                    {
-                        "id": 1,
-                        "name": "Community Center",
-                        "type": "meeting",
-                        "description": "A place for village meetings and discussions",
-                        "capacity": 30
-                    },
-                    {
-                        "id": 2,
-                        "name": "Village Market",
-                        "type": "market",
-                        "description": "Buy and sell goods with other villagers",
-                        "capacity": 100
-                    },
-                    {
-                        "id": 3,
-                        "name": "Festival Grounds",
-                        "type": "festival",
-                        "description": "Celebrate festivals and cultural events",
-                        "capacity": 200
-                    }
-                ]
-            }
-        
     def create_scene(self):
         """Create a basic 3D scene"""
+        self.setup_pools()
+        
         # Create a simple ground plane
         self.scene = self.loader.loadModel("models/misc/sphere")
         self.scene.reparentTo(self.render)
@@ -108,22 +88,19 @@ class KitaverseClient(ShowBase):
     def create_environment(self):
         """Create basic environment objects"""
         # Create a simple building for the community center
-        building = self.loader.loadModel("models/misc/box")
-        building.reparentTo(self.render)
+        building = self.prop("models/misc/box")
         building.setScale(5, 5, 3)
         building.setPos(0, 0, 0)
         building.setColor(0.8, 0.8, 0.6, 1)
         
         # Create a market stall
-        stall = self.loader.loadModel("models/misc/cylinder")
-        stall.reparentTo(self.render)
+        stall = self.prop("models/misc/cylinder")
         stall.setScale(1, 1, 0.5)
         stall.setPos(10, 10, 0)
         stall.setColor(0.6, 0.4, 0.2, 1)
         
         # Create a festival stage
-        stage = self.loader.loadModel("models/misc/cube")
-        stage.reparentTo(self.render)
+        stage = self.prop("models/misc/cube")
         stage.setScale(8, 4, 0.5)
         stage.setPos(-10, -10, 0)
         stage.setColor(0.9, 0.1, 0.1, 1)
@@ -187,6 +164,11 @@ class KitaverseClient(ShowBase):
         self.accept("2", self.enter_space, [2])
         self.accept("3", self.enter_space, [3])
         
+        # Profiling overlay and trace export
+        if self.profiler:
+            self.accept("f3", self.profiler.toggle_overlay)
+            self.accept("f4", self.export_profile)
+        
         # Movement controls
         self.accept("arrow_up", self.move_forward)
         self.accept("arrow_down", self.move_backward)
@@ -217,9 +199,7 @@ class KitaverseClient(ShowBase):
         """Connect to the backend server"""
         try:
             # Test connection
-            url = f"{self.server_url}/"
-            response = urllib.request.urlopen(url)
-            data = json.loads(response.read())
+            data = self.connection.get_info()
             
             self.status_text.setText(f"Connected to {data['message']}")
         except Exception as e:
@@ -228,66 +208,30 @@ class KitaverseClient(ShowBase):
     def enter_space(self, space_id):
         """Enter a virtual space"""
         try:
-            # Prepare user data
-            user_data = {
-                "id": self.user_id,
-                "name": self.user_name,
-                "position": {
-                    "x": self.user_position.x,
-                    "y": self.user_position.y,
-                    "z": self.user_position.z
-                }
-            }
-            
             # Send request to server
-            url = f"{self.server_url}/spaces/{space_id}/enter"
-            data = json.dumps(user_data).encode('utf-8')
-            req = urllib.request.Request(url, data=data, 
-                                         headers={'Content-Type': 'application/json'})
-            response = urllib.request.urlopen(req)
-            result = json.loads(response.read())
+            result = self.connection.enter_space(space_id, self.user_id, self.user_name,
+                                                 self.user_position.x,
+                                                 self.user_position.y,
+                                                 self.user_position.z)
             
             # Update UI
             self.current_space = result["space"]
+            self.heartbeat.start(self.current_space["id"], self.user_id)
             self.space_info.setText(f"In {self.current_space['name']}\nUsers: {self.current_space['current_users']}/{self.current_space['capacity']}")
             self.status_text.setText(f"Entered {self.current_space['name']}")
             
             # Load space-specific environment
-            self.load_space_environment(space_id)
+            with self.measure(f"load_space_environment {space_id}"):
+                self.load_space_environment(space_id)
+                self.sync_avatars(self.connection.get_space_users(self.current_space["id"]))
             
         except Exception as e:
             self.status_text.setText(f"Failed to enter space: {str(e)}")
             
-    def load_space_environment(self, space_id):
-        """Load environment specific to the space type"""
-        # Find space definition
-        space_def = None
-        for space in self.space_definitions["spaces"]:
-            if space["id"] == space_id:
-                space_def = space
-                break
-                
-        if not space_def:
-            return
-            
-        # Clear existing environment objects
-        for child in self.render.getChildren():
-            if child != self.scene and child.getName() != "ambient_light" and child.getName() != "directional_light":
-                child.removeNode()
-                
-        # Load space-specific models based on type
-        if space_def["type"] == "meeting":
-            self.create_meeting_environment()
-        elif space_def["type"] == "market":
-            self.create_market_environment()
-        elif space_def["type"] == "festival":
-            self.create_festival_environment()
-            
     def create_meeting_environment(self):
         """Create environment for community center (meetings)"""
         # Create a large table in the center
-        table = self.loader.loadModel("models/misc/cylinder")
-        table.reparentTo(self.render)
+        table = self.prop("models/misc/cylinder")
         table.setScale(4, 4, 0.2)
         table.setPos(0, 0, 0)
         table.setColor(0.4, 0.2, 0.1, 1)
@@ -298,8 +242,7 @@ class KitaverseClient(ShowBase):
             x = 5 * math.cos(angle)
             y = 5 * math.sin(angle)
             
-            chair = self.loader.loadModel("models/misc/box")
-            chair.reparentTo(self.render)
+            chair = self.prop("models/misc/box")
             chair.setScale(0.5, 0.5, 1)
             chair.setPos(x, y, 0)
             chair.setColor(0.6, 0.4, 0.2, 1)
@@ -314,8 +257,7 @@ class KitaverseClient(ShowBase):
             x = 8 * math.cos(angle)
             y = 8 * math.sin(angle)
             
-            stall = self.loader.loadModel("models/misc/cylinder")
-            stall.reparentTo(self.render)
+            stall = self.prop("models/misc/cylinder")
             stall.setScale(1.5, 1.5, 1)
             stall.setPos(x, y, 0)
             stall.setColor(0.7, 0.5, 0.3, 1)
@@ -323,8 +265,7 @@ class KitaverseClient(ShowBase):
     def create_festival_environment(self):
         """Create environment for festival grounds"""
         # Create a larger performance stage
-        stage = self.loader.loadModel("models/misc/cube")
-        stage.reparentTo(self.render)
+        stage = self.prop("models/misc/cube")
         stage.setScale(10, 5, 0.5)
         stage.setPos(0, 10, 0)
         stage.setColor(0.9, 0.1, 0.1, 1)
@@ -336,8 +277,7 @@ class KitaverseClient(ShowBase):
             x = 15 * math.cos(angle)
             y = 15 * math.sin(angle)
             
-            decoration = self.loader.loadModel("models/misc/sphere")
-            decoration.reparentTo(self.render)
+            decoration = self.prop("models/misc/sphere")
             decoration.setScale(0.5, 0.5, 1)
             decoration.setPos(x, y, 0)
             decoration.setColor(1, 1, 0, 1)
@@ -2,19 +2,23 @@ from direct.showbase.ShowBase import ShowBase
 from panda3d.core import WindowProperties, ConfigVariableBool, Vec3, loadPrcFile
 from direct.gui.DirectGui import *
 import sys
-import json
-import urllib.request
-import urllib.parse
 import math
 
-class KitaverseMobileClient(ShowBase):
+from asset_cache import read_prc_setting
+from client_common import OPTIMIZED_PRC, KitaverseClientMixin
+from protocol import DEFAULT_SERVER_URL, Heartbeat, KitaverseConnection
+
+class KitaverseMobileClient(KitaverseClientMixin, ShowBase):
     def __init__(self):
         # Load optimized configuration for mobile devices
-        loadPrcFile("app/client/config_optimized.prc")
+        loadPrcFile(OPTIMIZED_PRC)
         
         # Initialize the ShowBase class
         ShowBase.__init__(self)
         
+        # Optional frame-time and network profiling
+        self.setup_profiler("mobile")
+        
         # Set window properties for mobile
         self.setup_mobile_window()
         
@@ -28,12 +32,20 @@ class KitaverseMobileClient(ShowBase):
         self.setup_mobile_controls()
         
         # Server connection state
-        self.server_url = "http://localhost:8000"
+        self.server_url = DEFAULT_SERVER_URL
+        self.connection = KitaverseConnection(
+            self.server_url,
+            observer=self.profiler.record_request if self.profiler else None)
         self.current_space = None
+        self.heartbeat = Heartbeat(self.connection)
+        self.taskMgr.doMethodLater(1.0, self.check_presence, "check-presence")
         self.user_id = 1
         self.user_name = "Villager"
         self.user_position = Vec3(0, 0, 0)
         
+        # Space models are streamed from the server and cached on disk
+        self.setup_asset_streaming(read_prc_setting(OPTIMIZED_PRC, "textures-quality", "low"))
+        
         # Load space definitions
         self.load_space_definitions()
         
@@ -47,41 +59,10 @@ class KitaverseMobileClient(ShowBase):
         # Disable mouse control for camera
         self.disableMouse()
         
-    def load_space_definitions(self):
-        """Load space definitions from JSON file"""
-        try:
-            with open("app/client/spaces.json", "r") as f:
-                self.space_definitions = json.load(f)
-        except FileNotFoundError:
-            # Default space definitions if file not found
-            self.space_definitions = {
-                "spaces": [
-                    {
-                        "id": 1,
-                        "name": "Community Center",
-                        "type": "meeting",
-                        "description": "A place for village meetings and discussions",
-                        "capacity": 30
-                    },
-                    {
-                        "id": 2,
-                        "name": "Village Market",
-                        "type": "market",
-                        "description": "Buy and sell goods with other villagers",
-                        "capacity": 100
-                    },
-                    {
-                        "id": 3,
-                        "name": "Festival Grounds",
-                        "type": "festival",
-                        "description": "Celebrate festivals and cultural events",
-                        "capacity": 200
-                    }
-                ]
-            }
-        
     def create_scene(self):
         """Create a basic 3D scene optimized for mobile"""
+        self.setup_pools()
+        
         # Create a simple ground plane
         self.scene = self.loader.loadModel("models/misc/sphere")
         self.scene.reparentTo(self.render)
@@ -201,9 +182,7 @@ class KitaverseMobileClient(ShowBase):
         """Connect to the backend server"""
         try:
             # Test connection
-            url = f"{self.server_url}/"
-            response = urllib.request.urlopen(url)
-            data = json.loads(response.read())
+            data = self.connection.get_info()
             
             self.status_text.setText(f"Connected!")
             # Enable space buttons after connection
@@ -216,66 +195,30 @@ class KitaverseMobileClient(ShowBase):
     def enter_space(self, space_id):
         """Enter a virtual space"""
         try:
-            # Prepare user data
-            user_data = {
-                "id": self.user_id,
-                "name": self.user_name,
-                "position": {
-                    "x": self.user_position.x,
-                    "y": self.user_position.y,
-                    "z": self.user_position.z
-                }
-            }
-            
             # Send request to server
-            url = f"{self.server_url}/spaces/{space_id}/enter"
-            data = json.dumps(user_data).encode('utf-8')
-            req = urllib.request.Request(url, data=data, 
-                                         headers={'Content-Type': 'application/json'})
-            response = urllib.request.urlopen(req)
-            result = json.loads(response.read())
+            result = self.connection.enter_space(space_id, self.user_id, self.user_name,
+                                                 self.user_position.x,
+                                                 self.user_position.y,
+                                                 self.user_position.z)
             
             # Update UI
             self.current_space = result["space"]
+            self.heartbeat.start(self.current_space["id"], self.user_id)
             self.space_info.setText(f"In {self.current_space['name']}\\nUsers: {self.current_space['current_users']}/{self.current_space['capacity']}")
             self.status_text.setText(f"Entered {self.current_space['name']}")
             
             # Load space-specific environment
-            self.load_space_environment(space_id)
+            with self.measure(f"load_space_environment {space_id}"):
+                self.load_space_environment(space_id)
+                self.sync_avatars(self.connection.get_space_users(self.current_space["id"]))
             
         except Exception as e:
             self.status_text.setText(f"Failed: {str(e)}")
             
-    def load_space_environment(self, space_id):
-        """Load environment specific to the space type"""
-        # Find space definition
-        space_def = None
-        for space in self.space_definitions["spaces"]:
-            if space["id"] == space_id:
-                space_def = space
-                break
-                
-        if not space_def:
-            return
-            
-        # Clear existing environment objects
-        for child in self.render.getChildren():
-            if child != self.scene and child.getName() != "ambient_light":
-                child.removeNode()
-                
-        # Load space-specific models based on type
-        if space_def["type"] == "meeting":
-            self.create_meeting_environment()
-        elif space_def["type"] == "market":
-            self.create_market_environment()
-        elif space_def["type"] == "festival":
-            self.create_festival_environment()
-            
     def create_meeting_environment(self):
         """Create environment for community center (meetings)"""
         # Create a large table in the center
-        table = self.loader.loadModel("models/misc/cylinder")
-        table.reparentTo(self.render)
+        table = self.prop("models/misc/cylinder")
         table.setScale(2, 2, 0.1)  # Smaller than desktop version
         table.setPos(0, 0, 0)
         table.setColor(0.4, 0.2, 0.1, 1)
@@ -286,8 +229,7 @@ class KitaverseMobileClient(ShowBase):
             x = 3 * math.cos(angle)
             y = 3 * math.sin(angle)
             
-            chair = self.loader.loadModel("models/misc/box")
-            chair.reparentTo(self.render)
+            chair = self.prop("models/misc/box")
             chair.setScale(0.3, 0.3, 0.8)
             chair.setPos(x, y, 0)
             chair.setColor(0.6, 0.4, 0.2, 1)
@@ -300,8 +242,7 @@ class KitaverseMobileClient(ShowBase):
             x = 6 * math.cos(angle)
             y = 6 * math.sin(angle)
             
-            stall = self.loader.loadModel("models/misc/cylinder")
-            stall.reparentTo(self.render)
+            stall = self.prop("models/misc/cylinder")
             stall.setScale(1, 1, 0.8)
             stall.setPos(x, y, 0)
             stall.setColor(0.7, 0.5, 0.3, 1)
@@ -309,8 +250,7 @@ class KitaverseMobileClient(ShowBase):
     def create_festival_environment(self):
         """Create environment for festival grounds"""
         # Create a performance stage
-        stage = self.loader.loadModel("models/misc/cube")
-        stage.reparentTo(self.render)
+        stage = self.prop("models/misc/cube")
         stage.setScale(5, 3, 0.3)
         stage.setPos(0, 6, 0)
         stage.setColor(0.9, 0.1, 0.1, 1)
@@ -321,8 +261,7 @@ class KitaverseMobileClient(ShowBase):
             x = 10 * math.cos(angle)
             y = 10 * math.sin(angle)
             
-            decoration = self.loader.loadModel("models/misc/sphere")
-            decoration.reparentTo(self.render)
+            decoration = self.prop("models/misc/sphere")
             decoration.setScale(0.3, 0.3, 0.3)
             decoration.setPos(x, y, 0)
             decoration.setColor(1, 1, 0, 1)
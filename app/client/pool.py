@@ -0,0 +1,99 @@
+from collections import defaultdict
+
+# Kitaverse node pooling
+#
+# Loading a model and removing it again costs allocations on both the C++ and
+# the Python side; at a busy festival, with avatars coming and going and
+# props rebuilt on every space change, that shows up as frame spikes. Pools
+# keep released nodes detached from the scene graph and hand them out again.
+# Idle nodes per pool are bounded, so a burst does not pin memory forever.
+#
+# Nodes are Panda3D NodePaths; the pool only calls reparentTo, detachNode,
+# clearTransform, clearColor and removeNode on them.
+
+MAX_IDLE_PROPS = 32
+MAX_IDLE_AVATARS = 64
+
+class NodePool:
+    """Reusable nodes of one model"""
+
+    def __init__(self, create, max_idle=MAX_IDLE_PROPS):
+        self.create = create
+        self.max_idle = max_idle
+        self.idle = []
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def acquire(self, parent):
+        """A node of this model, attached to `parent` with a fresh state"""
+        if self.idle:
+            node = self.idle.pop()
+            self.reused += 1
+        else:
+            node = self.create()
+            self.created += 1
+        node.reparentTo(parent)
+        return node
+
+    def release(self, node):
+        """Take a node out of the scene, keeping it for reuse if there is room"""
+        if len(self.idle) < self.max_idle:
+            node.detachNode()
+            node.clearTransform()
+            node.clearColor()
+            self.idle.append(node)
+        else:
+            node.removeNode()
+            self.discarded += 1
+
+    def prewarm(self, count):
+        """Create idle nodes ahead of time, e.g. before a festival starts"""
+        while len(self.idle) < min(count, self.max_idle):
+            self.idle.append(self.create())
+            self.created += 1
+
+class ScenePools:
+    """Pools per model path, and the nodes each group currently holds.
+
+    A group is a set of nodes released together, like the props of the
+    current space, so tearing down an environment does not need to walk the
+    scene graph.
+    """
+
+    def __init__(self, load_model, max_idle=MAX_IDLE_PROPS):
+        self.load_model = load_model
+        self.max_idle = max_idle
+        self.pools = {}
+        self.groups = defaultdict(list)
+
+    def pool(self, model_path, max_idle=None):
+        pool = self.pools.get(model_path)
+        if pool is None:
+            pool = self.pools[model_path] = NodePool(
+                lambda: self.load_model(model_path),
+                self.max_idle if max_idle is None else max_idle)
+        return pool
+
+    def acquire(self, group, model_path, parent):
+        node = self.pool(model_path).acquire(parent)
+        self.groups[group].append((model_path, node))
+        return node
+
+    def release(self, group, node):
+        """Release one node of a group"""
+        for i, (model_path, held) in enumerate(self.groups[group]):
+            if held is node:
+                del self.groups[group][i]
+                self.pools[model_path].release(node)
+                return
+
+    def release_group(self, group):
+        """Release every node of a group"""
+        for model_path, node in self.groups.pop(group, []):
+            self.pools[model_path].release(node)
+
+    def stats(self):
+        return {model_path: {"idle": len(pool.idle), "created": pool.created,
+                             "reused": pool.reused, "discarded": pool.discarded}
+                for model_path, pool in self.pools.items()}
@@ -0,0 +1,62 @@
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import TextNode
+
+from tracing import TraceRecorder
+
+# Kitaverse client profiler
+#
+# Records per-frame timings (update, render), model loads, scene rebuilds and
+# server round trips with a TraceRecorder (tracing.py), schedules its frame
+# phase tasks around Panda3D's render task and shows a small on-screen
+# overlay of the rolling values.
+
+OVERLAY_INTERVAL = 0.5
+
+class FrameProfiler(TraceRecorder):
+    """Collects client timings, shows them and exports them as a trace"""
+
+    def __init__(self, base, client_name, trace_dir="traces"):
+        super().__init__(client_name, trace_dir)
+        self.base = base
+        self.last_overlay_update = 0.0
+
+        self.overlay = OnscreenText(text="", style=1, fg=(1, 1, 0, 1), pos=(-1.3, 0.9),
+                                    align=TextNode.ALeft, scale=0.04, mayChange=True)
+
+        taskMgr = base.taskMgr
+        taskMgr.add(self._on_frame_start, "profiler-frame-start", sort=-1000)
+        taskMgr.add(self._on_before_render, "profiler-before-render", sort=49)
+        taskMgr.add(self._on_after_render, "profiler-after-render", sort=51)
+
+    def after_render(self, now):
+        if now - self.last_overlay_update >= OVERLAY_INTERVAL:
+            self.last_overlay_update = now
+            self.update_overlay()
+
+    def update_overlay(self):
+        if self.overlay.isHidden() or not self.frame_times:
+            return
+        frame_ms = sum(self.frame_times) / len(self.frame_times) * 1000
+        render_ms = sum(self.render_times) / max(len(self.render_times), 1) * 1000
+        rtt_ms = sum(self.round_trips) / len(self.round_trips) * 1000 if self.round_trips else 0
+        self.overlay.setText(
+            f"FPS {1000 / frame_ms:.0f}  frame {frame_ms:.1f} ms (max {max(self.frame_times) * 1000:.0f})\n"
+            f"render {render_ms:.1f} ms  scene load {self.last_scene_load * 1000:.0f} ms\n"
+            f"RTT {rtt_ms:.0f} ms  sent {self.bytes_sent / 1024:.1f} KB  recv {self.bytes_received / 1024:.1f} KB"
+        )
+
+    def toggle_overlay(self):
+        if self.overlay.isHidden():
+            self.overlay.show()
+        else:
+            self.overlay.hide()
+
+    def device_info(self):
+        info = super().device_info()
+        try:
+            gsg = self.base.win.getGsg()
+            info["renderer"] = gsg.getDriverRenderer()
+            info["driver_version"] = gsg.getDriverVersion()
+        except AttributeError:
+            pass
+        return info
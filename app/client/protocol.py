@@ -0,0 +1,158 @@
+import gzip
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Kitaverse client protocol
+#
+# Request payloads, URLs and message formats shared by the Panda3D clients and
+# the headless swarm (swarm.py), so they always speak the same protocol.
+
+DEFAULT_SERVER_URL = "http://localhost:8000"
+
+# The backend compresses larger JSON replies for clients that accept it
+ACCEPT_ENCODING = "gzip"
+
+# The backend removes users it has not heard from in its presence timeout
+# (30 s by default, reported by every heartbeat); send three per timeout
+DEFAULT_PRESENCE_TIMEOUT = 30.0
+HEARTBEATS_PER_TIMEOUT = 3
+
+def read_body(response):
+    """Return (body, bytes on the wire) of a urllib response, decompressing it"""
+    content = response.read()
+    if response.headers.get("Content-Encoding") == "gzip":
+        return gzip.decompress(content), len(content)
+    return content, len(content)
+
+def user_payload(user_id, name, x=0.0, y=0.0, z=0.0):
+    """Body of an enter request"""
+    return {
+        "id": user_id,
+        "name": name,
+        "position": {"x": x, "y": y, "z": z}
+    }
+
+def websocket_url(server_url, space_id, user_id):
+    """URL of a space's real-time connection"""
+    base = server_url.replace("https://", "wss://").replace("http://", "ws://")
+    return f"{base}/spaces/{space_id}/ws?user_id={user_id}"
+
+def move_message(x, y, z=0.0):
+    return json.dumps({"type": "move", "position": {"x": x, "y": y, "z": z}})
+
+def chat_message(text, scope="nearby"):
+    return json.dumps({"type": "chat", "text": text, "scope": scope})
+
+def heartbeat_message():
+    return json.dumps({"type": "heartbeat"})
+
+def iter_events(frame):
+    """Yield the events of a server frame, unpacking batches"""
+    event = json.loads(frame) if isinstance(frame, (str, bytes)) else frame
+    if event.get("type") == "batch":
+        yield from event["events"]
+    else:
+        yield event
+
+class KitaverseConnection:
+    """Blocking REST calls to the backend, used by the Panda3D clients.
+
+    If set, `observer(method, path, seconds, bytes_sent, bytes_received, status)`
+    is called after every request, e.g. by the client profiler.
+    """
+
+    def __init__(self, server_url=DEFAULT_SERVER_URL, observer=None):
+        self.server_url = server_url
+        self.observer = observer
+
+    def request(self, path, body=None):
+        """Send a GET (or a POST if `body` is given) and return the JSON reply"""
+        url = f"{self.server_url}{path}"
+        data = None
+        headers = {'Accept-Encoding': ACCEPT_ENCODING}
+        if body is None:
+            req = urllib.request.Request(url, headers=headers)
+        else:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+            req = urllib.request.Request(url, data=data, headers=headers)
+        
+        start = time.perf_counter()
+        content = b""
+        received = 0
+        status = None
+        try:
+            response = urllib.request.urlopen(req)
+            status = response.status
+            content, received = read_body(response)
+        except urllib.error.HTTPError as e:
+            status = e.code
+            raise
+        finally:
+            if self.observer:
+                self.observer(req.get_method(), path, time.perf_counter() - start,
+                              len(data or b""), received, status)
+        return json.loads(content)
+
+    def get_info(self):
+        return self.request("/")
+
+    def get_spaces(self):
+        return self.request("/spaces")["spaces"]
+
+    def enter_space(self, space_id, user_id, name, x=0.0, y=0.0, z=0.0):
+        return self.request(f"/spaces/{space_id}/enter", user_payload(user_id, name, x, y, z))
+
+    def leave_space(self, space_id, user_id):
+        return self.request(f"/spaces/{space_id}/leave?user_id={user_id}", {})
+
+    def get_space_users(self, space_id):
+        return self.request(f"/spaces/{space_id}/users")["users"]
+
+    def heartbeat(self, space_id, user_id):
+        return self.request(f"/spaces/{space_id}/heartbeat?user_id={user_id}", {})
+
+class Heartbeat:
+    """Keeps a user's place in a space from a background thread.
+
+    Heartbeats go out right after `start` and then every presence timeout
+    divided by HEARTBEATS_PER_TIMEOUT, so a slow network never stalls a
+    frame. If the server no longer has the user in the space, `lost` is set
+    and heartbeats stop; the client checks it from a task.
+    """
+
+    def __init__(self, connection):
+        # A connection of its own: these requests are not waited for by frames
+        self.connection = KitaverseConnection(connection.server_url)
+        self.interval = DEFAULT_PRESENCE_TIMEOUT / HEARTBEATS_PER_TIMEOUT
+        self.lost = False
+        self._stop = None
+
+    def start(self, space_id, user_id):
+        """Heartbeat for a space, replacing any previous one"""
+        self.stop()
+        self.lost = False
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, args=(space_id, user_id, self._stop),
+                         name="kitaverse-heartbeat", daemon=True).start()
+
+    def stop(self):
+        if self._stop:
+            self._stop.set()
+            self._stop = None
+
+    def _run(self, space_id, user_id, stop):
+        while not stop.is_set():
+            try:
+                reply = self.connection.heartbeat(space_id, user_id)
+                self.interval = reply.get("timeout", DEFAULT_PRESENCE_TIMEOUT) / HEARTBEATS_PER_TIMEOUT
+            except urllib.error.HTTPError as e:
+                if e.code == 404 and not stop.is_set():
+                    self.lost = True
+                    return
+            except (urllib.error.URLError, OSError, ValueError):
+                pass  # Try again next time; presence allows for a few misses
+            stop.wait(self.interval)
@@ -0,0 +1,221 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+
+import httpx
+import websockets
+
+from protocol import (DEFAULT_SERVER_URL, chat_message, iter_events, move_message,
+                      user_payload, websocket_url)
+
+# Kitaverse simulated-client swarm
+#
+# Spawns lightweight asyncio bots that speak the same protocol as the Panda3D
+# clients: each bot enters a space over REST, opens the space's WebSocket,
+# walks around and chats. Used to measure server CPU, memory, bandwidth per
+# user and chat delivery latency without any display.
+#
+# All bots share one client address, so start the server with a REST limit
+# that allows the ramp-up, e.g. KITAVERSE_REST_RATE=100000, and with space
+# capacities large enough for the swarm (KITAVERSE_SPACES_FILE).
+
+# Chat texts carry the sender's clock so receivers can measure latency;
+# all bots run in this process and share the monotonic clock
+PING_PREFIX = "swarm-ping:"
+
+class SwarmStats:
+    """Counters shared by every bot"""
+
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.events_received = 0
+        self.chat_latencies = []
+
+    def reset_traffic(self):
+        """Forget traffic counted so far, e.g. during ramp-up"""
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.frames_received = 0
+        self.events_received = 0
+        self.chat_latencies = []
+
+    def summary(self, bots, duration):
+        latencies = sorted(self.chat_latencies)
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+        connected = max(self.connected, 1)
+        return {
+            "bots": bots,
+            "connected": self.connected,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "duration_s": round(duration, 2),
+            "frames_received": self.frames_received,
+            "events_received": self.events_received,
+            "bytes_sent_per_user_per_s": round(self.bytes_sent / connected / duration, 1),
+            "bytes_received_per_user_per_s": round(self.bytes_received / connected / duration, 1),
+            "chat_latency_ms": {
+                "samples": len(latencies),
+                "mean": round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99)
+            }
+        }
+
+def read_process_usage(pid):
+    """Return (cpu_seconds, rss_bytes) of a local process from /proc"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])  # utime + stime
+    with open(f"/proc/{pid}/statm") as f:
+        rss_pages = int(f.read().split()[1])
+    return ticks / os.sysconf("SC_CLK_TCK"), rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+def raise_open_file_limit():
+    """Every bot holds a socket; lift the soft descriptor limit if we can"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+class Bot:
+    """One simulated villager"""
+
+    def __init__(self, bot_id, space_id, args, http, stats, stop):
+        self.bot_id = bot_id
+        self.space_id = space_id
+        self.args = args
+        self.http = http
+        self.stats = stats
+        self.stop = stop
+        self.x = random.uniform(-args.area, args.area)
+        self.y = random.uniform(-args.area, args.area)
+
+    async def run(self):
+        payload = user_payload(self.bot_id, f"Bot {self.bot_id}", self.x, self.y)
+        try:
+            response = await self.http.post(f"/spaces/{self.space_id}/enter", json=payload)
+        except httpx.HTTPError:
+            self.stats.failed += 1
+            return
+        if response.status_code != 200:
+            self.stats.rejected += 1
+            return
+        # The server may have placed us in an overflow instance
+        self.space_id = response.json()["space"]["id"]
+
+        url = websocket_url(self.args.server, self.space_id, self.bot_id)
+        try:
+            async with websockets.connect(url, max_queue=None) as websocket:
+                self.stats.connected += 1
+                receiver = asyncio.ensure_future(self.receive(websocket))
+                try:
+                    await self.act(websocket)
+                finally:
+                    receiver.cancel()
+        except (OSError, websockets.exceptions.WebSocketException):
+            self.stats.failed += 1
+
+    async def send(self, websocket, message):
+        self.stats.bytes_sent += len(message)
+        await websocket.send(message)
+
+    async def act(self, websocket):
+        """Walk around and chat until the swarm stops; every move is also a heartbeat"""
+        while not self.stop.is_set():
+            await asyncio.sleep(random.expovariate(1 / self.args.move_interval))
+            self.x += random.uniform(-1, 1)
+            self.y += random.uniform(-1, 1)
+            await self.send(websocket, move_message(self.x, self.y))
+
+            if random.random() < self.args.chat_probability:
+                scope = "space" if random.random() < self.args.announce_probability else "nearby"
+                await self.send(websocket, chat_message(f"{PING_PREFIX}{time.monotonic()}", scope))
+
+    async def receive(self, websocket):
+        async for frame in websocket:
+            received_at = time.monotonic()
+            self.stats.frames_received += 1
+            self.stats.bytes_received += len(frame)
+            for event in iter_events(frame):
+                self.stats.events_received += 1
+                text = event.get("text", "")
+                if event.get("type") == "chat" and text.startswith(PING_PREFIX):
+                    self.stats.chat_latencies.append(received_at - float(text[len(PING_PREFIX):]))
+
+async def run_swarm(args):
+    stats = SwarmStats()
+    stop = asyncio.Event()
+    space_ids = [int(space_id) for space_id in args.spaces.split(",")]
+    limits = httpx.Limits(max_connections=args.http_connections)
+
+    usage_before = read_process_usage(args.server_pid) if args.server_pid else None
+    started = time.monotonic()
+    async with httpx.AsyncClient(base_url=args.server, limits=limits, timeout=30.0) as http:
+        tasks = []
+        for n in range(args.bots):
+            bot = Bot(args.first_id + n, space_ids[n % len(space_ids)], args, http, stats, stop)
+            tasks.append(asyncio.ensure_future(bot.run()))
+            await asyncio.sleep(1 / args.spawn_rate)
+        ramp_up = time.monotonic() - started
+
+        # Only the steady state counts towards the measurements
+        stats.reset_traffic()
+        measure_started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        duration = time.monotonic() - measure_started
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    report = stats.summary(args.bots, duration)
+    report["ramp_up_s"] = round(ramp_up, 2)
+    if usage_before:
+        cpu_after, rss_after = read_process_usage(args.server_pid)
+        total = time.monotonic() - started
+        report["server"] = {
+            "cpu_percent": round((cpu_after - usage_before[0]) / total * 100, 1),
+            "rss_mb": round(rss_after / 2 ** 20, 1),
+            "rss_growth_mb": round((rss_after - usage_before[1]) / 2 ** 20, 1)
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a swarm of headless Kitaverse bots")
+    parser.add_argument("--server", default=DEFAULT_SERVER_URL)
+    parser.add_argument("--bots", type=int, default=100)
+    parser.add_argument("--spaces", default="1,2,3", help="Comma-separated space ids to spread bots over")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to measure after ramp-up")
+    parser.add_argument("--spawn-rate", type=float, default=200, help="Bots started per second")
+    parser.add_argument("--move-interval", type=float, default=0.5, help="Mean seconds between moves")
+    parser.add_argument("--chat-probability", type=float, default=0.05, help="Chance of chatting per move")
+    parser.add_argument("--announce-probability", type=float, default=0.05, help="Share of chats sent to the whole space")
+    parser.add_argument("--area", type=float, default=50, help="Half-width of the area bots start in")
+    parser.add_argument("--first-id", type=int, default=100000, help="User id of the first bot")
+    parser.add_argument("--http-connections", type=int, default=100)
+    parser.add_argument("--server-pid", type=int, help="Local server process to sample CPU and memory from")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    report = asyncio.run(run_swarm(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
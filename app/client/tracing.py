@@ -0,0 +1,129 @@
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import platform
+import time
+
+# Kitaverse client tracing
+#
+# The bookkeeping behind the client profiler (profiler.py): spans for frames,
+# model loads, scene rebuilds and server round trips, and their export in
+# Chrome trace-event format (open in chrome://tracing or ui.perfetto.dev) so
+# runs on different phone models can be compared side by side. Nothing here
+# needs Panda3D; the profiler adds the overlay and schedules the phase tasks.
+#
+# Frame phases are measured with tasks around Panda3D's igLoop (sort 50),
+# which renders the frame:
+#   frame start (sort -1000) -> update -> before render (49) -> render -> after render (51)
+
+MAX_TRACE_EVENTS = 50000
+
+class TraceRecorder:
+    """Collects client timings and exports them as a trace"""
+
+    def __init__(self, client_name, trace_dir="traces"):
+        self.client_name = client_name
+        self.trace_dir = trace_dir
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=MAX_TRACE_EVENTS)
+        self.frame_start = None
+        self.render_start = None
+        self.network_time = 0.0
+
+        # Rolling values for the overlay
+        self.frame_times = deque(maxlen=120)
+        self.render_times = deque(maxlen=120)
+        self.round_trips = deque(maxlen=50)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.last_scene_load = 0.0
+
+    def _micros(self, seconds):
+        return round((seconds - self.origin) * 1e6, 1)
+
+    def add_span(self, name, category, start, end, args=None):
+        """Record a completed span (times from time.perf_counter)"""
+        event = {"name": name, "cat": category, "ph": "X", "pid": 1, "tid": 1,
+                 "ts": self._micros(start), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextmanager
+    def measure(self, name, category="scene_load"):
+        """Time a block of code as a span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.add_span(name, category, start, end)
+            if category == "scene_load":
+                self.last_scene_load = end - start
+
+    def instrument_loader(self, loader):
+        """Record every loadModel call, which blocks the frame it runs in"""
+        load_model = loader.loadModel
+
+        def timed_load_model(model_path, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return load_model(model_path, *args, **kwargs)
+            finally:
+                self.add_span("loadModel", "model_load", start, time.perf_counter(),
+                              {"path": str(model_path)})
+
+        loader.loadModel = timed_load_model
+
+    def record_request(self, method, path, seconds, bytes_sent, bytes_received, status):
+        """Observer for KitaverseConnection requests"""
+        end = time.perf_counter()
+        self.network_time += seconds
+        self.round_trips.append(seconds)
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.add_span(f"{method} {path}", "network", end - seconds, end,
+                      {"bytes_sent": bytes_sent, "bytes_received": bytes_received, "status": status})
+
+    def _on_frame_start(self, task):
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.frame_times.append(now - self.frame_start)
+            self.add_span("frame", "frame", self.frame_start, now,
+                          {"network_wait_ms": round(self.network_time * 1000, 2)})
+        self.frame_start = now
+        self.network_time = 0.0
+        return task.cont
+
+    def _on_before_render(self, task):
+        self.render_start = time.perf_counter()
+        if self.frame_start is not None:
+            self.add_span("update", "frame", self.frame_start, self.render_start)
+        return task.cont
+
+    def _on_after_render(self, task):
+        now = time.perf_counter()
+        if self.render_start is not None:
+            self.render_times.append(now - self.render_start)
+            self.add_span("render", "frame", self.render_start, now)
+        self.after_render(now)
+        return task.cont
+
+    def after_render(self, now):
+        """Called once a frame has rendered, e.g. to refresh an overlay"""
+
+    def device_info(self):
+        return {"client": self.client_name, "platform": platform.platform(),
+                "python": platform.python_version()}
+
+    def export(self, path=None):
+        """Write the recorded trace and return its path"""
+        if path is None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            stamp = time.strftime("%Y%m%d_%H%M%S")
+            path = os.path.join(self.trace_dir, f"kitaverse-{self.client_name}-{stamp}.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": list(self.events), "displayTimeUnit": "ms",
+                       "metadata": self.device_info()}, f)
+        return path
@@ -0,0 +1,133 @@
+import argparse
+import hashlib
+import json
+import os
+import urllib.request
+
+from chunking import chunk_hash, split_chunks
+from protocol import DEFAULT_SERVER_URL, KitaverseConnection
+
+# Kitaverse updater
+#
+# Brings an installed copy of Kitaverse up to the version published by the
+# server (see package.py) while downloading as little as possible: files are
+# compared by content hash, and changed files are rebuilt from the chunks of
+# the old copy plus only the chunks that are new.
+
+STATE_FILE = ".kitaverse-update.json"
+
+class UpdateError(Exception):
+    """Raised when a download or a manifest path cannot be used"""
+
+class Updater:
+    """Differential updater for one install directory"""
+
+    def __init__(self, server_url=DEFAULT_SERVER_URL, install_dir="."):
+        self.connection = KitaverseConnection(server_url)
+        self.install_dir = install_dir
+        self.bytes_downloaded = 0
+        self.bytes_reused = 0
+
+    def install_path(self, relative_path):
+        """Where a manifest path is installed; paths leaving install_dir are refused"""
+        root = os.path.realpath(self.install_dir)
+        path = os.path.realpath(os.path.join(root, relative_path))
+        if path == root or os.path.commonpath([root, path]) != root:
+            raise UpdateError(f"{relative_path!r} is outside the install directory")
+        return path
+
+    def load_state(self):
+        try:
+            with open(os.path.join(self.install_dir, STATE_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"version": None, "files": {}}
+
+    def save_state(self, manifest):
+        with open(os.path.join(self.install_dir, STATE_FILE), "w") as f:
+            json.dump(manifest, f)
+
+    def download_chunk(self, digest):
+        url = f"{self.connection.server_url}/updates/chunks/{digest}"
+        data = urllib.request.urlopen(url).read()
+        if chunk_hash(data) != digest:
+            raise UpdateError(f"Chunk {digest} is corrupt")
+        self.bytes_downloaded += len(data)
+        return data
+
+    def local_chunks(self, path):
+        """Chunks of the currently installed copy of a file"""
+        try:
+            with open(path, "rb") as f:
+                return dict(split_chunks(f.read()))
+        except OSError:
+            return {}
+
+    def update_file(self, relative_path, entry):
+        """Rebuild one file from reused and downloaded chunks"""
+        path = self.install_path(relative_path)
+        available = self.local_chunks(path)
+        parts = []
+        for digest in entry["chunks"]:
+            if digest in available:
+                self.bytes_reused += len(available[digest])
+            else:
+                available[digest] = self.download_chunk(digest)
+            parts.append(available[digest])
+        data = b"".join(parts)
+        if hashlib.sha256(data).hexdigest() != entry["hash"]:
+            raise UpdateError(f"{relative_path} does not match the manifest")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = path + ".download"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def file_is_current(self, path, entry):
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"]:
+            return False
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest() == entry["hash"]
+
+    def run(self):
+        """Update the install directory; returns the number of changed files"""
+        manifest = self.connection.request("/updates/manifest")
+        state = self.load_state()
+        if state["version"] == manifest["version"]:
+            return 0
+
+        # Check every path before touching anything
+        paths = {relative_path: self.install_path(relative_path)
+                 for relative_path in set(manifest["files"]) | set(state["files"])}
+
+        changed = 0
+        for relative_path, entry in sorted(manifest["files"].items()):
+            if self.file_is_current(paths[relative_path], entry):
+                continue
+            self.update_file(relative_path, entry)
+            changed += 1
+
+        # Remove files the previous version installed and the new one dropped
+        for relative_path in set(state["files"]) - set(manifest["files"]):
+            path = paths[relative_path]
+            if os.path.exists(path):
+                os.remove(path)
+                changed += 1
+
+        self.save_state(manifest)
+        return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Update Kitaverse from the server")
+    parser.add_argument("--server", default=DEFAULT_SERVER_URL)
+    parser.add_argument("--install-dir", default=".")
+    args = parser.parse_args()
+
+    updater = Updater(args.server, args.install_dir)
+    changed = updater.run()
+    print(f"{changed} files updated: downloaded {updater.bytes_downloaded} bytes, "
+          f"reused {updater.bytes_reused} bytes already on this device")
+
+if __name__ == "__main__":
+    main()
@@ -1,135 +1,458 @@
 # Kitaverse Packaging Script
 
 import os
+import json
 import shutil
+import hashlib
 import zipfile
-import datetime
+import subprocess
+import sys
 
-def create_distribution():
-    \"\"\"Create a distribution package for Kitaverse\"\"\"
-    print(\"Creating Kitaverse distribution package...\")
+# Content-defined chunking is shared with the client updater
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "client"))
+from chunking import split_chunks
+
+# Panda3D is only needed to convert models and resize textures
+try:
+    from panda3d.core import (Filename, Loader, LoaderOptions, NodePath, PNMImage,
+                              getModelPath, loadPrcFileData)
+    HAS_PANDA3D = True
+except ImportError:
+    HAS_PANDA3D = False
+
+# Source models and textures, laid out like the paths clients load
+# (e.g. assets/models/furniture/round_table.egg for models/furniture/round_table.bam).
+# Models should name their textures relative to this directory
+# (textures/wood.png), which is how they are stored in the converted .bam files.
+ASSET_SOURCE_DIR = "assets"
+SPACES_FILE = "app/client/spaces.json"
+MODEL_SOURCE_EXTENSIONS = [".bam", ".egg", ".egg.pz", ".gltf", ".glb", ".obj"]
+TEXTURE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".tga", ".bmp"]
+
+DIST_DIR = "dist"
+BUILD_DIR = os.path.join(DIST_DIR, "kitaverse")
+UPDATES_DIR = os.path.join(DIST_DIR, "updates")
+BUILD_CACHE_FILE = os.path.join(DIST_DIR, "build-cache.json")
+
+# Largest texture side per device tier ("textures_quality" in config.json)
+TEXTURE_TIERS = {
+    "low": 256,
+    "medium": 512,
+    "high": 1024
+}
+
+def file_hash(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def referenced_models(spaces_file=SPACES_FILE):
+    """Model paths referenced by the space definitions"""
+    with open(spaces_file, "r") as f:
+        definitions = json.load(f)
+    models = set()
+    for space in definitions["spaces"]:
+        models.update(space.get("models", {}).values())
+    return sorted(models)
+
+def find_model_source(model_path):
+    """Find the source file for a model path such as models/x/y.bam"""
+    stem = os.path.splitext(os.path.join(ASSET_SOURCE_DIR, model_path))[0]
+    for extension in MODEL_SOURCE_EXTENSIONS:
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return None
+
+def convert_model(source, target):
+    """Convert a model to .bam; returns False if no converter is available"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if source.endswith(".bam"):
+        shutil.copy2(source, target)
+        return True
+    if HAS_PANDA3D:
+        loadPrcFileData("", "bam-texture-mode unchanged")
+        getModelPath().prependDirectory(Filename.fromOsSpecific(os.path.abspath(ASSET_SOURCE_DIR)))
+        options = LoaderOptions(LoaderOptions.LF_no_cache | LoaderOptions.LF_report_errors)
+        node = Loader.getGlobalPtr().loadSync(Filename.fromOsSpecific(source), options)
+        return node is not None and NodePath(node).writeBamFile(Filename.fromOsSpecific(target))
+    egg2bam = shutil.which("egg2bam")
+    if egg2bam and source.endswith(".egg"):
+        return subprocess.run([egg2bam, "-o", target, source]).returncode == 0
+    return False
+
+def resize_texture(source, target, max_size):
+    """Scale a texture down to fit max_size, keeping power-of-two sides.
+
+    The format stays the same so paths stored in .bam files remain valid.
+    Returns True once the target is written.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not HAS_PANDA3D:
+        shutil.copy2(source, target)
+        return True
+    image = PNMImage()
+    if not image.read(Filename.fromOsSpecific(source)):
+        shutil.copy2(source, target)
+        return True
+    width, height = image.getXSize(), image.getYSize()
+    scale = min(1.0, max_size / max(width, height))
+    new_width = 1 << max(0, int(width * scale).bit_length() - 1)
+    new_height = 1 << max(0, int(height * scale).bit_length() - 1)
+    if (new_width, new_height) == (width, height):
+        shutil.copy2(source, target)
+        return True
+    resized = PNMImage(new_width, new_height, image.getNumChannels(), image.getMaxval())
+    resized.gaussianFilterFrom(1.0, image)
+    return resized.write(Filename.fromOsSpecific(target))
+
+def store_object(path, objects_dir):
+    """Add a file to the content-addressed store; returns (hash, size, is_new)"""
+    digest = file_hash(path)
+    target = os.path.join(objects_dir, digest[:2], digest)
+    if os.path.exists(target):
+        return digest, os.path.getsize(target), False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(path, target)
+    return digest, os.path.getsize(target), True
+
+def model_textures(object_path, texture_paths):
+    """Textures a converted model refers to, out of the bundled ones"""
+    with open(object_path, "rb") as f:
+        data = f.read()
+    return sorted(path for path in texture_paths if path.encode("utf-8") in data)
+
+def build_asset_bundle(bundle_dir, cache=None):
+    """Build the content-addressed asset bundle for all device tiers.
+
+    Produces bundle_dir/objects/<aa>/<sha256> and bundle_dir/manifest.json,
+    which maps each tier's logical paths (models/..., textures/...) to the
+    object holding them. Model entries also list the textures the model uses.
+    Identical files across tiers or paths are stored once.
+    With a build cache, sources that have not changed since the last build are
+    not converted or resized again.
+    """
+    print("Building asset bundle...")
+    if cache is None:
+        cache = {"files": {}, "chunks": {}, "assets": {}}
+    os.makedirs(bundle_dir, exist_ok=True)
+    objects_dir = os.path.join(bundle_dir, "objects")
+    staging_dir = os.path.join(bundle_dir, "staging")
+    manifest = {"version": 1, "tiers": {tier: {} for tier in TEXTURE_TIERS}}
+    stats = {"built": 0, "reused": 0, "stored_bytes": 0, "logical_bytes": 0}
     
-    # Create distribution directory
-    dist_dir = \"dist\"
-    if not os.path.exists(dist_dir):
-        os.makedirs(dist_dir)
+    def add_output(logical_path, source, step, tiers, build):
+        """Build (or reuse) one output and list it under the given tiers"""
+        key = f"{cached_file_hash(source, cache)}:{step}"
+        digest = cache["assets"].get(key)
+        object_path = os.path.join(objects_dir, digest[:2], digest) if digest else None
+        if object_path and os.path.exists(object_path):
+            size = os.path.getsize(object_path)
+            stats["reused"] += 1
+        else:
+            staged = os.path.join(staging_dir, step, logical_path)
+            if not build(source, staged):
+                return False
+            digest, size, is_new = store_object(staged, objects_dir)
+            cache["assets"][key] = digest
+            stats["built"] += 1
+            if is_new:
+                stats["stored_bytes"] += size
+        for tier in tiers:
+            manifest["tiers"][tier][logical_path] = {"hash": digest, "size": size}
+            stats["logical_bytes"] += size
+        return True
+    
+    # Models are tier-independent: convert each referenced model once
+    model_count = 0
+    for model_path in referenced_models():
+        source = find_model_source(model_path)
+        if not source:
+            print(f"  WARNING: no source for {model_path} in {ASSET_SOURCE_DIR}/")
+        elif add_output(model_path, source, "bam", TEXTURE_TIERS, convert_model):
+            model_count += 1
+        else:
+            print(f"  WARNING: cannot convert {source} (install panda3d)")
+    
+    textures = []
+    if os.path.isdir(ASSET_SOURCE_DIR):
+        for root, dirs, files in os.walk(ASSET_SOURCE_DIR):
+            for file in files:
+                if os.path.splitext(file)[1].lower() in TEXTURE_EXTENSIONS:
+                    textures.append(os.path.relpath(os.path.join(root, file), ASSET_SOURCE_DIR))
+    
+    for tier, max_size in TEXTURE_TIERS.items():
+        for texture_path in textures:
+            add_output(texture_path.replace(os.sep, "/"), os.path.join(ASSET_SOURCE_DIR, texture_path),
+                       tier, [tier], lambda source, target: resize_texture(source, target, max_size))
+    
+    # Record which textures each model loads, so clients fetch only those
+    texture_paths = [texture_path.replace(os.sep, "/") for texture_path in textures]
+    uses = {}
+    for entries in manifest["tiers"].values():
+        for logical_path, entry in entries.items():
+            if logical_path.startswith("models/"):
+                digest = entry["hash"]
+                if digest not in uses:
+                    uses[digest] = model_textures(os.path.join(objects_dir, digest[:2], digest), texture_paths)
+                entry["textures"] = uses[digest]
     
-    # Create package name with timestamp
-    timestamp = datetime.datetime.now().strftime(\"%Y%m%d_%H%M%S\")
-    package_name = f\"kitaverse_{timestamp}\"
-    package_dir = os.path.join(dist_dir, package_name)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    write_if_changed(os.path.join(bundle_dir, "manifest.json"), json.dumps(manifest, indent=2, sort_keys=True))
     
-    # Create package directory structure
-    os.makedirs(package_dir)
-    os.makedirs(os.path.join(package_dir, \"app\"))
-    os.makedirs(os.path.join(package_dir, \"app\", \"backend\"))
-    os.makedirs(os.path.join(package_dir, \"app\", \"client\"))
+    print(f"  {model_count} models, {len(textures)} textures: {stats['built']} built, "
+          f"{stats['reused']} reused, {stats['stored_bytes']} new bytes stored "
+          f"for {stats['logical_bytes']} bytes across tiers")
+    return manifest
+
+def load_build_cache():
+    """Hashes and chunk lists remembered from previous builds"""
+    try:
+        with open(BUILD_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "chunks": {}, "assets": {}}
+
+def save_build_cache(cache):
+    with open(BUILD_CACHE_FILE, "w") as f:
+        json.dump(cache, f)
+
+def cached_file_hash(path, cache):
+    """Hash a file, reusing the previous result while size and mtime match"""
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = cache["files"].get(key)
+    if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+        return entry[2]
+    digest = file_hash(path)
+    cache["files"][key] = [stat.st_mtime_ns, stat.st_size, digest]
+    return digest
+
+def sync_file(source, target, cache):
+    """Copy a file into the build tree unless the target already matches"""
+    if os.path.exists(target) and cached_file_hash(target, cache) == cached_file_hash(source, cache):
+        return False
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(source, target)
+    return True
+
+def write_if_changed(path, content):
+    """Write a generated text file unless it already has this content"""
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return True
+
+def publish_update(build_dir, cache):
+    """Split the build into chunks and write the update manifest.
+
+    Only chunks not published before are written, and a file's chunk list is
+    reused while its content hash is unchanged. The version is derived from
+    the content, so an unchanged build keeps its version.
+    """
+    chunks_dir = os.path.join(UPDATES_DIR, "chunks")
+    os.makedirs(chunks_dir, exist_ok=True)
+    files = {}
+    new_chunks = 0
+    for root, dirs, names in os.walk(build_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            digest = cached_file_hash(path, cache)
+            chunk_list = cache["chunks"].get(digest)
+            missing = chunk_list is None or any(
+                not os.path.exists(os.path.join(chunks_dir, h[:2], h)) for h in chunk_list)
+            if missing:
+                with open(path, "rb") as f:
+                    chunks = split_chunks(f.read())
+                for chunk_digest, data in chunks:
+                    chunk_path = os.path.join(chunks_dir, chunk_digest[:2], chunk_digest)
+                    if not os.path.exists(chunk_path):
+                        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                        with open(chunk_path, "wb") as f:
+                            f.write(data)
+                        new_chunks += 1
+                chunk_list = [chunk_digest for chunk_digest, _ in chunks]
+                cache["chunks"][digest] = chunk_list
+            relative = os.path.relpath(path, build_dir).replace(os.sep, "/")
+            files[relative] = {"hash": digest, "size": os.path.getsize(path), "chunks": chunk_list}
+    
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    manifest = {"version": version, "files": files}
+    write_if_changed(os.path.join(UPDATES_DIR, "manifest.json"), json.dumps(manifest, indent=2, sort_keys=True))
+    print(f"Update {version}: {len(files)} files, {new_chunks} new chunks")
+    return manifest
+
+def create_distribution():
+    """Create a distribution package for Kitaverse.
+
+    The build tree in dist/kitaverse is kept between runs and only files whose
+    content changed are copied. The ZIP is named after the content version and
+    only rebuilt when that version is new.
+    """
+    print("Creating Kitaverse distribution package...")
+    
+    # Create distribution directory
+    if not os.path.exists(DIST_DIR):
+        os.makedirs(DIST_DIR)
+    cache = load_build_cache()
+    package_dir = BUILD_DIR
+    expected = set()
+    changed = 0
     
     # Copy essential files
     files_to_copy = [
-        \"README.md\",
-        \"requirements.txt\",
-        \"Dockerfile\",
-        \"start_server.bat\",
-        \"test_kitaverse.py\"
+        "README.md",
+        "requirements.txt",
+        "Dockerfile",
+        "start_server.bat",
+        "test_kitaverse.py"
     ]
     
     for file in files_to_copy:
         if os.path.exists(file):
-            shutil.copy2(file, package_dir)
+            target_path = os.path.join(package_dir, file)
+            expected.add(target_path)
+            changed += sync_file(file, target_path, cache)
     
     # Copy backend files
     backend_files = [
-        \"app/backend/main.py\",
-        \"app/backend/README.md\"
+        "app/backend/main.py",
+        "app/backend/admission.py",
+        "app/backend/assets.py",
+        "app/backend/bench_compression.py",
+        "app/backend/compression.py",
+        "app/backend/concurrency.py",
+        "app/backend/definitions.py",
+        "app/backend/hub.py",
+        "app/backend/launcher.py",
+        "app/backend/messaging.py",
+        "app/backend/occupancy.py",
+        "app/backend/presence.py",
+        "app/backend/ratelimit.py",
+        "app/backend/recording.py",
+        "app/backend/replay.py",
+        "app/backend/router.py",
+        "app/backend/server.json",
+        "app/backend/shards.json",
+        "app/backend/snapshots.py",
+        "app/backend/startup.py",
+        "app/backend/README.md"
     ]
     
-    for file in backend_files:
-        if os.path.exists(file):
-            target_path = os.path.join(package_dir, file)
-            os.makedirs(os.path.dirname(target_path), exist_ok=True)
-            shutil.copy2(file, target_path)
-    
     # Copy client files
     client_files = [
-        \"app/client/main.py\",
-        \"app/client/mobile.py\",
-        \"app/client/index.html\",
-        \"app/client/README.md\",
-        \"app/client/config.json\",
-        \"app/client/config_optimized.prc\",
-        \"app/client/spaces.json\"
+        "app/client/main.py",
+        "app/client/mobile.py",
+        "app/client/asset_cache.py",
+        "app/client/chunking.py",
+        "app/client/client_common.py",
+        "app/client/pool.py",
+        "app/client/profiler.py",
+        "app/client/protocol.py",
+        "app/client/swarm.py",
+        "app/client/tracing.py",
+        "app/client/updater.py",
+        "app/client/index.html",
+        "app/client/README.md",
+        "app/client/config.json",
+        "app/client/config_optimized.prc",
+        "app/client/spaces.json"
     ]
     
-    for file in client_files:
+    for file in backend_files + client_files:
         if os.path.exists(file):
             target_path = os.path.join(package_dir, file)
-            os.makedirs(os.path.dirname(target_path), exist_ok=True)
-            shutil.copy2(file, target_path)
+            expected.add(target_path)
+            changed += sync_file(file, target_path, cache)
     
     # Create a simple installation script
-    install_script = \"\"\"#!/bin/bash
+    install_script = """#!/bin/bash
 # Kitaverse Installation Script
 
-echo \"Installing Kitaverse dependencies...\"
+echo "Installing Kitaverse dependencies..."
 pip install -r requirements.txt
 
-echo \"Kitaverse installation complete!\"
-echo \"To run Kitaverse:\"
-echo \"1. Start the backend server: python app/backend/main.py\"
-echo \"2. Open app/client/index.html in a web browser\"
-\"\"\"
+echo "Kitaverse installation complete!"
+echo "To run Kitaverse:"
+echo "1. Start the backend server: python app/backend/launcher.py"
+echo "2. Open app/client/index.html in a web browser"
+"""
     
-    with open(os.path.join(package_dir, \"install.sh\"), \"w\") as f:
-        f.write(install_script)
+    expected.add(os.path.join(package_dir, "install.sh"))
+    changed += write_if_changed(os.path.join(package_dir, "install.sh"), install_script)
     
     # Create a Windows installation batch file
-    install_batch = \"\"\"@echo off
+    install_batch = """@echo off
 echo Installing Kitaverse dependencies...
 pip install -r requirements.txt
 
 echo Kitaverse installation complete!
 echo To run Kitaverse:
-echo 1. Start the backend server: python app/backend/main.py
+echo 1. Start the backend server: python app/backend/launcher.py
 echo 2. Open app/client/index.html in a web browser
 pause
-\"\"\"
+"""
     
-    with open(os.path.join(package_dir, \"install.bat\"), \"w\") as f:
-        f.write(install_batch)
+    expected.add(os.path.join(package_dir, "install.bat"))
+    changed += write_if_changed(os.path.join(package_dir, "install.bat"), install_batch)
     
-    # Create ZIP archive
-    zip_filename = f\"{package_name}.zip\"
-    zip_path = os.path.join(dist_dir, zip_filename)
+    # Prepare models and textures for download
+    bundle_dir = os.path.join(package_dir, "assets")
+    manifest = build_asset_bundle(bundle_dir, cache)
+    expected.add(os.path.join(bundle_dir, "manifest.json"))
+    for tier in manifest["tiers"].values():
+        for entry in tier.values():
+            expected.add(os.path.join(bundle_dir, "objects", entry["hash"][:2], entry["hash"]))
     
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(package_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arc_path = os.path.relpath(file_path, package_dir)
-                zipf.write(file_path, os.path.join(package_name, arc_path))
+    # Remove files that are no longer part of the distribution
+    for root, dirs, files in os.walk(package_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if file_path not in expected:
+                os.remove(file_path)
+                changed += 1
+    print(f"{changed} files changed since the last build")
+    
+    # Publish chunks for differential updates
+    update = publish_update(package_dir, cache)
+    save_build_cache(cache)
+    
+    # Create ZIP archive for first-time installs
+    package_name = f"kitaverse_{update['version']}"
+    zip_path = os.path.join(DIST_DIR, f"{package_name}.zip")
     
-    # Clean up temporary directory
-    shutil.rmtree(package_dir)
+    if not os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for root, dirs, files in os.walk(package_dir):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    arc_path = os.path.relpath(file_path, package_dir)
+                    zipf.write(file_path, os.path.join(package_name, arc_path))
     
-    print(f\"Distribution package created: {zip_path}\")
+    print(f"Distribution package created: {zip_path}")
     return zip_path
 
 def main():
-    \"\"\"Main function\"\"\"
-    print(\"Kitaverse Packaging Tool\")
-    print(\"=\" * 30)
+    """Main function"""
+    print("Kitaverse Packaging Tool")
+    print("=" * 30)
     
     try:
         package_path = create_distribution()
-        print(\"\\nPackage created successfully!\")
-        print(f\"Package location: {package_path}\")
-        print(\"\\nTo distribute Kitaverse:\")
-        print(\"1. Share the ZIP file with users\")
-        print(\"2. Users can extract and run install.sh (Linux/Mac) or install.bat (Windows)\")
-        print(\"3. Follow the instructions to start the server and open the client\")
+        print("\nPackage created successfully!")
+        print(f"Package location: {package_path}")
+        print("\nTo distribute Kitaverse:")
+        print("1. Share the ZIP file with users")
+        print("2. Users can extract and run install.sh (Linux/Mac) or install.bat (Windows)")
+        print("3. Follow the instructions to start the server and open the client")
     except Exception as e:
-        print(f\"Error creating package: {e}\")
+        print(f"Error creating package: {e}")
 
-if __name__ == \"__main__\":
+if __name__ == "__main__":
     main()
\ No newline at end of file
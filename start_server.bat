@@ -1,4 +1,4 @@
 @echo off
 echo Starting Kitaverse Server...
-python app/backend/main.py
+python app/backend/launcher.py
 pause
\ No newline at end of file
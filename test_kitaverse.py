@@ -1,10 +1,23 @@
 # Kitaverse Test Script
 
 import subprocess
+import importlib
 import time
 import sys
 import os
 
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "backend")
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "client")
+
+def load_backend():
+    """Import a fresh copy of the backend with empty in-memory state"""
+    # Both apps have a main.py: the backend must come first
+    if BACKEND_DIR in sys.path:
+        sys.path.remove(BACKEND_DIR)
+    sys.path.insert(0, BACKEND_DIR)
+    import main as backend
+    return importlib.reload(backend)
+
 def test_setup():
     """Test if the environment is set up correctly"""
     print("Testing Kitaverse setup...")
@@ -47,6 +60,868 @@ def test_backend():
         print(f"ERROR: Missing backend dependencies: {e}")
         return False
 
+def test_space_overflow():
+    """Test that a full space spills over into a numbered overflow instance"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    client = TestClient(backend.app)
+    backend.find_space(1).capacity = 1
+    
+    first = client.post("/spaces/1/enter", json={"id": 1, "name": "Ani"}).json()
+    second = client.post("/spaces/1/enter", json={"id": 2, "name": "Budi"}).json()
+    assert first["space"]["id"] == 1
+    assert second["space"]["name"] == "Community Center #2"
+    assert second["space"]["parent_id"] == 1
+    
+    # Entering a full overflow instance directly spills over from the original space
+    third = client.post("/spaces/1001/enter", json={"id": 3, "name": "Citra"}).json()
+    fourth = client.post("/spaces/1/enter", json={"id": 4, "name": "Dewi"}).json()
+    assert (third["space"]["id"], third["space"]["parent_id"]) == (2001, 1)
+    assert (fourth["space"]["id"], fourth["space"]["parent_id"]) == (3001, 1)
+    ids = [s.id for s in backend.spaces]
+    assert len(ids) == len(set(ids))
+    
+    # The overflow instance disappears once it is empty again
+    overflow_id = second["space"]["id"]
+    assert client.post(f"/spaces/{overflow_id}/leave", params={"user_id": 2}).status_code == 200
+    assert client.get(f"/spaces/{overflow_id}").status_code == 404
+
+def test_router_routing():
+    """Test that the router maps spaces and overflow instances to workers"""
+    import router
+    
+    table = router.build_routing_table({"workers": [
+        {"port": 9001, "spaces": [1]},
+        {"port": 9002, "spaces": [2, 3]}
+    ]})
+    assert router.worker_for(1, table) == "http://127.0.0.1:9001"
+    assert router.worker_for(3, table) == "http://127.0.0.1:9002"
+    assert router.worker_for(2 + 2 * router.OVERFLOW_ID_STRIDE, table) == "http://127.0.0.1:9002"
+
+def test_timer_wheel():
+    """Test that the presence wheel expires only keys without heartbeats"""
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    from presence import TimerWheel
+    
+    now = [0.0]
+    wheel = TimerWheel(timeout=10, tick=1, slots=8, clock=lambda: now[0])
+    wheel.touch("ani")
+    wheel.touch("budi")
+    
+    now[0] = 6
+    assert wheel.advance() == []
+    wheel.touch("budi")  # Heartbeat pushes budi's deadline to 16
+    
+    now[0] = 11
+    assert wheel.advance() == ["ani"]
+    now[0] = 40  # Long stall: more than one lap of the wheel
+    assert wheel.advance() == ["budi"]
+    assert len(wheel) == 0
+
+def test_presence_expiry():
+    """Test that a silent user is reaped and the space is told"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    now = [0.0]
+    backend.presence = backend.TimerWheel(timeout=5, clock=lambda: now[0])
+    
+    with TestClient(backend.app) as client:
+        client.post("/spaces/2/enter", json={"id": 1, "name": "Ani"})
+        client.post("/spaces/2/enter", json={"id": 2, "name": "Budi"})
+        with client.websocket_connect("/spaces/2/ws?user_id=1") as websocket:
+            now[0] = 4
+            assert client.post("/spaces/2/heartbeat", params={"user_id": 1}).status_code == 200
+            now[0] = 7  # Budi's last sign of life was at 0
+            assert websocket.receive_json() == {"type": "leave", "user_id": 2, "reason": "timeout"}
+        assert backend.find_space(2).current_users == 1
+
+def test_rate_limiting():
+    """Test that REST clients get 429 once their token bucket is empty"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    now = [0.0]
+    backend.rest_limiter = backend.RateLimiter(rate=1, burst=2, clock=lambda: now[0])
+    client = TestClient(backend.app)
+    
+    user = {"id": 1, "name": "Ani"}
+    assert client.post("/spaces/1/enter", json=user).status_code == 200
+    assert client.post("/spaces/1/enter", json=user).status_code == 200
+    rejected = client.post("/spaces/1/enter", json=user)
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "1"
+    
+    now[0] = 1  # One token refilled
+    assert client.post("/spaces/1/enter", json=user).status_code == 200
+    assert client.get("/stats/backpressure").json()["counters"] == {"rest_rejected": 1}
+    
+    # Behind the router, each client forwarded by it has its own bucket...
+    proxied = TestClient(backend.app, client=("127.0.0.1", 40000))
+    for address in ("203.0.113.7", "203.0.113.8"):
+        assert proxied.post("/spaces/1/enter", json=user,
+                            headers={"X-Forwarded-For": address}).status_code == 200
+    # ...but a client talking to the worker directly cannot choose one
+    assert client.post("/spaces/1/enter", json=user, headers={"X-Forwarded-For": "203.0.113.9"}).status_code == 429
+
+def test_router_forwarding(monkeypatch):
+    """Test that the router passes requests on, with the client address it saw"""
+    import httpx
+    from fastapi.testclient import TestClient
+    import router
+    
+    seen = []
+    def worker(request):
+        seen.append(request.headers.get("x-forwarded-for"))
+        return httpx.Response(200, headers={"Content-Type": "application/json"},
+                              stream=httpx.ByteStream(b'{"users": []}'))
+    monkeypatch.setattr(router, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(worker)))
+    monkeypatch.setattr(router, "routing_table", {2: "http://127.0.0.1:9002"})
+    monkeypatch.setattr(router, "worker_urls", ["http://127.0.0.1:9002"])
+    client = TestClient(router.app, client=("198.51.100.4", 40000))
+    assert client.get("/spaces/2/users", headers={"X-Forwarded-For": "10.0.0.1"}).status_code == 200
+    assert seen == ["198.51.100.4"]
+    
+    # Files go to a worker, statistics and reloads to all of them
+    assert client.get("/assets/manifest").status_code == 200
+    assert client.get("/updates/manifest").status_code == 200
+    assert client.get("/stats/loop").json() == {"workers": {"http://127.0.0.1:9002": {"users": []}}}
+    assert client.post("/admin/reload-spaces").json()["workers"]["http://127.0.0.1:9002"]["status"] == 200
+
+def test_position_coalescing():
+    """Test that a slow connection only receives the latest position per user"""
+    import asyncio
+    from collections import Counter
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    from hub import Connection
+    
+    class SlowSocket:
+        def __init__(self):
+            self.sent = []
+            self.release = asyncio.Event()
+        
+        async def send_json(self, event):
+            await self.release.wait()
+            self.sent.append(event)
+    
+    async def scenario():
+        stats = Counter()
+        websocket = SlowSocket()
+        connection = Connection(websocket, stats, max_events=2)
+        connection.send({"type": "enter", "user_id": 1})
+        await asyncio.sleep(0)  # The sender is now stuck on the first event
+        for x in range(5):
+            connection.send_position(2, {"type": "position", "user_id": 2, "position": {"x": x}})
+        for user_id in (3, 4, 5):
+            connection.send({"type": "enter", "user_id": user_id})
+        
+        websocket.release.set()
+        while len(connection):
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        connection.close()
+        return websocket.sent, stats
+    
+    sent, stats = asyncio.run(scenario())
+    assert sent[0] == {"type": "enter", "user_id": 1}
+    # Everything queued while the socket was busy goes out as one frame
+    assert len(sent) == 2 and sent[1]["type"] == "batch"
+    assert [e["user_id"] for e in sent[1]["events"]] == [4, 5, 2]
+    assert sent[1]["events"][-1]["position"] == {"x": 4}
+    assert stats == Counter({"positions_coalesced": 4, "events_dropped": 1, "events_batched": 3})
+
+def test_loop_block_detector(caplog):
+    """Test that a handler blocking the event loop is logged with its stack"""
+    import asyncio
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    from concurrency import LoopBlockDetector, SpaceLocks
+    
+    def slow_handler():
+        time.sleep(0.3)  # Blocking call on the loop
+    
+    async def scenario():
+        detector = LoopBlockDetector(threshold=0.05)
+        detector.start()
+        await asyncio.sleep(0.05)
+        slow_handler()
+        await asyncio.sleep(0.1)
+        detector.stop()
+        
+        # Locks for the same space serialize, whatever order they are asked in
+        locks = SpaceLocks()
+        order = []
+        async def change(name, *keys):
+            async with locks.hold(*keys):
+                order.append(name)
+                await asyncio.sleep(0.01)
+                order.append(name)
+        await asyncio.gather(change("a", 1, 2), change("b", 2, 1))
+        return detector, order
+    
+    with caplog.at_level("WARNING", logger="kitaverse"):
+        detector, order = asyncio.run(scenario())
+    assert detector.blocks == 1 and detector.max_block >= 0.2
+    assert "slow_handler" in caplog.text
+    assert order == ["a", "a", "b", "b"]
+
+def test_proximity_chat():
+    """Test that nearby chat only reaches users within the chat radius"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    villagers = [
+        {"id": 1, "name": "Ani", "position": {"x": 0, "y": 0, "z": 0}},
+        {"id": 2, "name": "Budi", "position": {"x": 10, "y": 5, "z": 0}},
+        {"id": 3, "name": "Citra", "position": {"x": 60, "y": 0, "z": 0}}
+    ]
+    with TestClient(backend.app) as client:
+        for villager in villagers:
+            client.post("/spaces/2/enter", json=villager)
+        with client.websocket_connect("/spaces/2/ws?user_id=1") as ani, \
+             client.websocket_connect("/spaces/2/ws?user_id=2") as budi, \
+             client.websocket_connect("/spaces/2/ws?user_id=3") as citra:
+            ani.send_json({"type": "chat", "text": "Fresh mangoes!"})
+            ani.send_json({"type": "chat", "text": "Market closes at six", "scope": "space"})
+            
+            # Budi is nearby and gets both; Citra only the announcement
+            received = []
+            while len(received) < 2:
+                frame = budi.receive_json()
+                received.extend(frame["events"] if frame["type"] == "batch" else [frame])
+            assert [e["text"] for e in received] == ["Fresh mangoes!", "Market closes at six"]
+            assert citra.receive_json()["text"] == "Market closes at six"
+
+def test_occupancy_history():
+    """Test that joins, leaves and samples roll up into minute and hour buckets"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    now = [7200.0]
+    backend.occupancy = backend.OccupancyRecorder(clock=lambda: now[0])
+    client = TestClient(backend.app)
+    backend.find_space(2).capacity = 1
+    
+    client.post("/spaces/2/enter", json={"id": 1, "name": "Ani"})
+    client.post("/spaces/2/enter", json={"id": 2, "name": "Budi"})  # Overflow instance
+    backend.occupancy.sample(backend.occupancy_counts().items())
+    now[0] += 60
+    client.post("/spaces/2/leave", params={"user_id": 1})
+    backend.occupancy.sample(backend.occupancy_counts().items())
+    
+    minutes = client.get("/spaces/2/occupancy", params={"resolution": "minute"}).json()
+    assert minutes["current_users"] == 1
+    assert [(b["start"], b["joins"], b["leaves"], b["peak"], b["average"]) for b in minutes["buckets"]] == [
+        (7200, 2, 0, 2, 2.0), (7260, 0, 1, 1, 1.0)]
+    hours = client.get("/spaces/2/occupancy").json()["buckets"]
+    assert [(b["joins"], b["leaves"], b["peak"], b["average"]) for b in hours] == [(2, 1, 2, 1.5)]
+    assert client.get("/spaces/2/occupancy", params={"resolution": "week"}).status_code == 400
+
+def test_space_hot_reload(tmp_path, monkeypatch, caplog):
+    """Test that edits to the definitions file apply without a restart"""
+    import json
+    from fastapi.testclient import TestClient
+    
+    spaces_file = tmp_path / "spaces.json"
+    definitions = {"spaces": [
+        {"id": 1, "name": "Community Center", "type": "meeting", "description": "Meetings", "capacity": 30},
+        {"id": 2, "name": "Village Market", "type": "market", "description": "Trade", "capacity": 100}
+    ]}
+    spaces_file.write_text(json.dumps(definitions))
+    monkeypatch.setenv("KITAVERSE_SPACES_FILE", str(spaces_file))
+    backend = load_backend()
+    client = TestClient(backend.app)
+    client.post("/spaces/1/enter", json={"id": 1, "name": "Ani"})
+    
+    definitions["spaces"][0]["capacity"] = 40
+    definitions["spaces"][1] = {"id": 4, "name": "School", "type": "meeting", "description": "Lessons"}
+    spaces_file.write_text(json.dumps(definitions))
+    changes = client.post("/admin/reload-spaces").json()["changes"]
+    assert changes == {"added": [4], "updated": [1], "removed": [2]}
+    
+    # Ani is still inside the updated space
+    space = client.get("/spaces/1").json()
+    assert (space["capacity"], space["current_users"]) == (40, 1)
+    assert [s["id"] for s in client.get("/spaces").json()["spaces"]] == [1, 4]
+    
+    # Ids from the overflow range are refused and the running spaces kept
+    spaces_file.write_text(json.dumps({"spaces": definitions["spaces"] + [
+        {"id": 1001, "name": "Annex", "type": "meeting", "description": "Overflow alias"}]}))
+    response = client.post("/admin/reload-spaces")
+    assert response.status_code == 400 and "1001" in response.json()["detail"]
+    assert [s["id"] for s in client.get("/spaces").json()["spaces"]] == [1, 4]
+    spaces_file.write_text(json.dumps(definitions))
+    
+    # A sharded worker only warns about spaces no worker was assigned
+    backend = load_backend()
+    backend.host_spaces({1})
+    definitions["spaces"].append({"id": 5, "name": "Clinic", "type": "meeting", "description": "Health"})
+    with caplog.at_level("WARNING", logger="kitaverse"):
+        assert backend.apply_space_definitions(definitions["spaces"]) == {"added": [], "updated": [], "removed": []}
+        backend.apply_space_definitions(definitions["spaces"])
+    assert [r.getMessage() for r in caplog.records] == [
+        "Space 5 was added to the definitions but is not hosted: restart the router to assign it to a worker"]
+
+def test_admission_control():
+    """Test that capacity drops under load, sheds entries and recovers with headroom"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    client = TestClient(backend.app)
+    for user_id in range(1, 6):
+        client.post("/spaces/1/enter", json={"id": user_id, "name": f"Villager {user_id}"})
+    
+    # Two seconds of a lagging event loop lower the Community Center from 30 to 19
+    for _ in range(2):
+        backend.admission.update(0.2, backend.space_loads())
+    assert backend.admission.capacity(1, 30) == 19
+    decisions = client.get("/stats/admission").json()["decisions"]
+    assert [(d["space_id"], d["from"], d["to"], d["reason"]) for d in decisions if d["space_id"] == 1] == [
+        (1, 30, 24, "loop_lag"), (1, 24, 19, "loop_lag")]
+    
+    # A full space is not overflowed while the server is behind
+    backend.find_space(1).current_users = 19
+    response = client.post("/spaces/1/enter", json={"id": 99, "name": "Eka"})
+    assert response.status_code == 503 and "retry-after" in response.headers
+    assert [s["id"] for s in backend.spaces if s.parent_id == 1] == []
+    
+    # Deep outbound queues only hold back their own space
+    backend.admission.update(0.0, [(1, 30, 19, 0.0), (2, 100, 50, 64.0)])
+    space_stats = {s["id"]: s for s in client.get("/stats/admission").json()["spaces"]}
+    assert space_stats[1]["effective"] == 22 and space_stats[1]["rejected"] == 1
+    assert space_stats[2]["effective"] == 51  # Still going down from 64
+    for _ in range(10):
+        backend.admission.update(0.0, backend.space_loads())
+    assert backend.admission.capacity(1, 30) == 30 and backend.admission.capacity(2, 100) == 100
+
+def test_snapshot_restore(tmp_path, monkeypatch):
+    """Test that memberships and positions survive a restart"""
+    from fastapi.testclient import TestClient
+    
+    monkeypatch.setenv("KITAVERSE_SNAPSHOT_FILE", str(tmp_path / "state.snapshot"))
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        client.post("/spaces/3/enter", json={"id": 7, "name": "Dewi", "position": {"x": 1.5, "y": -2, "z": 0}})
+    
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        users = client.get("/spaces/3/users").json()["users"]
+        assert users == [{"id": 7, "name": "Dewi", "position": {"x": 1.5, "y": -2.0, "z": 0.0}, "space_id": 3}]
+        assert client.get("/spaces/3").json()["current_users"] == 1
+        
+        # Ids and names that do not fit a snapshot are refused at the door
+        assert client.post("/spaces/3/enter", json={"id": 2 ** 64, "name": "Wayan"}).status_code == 422
+        assert client.post("/spaces/3/enter", json={"id": 8, "name": "é" * 40000}).status_code == 422
+    
+    # The encoder leaves out what it cannot store and never splits a character
+    from snapshots import decode_snapshot, encode_snapshot
+    _, records = decode_snapshot(encode_snapshot([(2 ** 64, "Wayan", 3, {}), (8, "é" * 40000, 3, {})]))
+    assert [(user_id, len(name)) for user_id, name, _, _ in records] == [(8, 0xFFFF // 2)]
+
+def test_sharded_snapshots(tmp_path, monkeypatch):
+    """Test that workers sharing a snapshot path each keep their own users"""
+    from fastapi.testclient import TestClient
+    
+    monkeypatch.setenv("KITAVERSE_SNAPSHOT_FILE", str(tmp_path / "state.snapshot"))
+    layout = {1: {1, 3}, 2: {2}}
+    for worker, space_ids in layout.items():
+        backend = load_backend()
+        backend.host_spaces(space_ids)
+        with TestClient(backend.app) as client:
+            for space_id in sorted(space_ids):
+                client.post(f"/spaces/{space_id}/enter", json={"id": worker * 10 + space_id, "name": "Ani"})
+    assert sorted(os.listdir(tmp_path)) == ["state.spaces-1-3.snapshot", "state.spaces-2.snapshot"]
+    
+    for worker, space_ids in layout.items():
+        backend = load_backend()
+        backend.host_spaces(space_ids)
+        with TestClient(backend.app) as client:
+            for space_id in sorted(space_ids):
+                users = client.get(f"/spaces/{space_id}/users").json()["users"]
+                assert [user["id"] for user in users] == [worker * 10 + space_id]
+
+def test_session_recording(tmp_path, monkeypatch):
+    """Test that inbound operations are logged per space in the order they arrived"""
+    from fastapi.testclient import TestClient
+    
+    monkeypatch.setenv("KITAVERSE_RECORD_DIR", str(tmp_path))
+    backend = load_backend()
+    from recording import read_recording
+    with TestClient(backend.app) as client:
+        client.post("/spaces/2/enter", json={"id": 1, "name": "Ani", "position": {"x": 1, "y": 2, "z": 0}})
+        client.get("/spaces/2/users")
+        with client.websocket_connect("/spaces/2/ws?user_id=1") as websocket:
+            websocket.send_json({"type": "move", "position": {"x": 3.5, "y": 2, "z": 0}})
+            websocket.send_json({"type": "chat", "text": "Selamat pagi", "scope": "space"})
+            client.get("/spaces/2/users")  # Give the socket time to handle both messages
+        client.post("/spaces/2/leave", params={"user_id": 1})
+    
+    operations = read_recording(str(tmp_path / "space-2.kvrec"))
+    assert [(kind, space_id, user_id) for _, kind, space_id, user_id, _ in operations] == [
+        ("enter", 2, 1), ("users", 2, 0), ("connect", 2, 1), ("move", 2, 1), ("chat", 2, 1),
+        ("users", 2, 0), ("disconnect", 2, 1), ("leave", 2, 1)]
+    assert operations[0][4] == {"name": "Ani", "position": {"x": 1.0, "y": 2.0, "z": 0.0}}
+    assert operations[4][4] == {"text": "Selamat pagi", "scope": "space"}
+    assert [operation[0] for operation in operations] == sorted(operation[0] for operation in operations)
+    assert not (tmp_path / "space-1.kvrec").exists()  # Pre-warming is not recorded
+    
+    # A record cut off by a crash is dropped, the rest still reads
+    data = (tmp_path / "space-2.kvrec").read_bytes()
+    (tmp_path / "space-2.kvrec").write_bytes(data[:-3])
+    assert len(read_recording(str(tmp_path / "space-2.kvrec"))) == len(operations) - 1
+    
+    # After a restart, new records are appended after the last complete one
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        client.post("/spaces/2/enter", json={"id": 5, "name": "Wayan"})
+    operations = read_recording(str(tmp_path / "space-2.kvrec"))
+    assert [(kind, user_id) for _, kind, _, user_id, _ in operations[-2:]] == [("disconnect", 1), ("enter", 5)]
+    assert operations[-1][4]["name"] == "Wayan"
+    
+    # Long multi-byte text and huge coordinates still give a readable log
+    from recording import (CHAT, ENTER, FLOAT32_MAX, HEADER, MAGIC, MOVE, VERSION,
+                           decode_recording, encode_operation)
+    data = (HEADER.pack(MAGIC, VERSION, 2) + encode_operation(ENTER, 1.0, 2, 5, {"name": "é" * 40000})
+            + encode_operation(MOVE, 2.0, 2, 5, {"position": {"x": 1e300, "y": 0, "z": 0}})
+            + encode_operation(CHAT, 3.0, 2, 5, {"text": "😀" * 20000, "scope": "space"}))
+    enter, move, chat = [operation[4] for operation in decode_recording(data)]
+    assert set(enter["name"]) == {"é"} and set(chat["text"]) == {"😀"}
+    assert move["position"]["x"] == FLOAT32_MAX
+
+def test_session_replay(tmp_path, monkeypatch):
+    """Test that a recorded session replays in order against a live server"""
+    import asyncio
+    import socket
+    import threading
+    import httpx
+    import uvicorn
+    from fastapi.testclient import TestClient
+    
+    monkeypatch.setenv("KITAVERSE_RECORD_DIR", str(tmp_path))
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        client.post("/spaces/2/enter", json={"id": 1, "name": "Ani"})
+        client.post("/spaces/2/enter", json={"id": 2, "name": "Budi"})
+        client.get("/spaces/2/users")
+        with client.websocket_connect("/spaces/2/ws?user_id=2") as websocket:
+            websocket.send_json({"type": "move", "position": {"x": 3, "y": 4, "z": 0}})
+            websocket.send_json({"type": "move", "position": {"x": 5, "y": 6, "z": 0}})
+            client.get("/spaces/2/users")  # Give the socket time to handle both messages
+        client.post("/spaces/2/leave", params={"user_id": 1})
+    
+    monkeypatch.delenv("KITAVERSE_RECORD_DIR")
+    backend = load_backend()
+    import replay
+    operations = list(replay.merge_recordings(replay.recording_paths([str(tmp_path)])))
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server_url = f"http://127.0.0.1:{port}"
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        report = asyncio.run(replay.replay(operations, server_url, speed=0))
+        assert report["operations"] == {"enter": 2, "users": 2, "connect": 1, "move": 2,
+                                        "disconnect": 1, "leave": 1}
+        assert report["statuses"] == {"enter": {200: 2}, "users": {200: 2}, "connect": {101: 1},
+                                      "leave": {200: 1}}
+        assert report["skipped"] == {} and report["schedule_lag_ms"] is None
+        
+        # Each user's operations arrived in the recorded order: Budi is still
+        # inside, at the position of the last move, and Ani has left
+        users = httpx.get(f"{server_url}/spaces/2/users").json()["users"]
+        assert [(user["id"], user["position"]) for user in users] == [(2, {"x": 5.0, "y": 6.0, "z": 0.0})]
+        
+        # Long pauses are shortened to max_gap
+        started = operations[0][0]
+        pause = [(started, "users", 2, 0, {}), (started + 100, "users", 2, 0, {})]
+        report = asyncio.run(replay.replay(pause, server_url, speed=1, max_gap=0.2))
+        assert report["recorded_duration_s"] == 0.2
+        assert 0.2 <= report["duration_s"] < 5
+        assert report["statuses"] == {"users": {200: 2}}
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+def test_position_validation(tmp_path, monkeypatch):
+    """Test that non-numeric positions are rejected instead of breaking snapshots"""
+    from fastapi.testclient import TestClient
+    
+    monkeypatch.setenv("KITAVERSE_SNAPSHOT_FILE", str(tmp_path / "state.snapshot"))
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        assert client.post("/spaces/3/enter", json={"id": 7, "name": "Dewi",
+                                                    "position": {"x": "abc"}}).status_code == 422
+        client.post("/spaces/3/enter", json={"id": 7, "name": "Dewi", "position": {"x": 1, "y": 2}})
+        with client.websocket_connect("/spaces/3/ws?user_id=7") as websocket:
+            websocket.send_json({"type": "move", "position": {"x": "abc", "y": 0, "z": 0}})
+            websocket.send_json({"type": "move", "position": {"x": 4, "y": 5, "z": 0}})
+            client.get("/spaces/3/users")  # Give the socket time to handle both messages
+        assert backend.users[7].position == {"x": 4.0, "y": 5.0, "z": 0.0}
+    
+    backend = load_backend()
+    with TestClient(backend.app) as client:
+        assert client.get("/spaces/3/users").json()["users"][0]["position"] == {"x": 4.0, "y": 5.0, "z": 0.0}
+
+def test_client_protocol():
+    """Test the protocol helpers shared by the clients and the swarm"""
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import protocol
+    
+    assert protocol.websocket_url("http://localhost:8000", 2, 7) == "ws://localhost:8000/spaces/2/ws?user_id=7"
+    frame = '{"type": "batch", "events": [{"type": "enter", "user_id": 1}, {"type": "leave", "user_id": 2}]}'
+    assert [e["type"] for e in protocol.iter_events(frame)] == ["enter", "leave"]
+    assert list(protocol.iter_events({"type": "chat"})) == [{"type": "chat"}]
+
+def test_client_trace(tmp_path):
+    """Test that the profiler's trace holds frame, render, network and model-load spans"""
+    import json
+    from types import SimpleNamespace
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import tracing
+    
+    recorder = tracing.TraceRecorder("desktop", trace_dir=str(tmp_path))
+    loader = SimpleNamespace(loadModel=lambda model_path, **kwargs: model_path)
+    recorder.instrument_loader(loader)
+    task = SimpleNamespace(cont="cont")
+    
+    # Two frames, with a request and a model load in the first one
+    for frame in range(2):
+        assert recorder._on_frame_start(task) == "cont"
+        if frame == 0:
+            recorder.record_request("GET", "/spaces/2/users", 0.002, 120, 3400, 200)
+            with recorder.measure("load_space_environment 2"):
+                assert loader.loadModel("models/misc/box") == "models/misc/box"
+        recorder._on_before_render(task)
+        recorder._on_after_render(task)
+    recorder._on_frame_start(task)
+    
+    with open(recorder.export()) as f:
+        trace = json.load(f)
+    assert trace["metadata"]["client"] == "desktop"
+    names = [(event["cat"], event["name"]) for event in trace["traceEvents"]]
+    assert names.count(("frame", "frame")) == 2 and names.count(("frame", "render")) == 2
+    assert names.count(("frame", "update")) == 2
+    first_frame = next(event for event in trace["traceEvents"] if event["name"] == "frame")
+    assert first_frame["args"] == {"network_wait_ms": 2.0}
+    assert ("scene_load", "load_space_environment 2") in names
+    model_load, = [event for event in trace["traceEvents"] if event["cat"] == "model_load"]
+    assert model_load["args"] == {"path": "models/misc/box"}
+    network, = [event for event in trace["traceEvents"] if event["cat"] == "network"]
+    assert network["name"] == "GET /spaces/2/users"
+    assert network["args"] == {"bytes_sent": 120, "bytes_received": 3400, "status": 200}
+    assert network["dur"] == 2000.0
+    assert (recorder.bytes_sent, recorder.bytes_received) == (120, 3400)
+    assert all(event["dur"] >= 0 for event in trace["traceEvents"])
+
+def test_client_heartbeat(monkeypatch):
+    """Test that a client that keeps heartbeating keeps its place and others are reaped"""
+    import socket
+    import threading
+    import uvicorn
+    
+    monkeypatch.setenv("KITAVERSE_PRESENCE_TIMEOUT", "1.5")
+    backend = load_backend()
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import protocol
+    
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        connection = protocol.KitaverseConnection(f"http://127.0.0.1:{port}")
+        connection.enter_space(2, 1, "Ani")
+        connection.enter_space(2, 2, "Budi")  # Never heartbeats
+        heartbeat = protocol.Heartbeat(connection)
+        heartbeat.start(2, 1)
+        time.sleep(3.5)
+        assert [u["id"] for u in connection.get_space_users(2)] == [1]
+        assert heartbeat.interval == 0.5 and not heartbeat.lost
+        
+        # Once the server has dropped the user, the client finds out
+        connection.leave_space(2, 1)
+        heartbeat.start(2, 1)
+        time.sleep(0.3)
+        assert heartbeat.lost
+        heartbeat.stop()
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+def test_asset_bundle(tmp_path, monkeypatch):
+    """Test that the asset bundle is content-addressed and deduplicated"""
+    import json
+    import package
+    
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("app/client")
+    os.makedirs("assets/models/furniture")
+    os.makedirs("assets/textures")
+    with open("app/client/spaces.json", "w") as f:
+        json.dump({"spaces": [
+            {"id": 1, "models": {"table": "models/furniture/round_table.bam"}},
+            {"id": 2, "models": {"table": "models/furniture/round_table.bam",
+                                 "stall": "models/furniture/market_stall.bam"}}
+        ]}, f)
+    with open("assets/models/furniture/round_table.bam", "wb") as f:
+        f.write(b"table\0textures/wood.png\0")
+    for texture in ("wood.png", "canvas.png"):
+        with open(f"assets/textures/{texture}", "wb") as f:
+            f.write(texture.encode())
+    
+    manifest = package.build_asset_bundle("bundle")
+    assert set(manifest["tiers"]) == set(package.TEXTURE_TIERS)
+    entry = manifest["tiers"]["low"]["models/furniture/round_table.bam"]
+    assert "models/furniture/market_stall.bam" not in manifest["tiers"]["low"]
+    
+    # Models list only the textures they use
+    assert entry["textures"] == ["textures/wood.png"]
+    
+    # One object serves every tier
+    objects = [name for _, _, files in os.walk("bundle/objects") for name in files]
+    textures = {manifest["tiers"][tier][f"textures/{texture}"]["hash"]
+                for tier in package.TEXTURE_TIERS for texture in ("wood.png", "canvas.png")}
+    assert sorted(objects) == sorted({entry["hash"]} | textures)
+    assert json.load(open("bundle/manifest.json"))["tiers"] == manifest["tiers"]
+
+def test_asset_streaming(tmp_path, monkeypatch):
+    """Test range requests for assets and eviction from the client cache"""
+    import hashlib
+    from fastapi.testclient import TestClient
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import asset_cache
+    
+    data = bytes(range(256)) * 40
+    digest = hashlib.sha256(data).hexdigest()
+    os.makedirs(tmp_path / "bundle" / "objects" / digest[:2])
+    (tmp_path / "bundle" / "objects" / digest[:2] / digest).write_bytes(data)
+    monkeypatch.setenv("KITAVERSE_ASSETS_DIR", str(tmp_path / "bundle"))
+    client = TestClient(load_backend().app)
+    
+    response = client.get(f"/assets/objects/{digest}", headers={"Range": "bytes=10000-"})
+    assert response.status_code == 206
+    assert response.content == data[10000:]
+    assert response.headers["content-range"] == f"bytes 10000-10239/{len(data)}"
+    assert "immutable" in response.headers["cache-control"]
+    assert client.get(f"/assets/objects/{digest}", headers={"Range": "bytes=20000-"}).status_code == 416
+    etag = client.get(f"/assets/objects/{digest}").headers["etag"]
+    assert client.get(f"/assets/objects/{digest}", headers={"If-None-Match": etag}).status_code == 304
+    
+    # Three 4 KB objects do not fit a 10 KB cache: the least recently used goes
+    cache = asset_cache.AssetCache(str(tmp_path / "cache"), "http://unused", max_bytes=10000)
+    
+    def fake_download(digest):
+        os.makedirs(os.path.dirname(cache.object_path(digest)), exist_ok=True)
+        with open(cache.object_path(digest), "wb") as f:
+            f.write(b"x" * 4000)
+    
+    monkeypatch.setattr(cache, "download", fake_download)
+    cache.fetch("a" * 64)
+    cache.fetch("b" * 64)
+    cache.fetch("a" * 64)
+    cache.fetch("c" * 64)
+    assert sorted(cache.index) == ["a" * 64, "c" * 64]
+    assert not os.path.exists(cache.object_path("b" * 64))
+    
+    # A server without a bundle has nothing to stream, which is not an error
+    import urllib.error
+    def no_bundle(request, timeout):
+        raise urllib.error.HTTPError(request.full_url, 404, "Not Found", {}, None)
+    
+    monkeypatch.setattr(asset_cache.urllib.request, "urlopen", no_bundle)
+    assert cache.fetch_manifest() == {"version": 1, "tiers": {}}
+    streamer = asset_cache.AssetStreamer(cache, "high")
+    streamer.request(1, ["models/furniture/round_table.bam"])
+    time.sleep(0.2)
+    assert streamer.poll() == [] and streamer.errors.empty()
+
+def test_differential_update(tmp_path, monkeypatch):
+    """Test that an install is updated with only the new chunks of the next build"""
+    import json
+    import random
+    import socket
+    import threading
+    import uvicorn
+    import package
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import updater
+    
+    monkeypatch.setattr(package, "UPDATES_DIR", str(tmp_path / "updates"))
+    monkeypatch.setenv("KITAVERSE_UPDATES_DIR", str(tmp_path / "updates"))
+    build = tmp_path / "build"
+    os.makedirs(build / "app")
+    data = random.Random(1).randbytes(300000)
+    (build / "app" / "world.bam").write_bytes(data)
+    (build / "README.md").write_text("Kitaverse")
+    (build / "old.txt").write_text("Dropped in the next build")
+    cache = {"files": {}, "chunks": {}, "assets": {}}
+    first = package.publish_update(str(build), cache)
+    
+    backend = load_backend()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(backend.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        install = tmp_path / "install"
+        os.makedirs(install)
+        assert updater.Updater(f"http://127.0.0.1:{port}", str(install)).run() == 3
+        
+        # The next build edits the middle of a file, drops one and adds one
+        (build / "app" / "world.bam").write_bytes(data[:150000] + b"edited" + data[150000:])
+        (build / "old.txt").unlink()
+        (build / "new.txt").write_text("Added in the next build")
+        second = package.publish_update(str(build), cache)
+        chunk_sizes = {digest: os.path.getsize(tmp_path / "updates" / "chunks" / digest[:2] / digest)
+                       for entry in second["files"].values() for digest in entry["chunks"]}
+        first_chunks = {digest for entry in first["files"].values() for digest in entry["chunks"]}
+        new_chunks = set(chunk_sizes) - first_chunks
+        assert 0 < len(new_chunks) < len(chunk_sizes)
+        
+        update = updater.Updater(f"http://127.0.0.1:{port}", str(install))
+        assert update.run() == 3
+        assert update.bytes_downloaded == sum(chunk_sizes[digest] for digest in new_chunks)
+        assert update.bytes_reused > 0
+        assert (install / "app" / "world.bam").read_bytes() == (build / "app" / "world.bam").read_bytes()
+        assert (install / "new.txt").exists() and not (install / "old.txt").exists()
+        assert update.run() == 0
+        
+        # A manifest cannot write or delete outside the install directory
+        entry = second["files"]["new.txt"]
+        hostile = {"version": "hostile", "files": {"../escape.txt": entry}}
+        (tmp_path / "updates" / "manifest.json").write_text(json.dumps(hostile))
+        try:
+            updater.Updater(f"http://127.0.0.1:{port}", str(install)).run()
+            assert False, "A path outside the install directory was accepted"
+        except updater.UpdateError:
+            pass
+        assert not (tmp_path / "escape.txt").exists()
+        assert (install / "README.md").exists()
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+def test_response_compression(tmp_path, monkeypatch):
+    """Test that large JSON replies are compressed and small or binary ones are not"""
+    from fastapi.testclient import TestClient
+    
+    (tmp_path / "manifest.json").write_text('{"version": 1, "tiers": {"low": {}}}' * 20)
+    monkeypatch.setenv("KITAVERSE_ASSETS_DIR", str(tmp_path))
+    backend = load_backend()
+    client = TestClient(backend.app)
+    for user_id in range(1, 30):
+        backend.admit_user(2, backend.User(id=user_id, name=f"Villager {user_id}"))
+    
+    response = client.get("/spaces/2/users", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < len(response.content) / 3
+    assert len(response.json()["users"]) == 29
+    assert "content-encoding" not in client.get("/", headers={"Accept-Encoding": "gzip"}).headers
+    assert "content-encoding" not in client.get("/spaces/2/users", headers={"Accept-Encoding": "identity"}).headers
+    
+    # Compressed manifests carry a weak ETag that still revalidates
+    manifest = client.get("/assets/manifest", headers={"Accept-Encoding": "gzip"})
+    assert manifest.headers["etag"].startswith('W/"')
+    assert client.get("/assets/manifest", headers={"Accept-Encoding": "gzip",
+                                                   "If-None-Match": manifest.headers["etag"]}).status_code == 304
+
+def test_startup_readiness():
+    """Test that the backend reports ready only after pre-warming, and not while draining"""
+    from fastapi.testclient import TestClient
+    
+    backend = load_backend()
+    from launcher import shard_layout, uvicorn_options
+    client = TestClient(backend.app)
+    assert client.get("/health/ready").status_code == 503
+    with client:
+        ready = client.get("/health/ready")
+        assert ready.status_code == 200
+        assert {"blocking_pool", "occupancy", "manifests", "first_requests"} <= set(ready.json()["phases"])
+        assert ready.json()["cold_start_ms"] > 0
+        assert client.get("/health/live").json()["status"] == "alive"
+    assert client.get("/health/ready").json()["status"] == "draining"
+    
+    options = uvicorn_options({"host": "0.0.0.0", "workers": 2, "loop": "uvloop", "http": "h11",
+                               "backlog": 2048, "no_such_setting": 1})
+    assert options["backlog"] == 2048 and options["http"] == "h11" and "no_such_setting" not in options
+    assert shard_layout([1, 2, 3], 2, "0.0.0.0", 8000)["workers"] == [
+        {"port": 8001, "spaces": [1, 3]}, {"port": 8002, "spaces": [2]}]
+
+def test_content_defined_chunks():
+    """Test that an edit only changes the chunks around it"""
+    import random
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    import chunking
+    
+    data = random.Random(42).randbytes(300000)
+    edited = data[:150000] + b"new stall prices" + data[150000:]
+    before = [h for h, _ in chunking.split_chunks(data)]
+    after = [h for h, _ in chunking.split_chunks(edited)]
+    
+    assert b"".join(c for _, c in chunking.split_chunks(edited)) == edited
+    assert len(before) > 10
+    assert len(set(after) - set(before)) <= 2
+
+def test_node_pool():
+    """Test that released nodes are reused and idle nodes stay bounded"""
+    if CLIENT_DIR not in sys.path:
+        sys.path.insert(0, CLIENT_DIR)
+    from pool import ScenePools
+    
+    class FakeNode:
+        def __init__(self, model_path):
+            self.model_path = model_path
+            self.parent = None
+            self.removed = False
+        
+        def reparentTo(self, parent):
+            self.parent = parent
+        
+        def detachNode(self):
+            self.parent = None
+        
+        def clearTransform(self):
+            pass
+        
+        def clearColor(self):
+            pass
+        
+        def removeNode(self):
+            self.parent = None
+            self.removed = True
+    
+    pools = ScenePools(FakeNode, max_idle=2)
+    chairs = [pools.acquire("environment", "models/misc/box", "meeting") for _ in range(3)]
+    pools.release_group("environment")
+    assert [chair.parent for chair in chairs] == [None, None, None]
+    assert sum(chair.removed for chair in chairs) == 1  # Only two are kept idle
+    
+    stalls = [pools.acquire("environment", "models/misc/box", "market") for _ in range(3)]
+    assert len({id(stall) for stall in stalls} & {id(chair) for chair in chairs}) == 2
+    assert all(stall.parent == "market" for stall in stalls)
+    assert pools.stats()["models/misc/box"] == {"idle": 0, "created": 4, "reused": 2, "discarded": 1}
+
 def test_client():
     """Test if the client dependencies are available"""
     print("\nTesting client dependencies...")